@@ -1,154 +1,110 @@
 # This file replicates the dataset creation testfile
 # of Gate 9
 
-import opengate as gate
+import argparse
+import json
+import os
+
 import opengate.tests.utility as tu
 
+from dataset_simulation import (PHASE_SPACE_OUTPUT_FILENAME, PHASE_SPACE_OUTPUT_PROFILES, make_simulation_config,
+                                run_simulation)
+from concurrent_optigan import run_concurrent_optigan
+from phase_space_shards import (launch_shards, merge_phase_space_files, shard_output_filename, shard_seeds,
+                                shard_time_intervals)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Creates the phase space dataset of the optigan simulation.")
+    parser.add_argument("--config", default=None,
+                        help="json file with the simulation config values to change (see dataset_simulation.py)")
+    parser.add_argument("--threads", type=int, default=1, help="number of Geant4 threads per run (default: %(default)s)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="number of independent runs launched as separate processes, each with its own "
+                             "seed and slice of the run time, merged at the end (default: %(default)s)")
+    parser.add_argument("--shard-index", type=int, default=None, help="runs only this shard (used by the shard launcher)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed, 'auto' if not given (default: %(default)s)")
+    parser.add_argument("--start-time", type=float, default=0, help="start of the run in seconds (default: %(default)s)")
+    parser.add_argument("--end-time", type=float, default=1, help="end of the run in seconds (default: %(default)s)")
+    parser.add_argument("--profile", choices=list(PHASE_SPACE_OUTPUT_PROFILES), default=None,
+                        help="phase space attributes stored (default: the config one, full)")
+    parser.add_argument("--keep-shards", action="store_true", help="keeps the shard (or chunk) root files after the merge")
+    parser.add_argument("--no-material-cache", action="store_true",
+                        help="reads the full material database instead of its reduced copy in the output material_cache folder")
+    parser.add_argument("--concurrent-optigan", type=int, default=None, metavar="CHUNKS",
+                        help="runs the simulation as this number of time slice chunks while an optigan worker "
+                             "generates the photons of every completed chunk, then merges the chunks")
+    parser.add_argument("--chunk-jobs", type=int, default=1,
+                        help="chunks simulated at the same time with --concurrent-optigan (default: %(default)s)")
+    parser.add_argument("--optigan-threads", type=int, default=None,
+                        help="torch threads of the optigan worker with --concurrent-optigan (default: torch's)")
+    args = parser.parse_args()
+
     paths = tu.get_default_test_paths(__file__, "")
     # paths.data = paths.current
 
     print(f"The information insides paths variable is {paths}")
 
-    # create simulation
-    sim = gate.Simulation()
-    sim.g4_verbose = True
-    sim.output_dir = paths.output
-
-    # units
-    m = gate.g4_units.m
-    cm = gate.g4_units.cm
-    mm = gate.g4_units.mm
-    um = gate.g4_units.um
-    eV = gate.g4_units.eV
-    MeV = gate.g4_units.MeV
-    keV = gate.g4_units.keV
-    Bq = gate.g4_units.Bq
-    deg = gate.g4_units.deg
-
-    # set the world size like in the Gate macro
-    # verified with C++ macro files
-    sim.world.size = [10 * cm, 10 * cm, 15 * cm]
-
-    # optical_system 
-    # verified with C++ macro files 
-    optical_system = sim.add_volume("Box", "optical_system")
-    optical_system.size = [10 * cm, 10 * cm, 14 * cm]
-    optical_system.material = "G4_AIR"
-    optical_system.translation = [0 * cm, 0 * cm, 0 * cm]
-
-    # add a material database
-    sim.volume_manager.add_material_database(paths.data / "GateMaterials.db")
-
-    # crystal 
-    # verified with C++ macro files
-    crystal = sim.add_volume("Box", "crystal")
-    crystal.mother = optical_system.name
-    crystal.size = [3 * mm, 3 * mm, 20 * mm]
-    crystal.translation = [0 * mm, 0 * mm, 10 * mm]
-    crystal.material = "BGO"
-
-    # grease
-    # verified with C++ macro files
-    grease = sim.add_volume("Box", "grease")
-    grease.mother = optical_system.name
-    grease.size = [3 * mm, 3 * mm, 0.015 * mm]
-    grease.material = "Epoxy"
-    grease.translation = [0 * mm, 0 * mm, 20.0075 * mm]
-
-    # pixel
-    # verified with C++ macro files 
-    pixel = sim.add_volume("Box", "pixel")
-    pixel.mother = optical_system.name
-    pixel.size = [3 * mm, 3 * mm, 0.1 * mm]
-    pixel.material = "SiO2"
-    pixel.translation = [0 * mm, 0 * mm, 20.065 * mm]
-
-    # physics
-    # verified with C++ macro files
-    sim.physics_manager.physics_list_name = "G4EmStandardPhysics_option4"
-    sim.physics_manager.set_production_cut("world", "electron", 10 * mm) #same as SetCutInRegion?
-    sim.physics_manager.set_production_cut("world", "positron", 10 * um)
-    sim.physics_manager.set_production_cut("crystal", "electron", 10 * um)
-    sim.physics_manager.set_production_cut("crystal", "positron", 10 * um)
-    sim.physics_manager.energy_range_min = 10 * eV
-    sim.physics_manager.energy_range_max = 1 * MeV
-    sim.physics_manager.special_physics_constructors.G4OpticalPhysics = True
-
-    # surfaces
-    # verified with C++ macro files
-
-    # RoughESR_LUT.z -> Customized3_LUT.z
-    # RoughESR_LUTR.z -> Customized3_LUTR.z
-    opt_surf_optical_system_to_crystal = sim.physics_manager.add_optical_surface(
-        volume_from="optical_system",
-        volume_to="crystal",
-        g4_surface_name="Customized3_LUT",
-    )
-
-    opt_surf_crystal_to_optical_system = sim.physics_manager.add_optical_surface(
-        "crystal", "optical_system", "Customized3_LUT"
+    config_overrides = {}
+    if args.config is not None:
+        with open(args.config) as config_file:
+            config_overrides = json.load(config_file)
+    if args.profile is not None:
+        config_overrides["output_profile"] = args.profile
+    config = make_simulation_config(
+        config_overrides,
+        output_dir=str(paths.output),
+        material_database=str(paths.data / "GateMaterials.db"),
+        material_cache_folder=None if args.no_material_cache else str(paths.output / "material_cache"),
+        number_of_threads=args.threads,
+        seed=args.seed,
+        start_time_s=args.start_time,
+        end_time_s=args.end_time,
     )
-
-    # Rough_LUT.z -> Customized2_LUT.z
-    # Rough_LUTR.z -> Customized2_LUTR.z
-    opt_surf_grease_to_crystal = sim.physics_manager.add_optical_surface("grease", "crystal", "Customized2_LUT")
-
-    opt_surf_crystal_to_grease = sim.physics_manager.add_optical_surface("crystal", "grease", "Customized2_LUT")
-
-    # RoughESRGrease_LUT.z -> Customized4_LUT.z
-    # RoughESRGrease_LUTR.z -> Customized4_LUTR.z
-    opt_surface_pixel_to_grease = sim.physics_manager.add_optical_surface("pixel", "grease", "Customized4_LUT")
-
-    opt_surf_grease_to_pixel = sim.physics_manager.add_optical_surface("grease", "pixel", "Customized4_LUT")
-
-    # source user info
-    # verified with C++ macro files
-    source = sim.add_source("GenericSource", "my_source")
-    source.particle = "e-"
-    source.energy.type = "mono"
-    source.energy.mono = 420 * keV
-    source.position.type = "sphere"
-    source.position.radius = 0 * mm
-    source.activity = 1000 * Bq
-    source.direction.type = "iso"
-    source.direction.theta = [163 * deg, 165 * deg]
-    source.direction.phi = [100 * deg, 110 * deg]
-    source.position.translation = [0 * mm, 0 * mm, 19 * mm]
-
-    # add a phase space actor to the crystal
-    # verified with C++ macro files 
-    phase = sim.add_actor("PhaseSpaceActor", "Phase")
-    phase.attached_to = pixel.name
-    phase.output_filename = "test075_optigan_create_dataset_carlotta_simu_exiting_phase_space.root"
-    phase.attributes = [
-        "EventID",
-        "ParticleName",
-        "Position",
-        "TrackID",
-        "ParentID",
-        "Direction",
-        "KineticEnergy",
-        "PreKineticEnergy",
-        "PostKineticEnergy",
-        "TotalEnergyDeposit",
-        "LocalTime",
-        "GlobalTime",
-        "TimeFromBeginOfEvent",
-        "StepLength",
-        "TrackCreatorProcess",
-        "TrackLength",
-        "PDGCode",
-    ]
-    phase.steps_to_store = "exiting"
-
+    output_filename = config_overrides.get("output_filename", PHASE_SPACE_OUTPUT_FILENAME)
+
+    # concurrent optigan mode: the chunks of the run are simulated one after the other
+    # (--chunk-jobs at a time) while an optigan worker consumes the completed ones
+    if args.concurrent_optigan is not None:
+        merged_root_file_path = os.path.join(paths.output, output_filename)
+        run_concurrent_optigan(config, args.concurrent_optigan, str(paths.output / "phase_space_chunks"),
+                               str(paths.data / "optigan_models"), str(paths.output / "optigan_chunk_outputs"),
+                               jobs=args.chunk_jobs, merged_root_file_path=merged_root_file_path, keep_chunks=args.keep_shards,
+                               crystal_size_mm=config["crystal_size_mm"], number_of_threads=args.optigan_threads, seed=args.seed)
+        raise SystemExit(0)
+
+    # shard mode: every shard runs this script in its own process on a slice of
+    # the run time, then the shard root files are merged with renumbered event ids
+    if args.shards > 1 and args.shard_index is None:
+        seeds = shard_seeds(args.shards, args.seed)
+        time_intervals = shard_time_intervals(args.shards, args.start_time, args.end_time)
+        config_arguments = ["--config", args.config] if args.config is not None else []
+        if args.profile is not None:
+            config_arguments += ["--profile", args.profile]
+        if args.no_material_cache:
+            config_arguments += ["--no-material-cache"]
+        launch_shards(__file__, [
+            config_arguments +
+            ["--threads", str(args.threads), "--shards", str(args.shards), "--shard-index", str(shard_index),
+             "--seed", str(seeds[shard_index]), "--start-time", str(start_time), "--end-time", str(end_time)]
+            for shard_index, (start_time, end_time) in enumerate(time_intervals)
+        ])
+        shard_root_file_paths = [os.path.join(paths.output, shard_output_filename(output_filename, shard_index))
+                                 for shard_index in range(args.shards)]
+        merged_root_file_path = os.path.join(paths.output, output_filename)
+        number_of_entries = merge_phase_space_files(shard_root_file_paths, merged_root_file_path, "Phase")
+        print(f"{args.shards} shards merged in {merged_root_file_path} ({number_of_entries} entries)")
+        if not args.keep_shards:
+            for shard_root_file_path in shard_root_file_paths:
+                os.remove(shard_root_file_path)
+        raise SystemExit(0)
+
+    if args.shard_index is not None:
+        config["output_filename"] = shard_output_filename(output_filename, args.shard_index)
 
     # optical_adder = sim.add_actor("HitsReadoutActor", "Singles")
     # optical_adder.input_digi_collection = "Hits"
 
-   
-    sim.user_hook_after_run = gate.userhooks.user_hook_dump_material_properties
-    sim.run()
+    sim = run_simulation(config)
 
     is_ok = all(t is True for t in sim.user_hook_log)
-    tu.test_ok(is_ok)
\ No newline at end of file
+    tu.test_ok(is_ok)
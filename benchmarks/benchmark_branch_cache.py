@@ -0,0 +1,64 @@
+# Time of the repeated reads of a phase space: the event segmentation and the
+# filtering of a synthetic phase space read from the root file (uproot decompresses
+# and deserializes the branches every time), then through branch_cache.py: the first
+# pass decodes the branches into the cache, the next ones map the .npy files.
+#
+# usage: python benchmarks/benchmark_branch_cache.py --events 5000 --repeats 3
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from branch_cache import BranchCache
+from optigan_segmentation import segment_root_file
+from root_filter_engine import DEFAULT_FILTERS, ParticleFilter, RootFilterEngine
+
+# the default filters and a filter on the ParticleName strings
+FILTERS = DEFAULT_FILTERS + [ParticleFilter("optical_photon_filter", "opticalphoton")]
+
+
+def run_passes(phase_space_path, work_folder, repeats, branch_cache=None):
+    output_root_file_paths = {root_filter.name: os.path.join(work_folder, f"{root_filter.name}.root") for root_filter in FILTERS}
+    seconds = {"segmentation": [], "filtering": []}
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        segment_root_file(phase_space_path, "Phase", branch_cache=branch_cache)
+        seconds["segmentation"].append(time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        RootFilterEngine(FILTERS, branch_cache=branch_cache).run(phase_space_path, output_root_file_paths)
+        seconds["filtering"].append(time.perf_counter() - start_time)
+    return seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Repeated reads of a phase space with and without the branch cache")
+    parser.add_argument("--events", type=int, default=5000, help="events of the synthetic phase space (default: %(default)s)")
+    parser.add_argument("--repeats", type=int, default=3, help="passes of every measure (default: %(default)s)")
+    parser.add_argument("--output", default=None, help="json file of the results")
+    args = parser.parse_args()
+
+    from benchmark_pipeline import synthesize_phase_space
+
+    with tempfile.TemporaryDirectory() as work_folder:
+        phase_space_path = os.path.join(work_folder, "phase_space.root")
+        number_of_entries = synthesize_phase_space(phase_space_path, args.events, output_profile="full")
+        results = {"root_file": run_passes(phase_space_path, work_folder, args.repeats)}
+        results["branch_cache"] = run_passes(phase_space_path, work_folder, args.repeats + 1,
+                                             BranchCache(os.path.join(work_folder, "branch_cache")))
+
+    print(f"{args.events} events, {number_of_entries} entries")
+    for stage in ("segmentation", "filtering"):
+        root_file_seconds = min(results["root_file"][stage])
+        first_seconds, *cached_seconds = results["branch_cache"][stage]
+        print(f"{stage:13s} root file {root_file_seconds:6.3f} s, first cached pass {first_seconds:6.3f} s, "
+              f"next passes {min(cached_seconds):6.3f} s (x{root_file_seconds / min(cached_seconds):.1f})")
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump({"events": args.events, "entries": number_of_entries, "seconds": results}, output_file, indent=2)
+        print(f"Results written in {args.output}")
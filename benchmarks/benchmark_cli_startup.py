@@ -0,0 +1,85 @@
+# Cold start time of the pipeline_cli.py subcommands: every command runs in a new
+# python process, the best of --repeats runs is kept with the heavy modules it
+# imported. The non plotting subcommands run on a synthetic phase space, the
+# "--help" runs measure the cost of just starting the cli.
+#
+# usage: python benchmarks/benchmark_cli_startup.py --events 1000 --repeats 5
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPOSITORY_FOLDER)
+
+# modules whose import dominates the start time
+HEAVY_MODULES = ["numpy", "uproot", "awkward", "pandas", "torch", "matplotlib", "seaborn", "scipy", "opengate"]
+
+# runs the cli in this process and prints the heavy modules it imported
+RUN_CLI = """
+import json, sys
+sys.path.insert(0, {repository_folder!r})
+sys.argv = ["pipeline_cli.py"] + {arguments!r}
+import pipeline_cli
+try:
+    pipeline_cli.main()
+except SystemExit:
+    pass
+print(json.dumps([module for module in {heavy_modules!r} if module in sys.modules]), file=sys.stderr)
+"""
+
+
+# best wall time of the command and the heavy modules it imported
+def measure_command(arguments, repeats):
+    code = RUN_CLI.format(repository_folder=REPOSITORY_FOLDER, arguments=arguments, heavy_modules=HEAVY_MODULES)
+    seconds = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        process = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        seconds.append(time.perf_counter() - start_time)
+        if process.returncode != 0:
+            raise RuntimeError(f"pipeline_cli.py {' '.join(arguments)} failed:\n{process.stderr}")
+    return {"seconds": min(seconds), "imported": json.loads(process.stderr.strip().splitlines()[-1])}
+
+
+def get_commands(work_folder):
+    phase_space_path = os.path.join(work_folder, "phase_space.root")
+    return {
+        "help": ["--help"],
+        "filter --help": ["filter", "--help"],
+        "extract-events --help": ["extract-events", "--help"],
+        "generate --help": ["generate", "--help"],
+        "compare --help": ["compare", "--help"],
+        "extract-events": ["extract-events", phase_space_path],
+        "compare": ["compare", "--dataset", f"a:{phase_space_path}:Phase", "--dataset", f"b:{phase_space_path}:Phase",
+                    "--quantities", "X", "Y", "--output", os.path.join(work_folder, "comparison.json")],
+        "filter": ["filter", "--input-folder", work_folder, "--output-folder", os.path.join(work_folder, "filtered"),
+                   "--no-plots", "--force"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold start time of the pipeline_cli.py subcommands")
+    parser.add_argument("--events", type=int, default=1000, help="events of the synthetic phase space (default: %(default)s)")
+    parser.add_argument("--repeats", type=int, default=5, help="runs of every command, the best is kept (default: %(default)s)")
+    parser.add_argument("--output", default=None, help="json file of the results")
+    args = parser.parse_args()
+
+    from benchmark_pipeline import synthesize_phase_space
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_folder:
+        synthesize_phase_space(os.path.join(work_folder, "phase_space.root"), args.events, output_profile="comparison")
+        for name, arguments in get_commands(work_folder).items():
+            results[name] = measure_command(arguments, args.repeats)
+            print(f"{name:24s} {results[name]['seconds']:6.3f} s  imports {', '.join(results[name]['imported']) or '-'}")
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump({"events": args.events, "repeats": args.repeats, "commands": results}, output_file, indent=2)
+        print(f"Results written in {args.output}")
@@ -0,0 +1,85 @@
+# Wall time of the simulation followed by the optigan stage against the concurrent
+# mode of concurrent_optigan.py, where the optigan worker consumes the phase space
+# chunks while the next ones are simulated. The Geant4 side is emulated: every chunk
+# is a synthetic phase space written after sleeping --chunk-seconds, so the benchmark
+# runs without opengate.
+#
+# usage: python benchmarks/benchmark_concurrent_optigan.py --model-folder ../data/optigan_models --chunks 4 --events 2000
+
+import argparse
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from concurrent_optigan import (chunk_file_name, clean_chunk_folder, consume_phase_space_chunks, get_chunk_configs,
+                                produce_phase_space_chunks, run_concurrent_optigan)
+from dataset_simulation import get_phase_space_output_path, make_simulation_config
+
+
+# stands for run_chunk_simulation: a synthetic phase space of number_of_events
+# events, published once chunk_seconds have passed
+def run_synthetic_chunk(chunk_config, chunk_file_path, number_of_events, chunk_seconds):
+    from benchmark_pipeline import synthesize_phase_space
+
+    start_time = time.perf_counter()
+    partial_file_path = get_phase_space_output_path(chunk_config)
+    synthesize_phase_space(partial_file_path, number_of_events, seed=chunk_config["seed"], output_profile=chunk_config["output_profile"])
+    time.sleep(max(0.0, chunk_seconds - (time.perf_counter() - start_time)))
+    os.replace(partial_file_path, chunk_file_path)
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sequential against concurrent simulation and optigan stages")
+    parser.add_argument("--model-folder", required=True, help="folder of the optigan model files")
+    parser.add_argument("--chunks", type=int, default=4, help="chunks of the run (default: %(default)s)")
+    parser.add_argument("--events", type=int, default=2000, help="events per chunk (default: %(default)s)")
+    parser.add_argument("--chunk-seconds", type=float, default=2.0, help="emulated simulation time of a chunk (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads of the optigan worker")
+    parser.add_argument("--output", default=None, help="json file of the results")
+    args = parser.parse_args()
+
+    run_chunk = functools.partial(run_synthetic_chunk, number_of_events=args.events, chunk_seconds=args.chunk_seconds)
+    consumer_options = {"number_of_threads": args.threads, "seed": 0, "poll_seconds": 0.05}
+    with tempfile.TemporaryDirectory() as work_folder:
+        chunk_folder = os.path.join(work_folder, "chunks")
+        config = make_simulation_config(seed=0, output_profile="optigan")
+
+        # sequential: every chunk is simulated, then the optigan stage runs on all of them
+        clean_chunk_folder(chunk_folder)
+        start_time = time.perf_counter()
+        produce_phase_space_chunks(get_chunk_configs(config, args.chunks, chunk_folder), chunk_folder, 1, run_chunk)
+        sequential_simulation_seconds = time.perf_counter() - start_time
+        sequential_result = consume_phase_space_chunks(chunk_folder, args.model_folder, os.path.join(work_folder, "sequential"),
+                                                       **consumer_options)
+        sequential_seconds = time.perf_counter() - start_time
+
+        concurrent_report = run_concurrent_optigan(config, args.chunks, chunk_folder, args.model_folder,
+                                                   os.path.join(work_folder, "concurrent"), run_chunk=run_chunk, **consumer_options)
+        assert os.path.exists(os.path.join(chunk_folder, chunk_file_name(args.chunks - 1)))
+
+    optigan_seconds = sequential_seconds - sequential_simulation_seconds
+    results = {
+        "chunks": args.chunks,
+        "events_per_chunk": args.events,
+        "number_of_photons": concurrent_report["metrics"]["number_of_photons"],
+        "simulation_seconds": sequential_simulation_seconds,
+        "optigan_seconds": optigan_seconds,
+        "sequential_seconds": sequential_seconds,
+        "concurrent_seconds": concurrent_report["wall_seconds"],
+        "optigan_wait_seconds": concurrent_report["optigan_wait_seconds"],
+    }
+    print(f"simulation {sequential_simulation_seconds:.2f} s, optigan {optigan_seconds:.2f} s "
+          f"({sequential_result['metrics']['number_of_photons']} photons)")
+    print(f"sequential {sequential_seconds:.2f} s, concurrent {concurrent_report['wall_seconds']:.2f} s "
+          f"(max of both {max(sequential_simulation_seconds, optigan_seconds):.2f} s)")
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Results written in {args.output}")
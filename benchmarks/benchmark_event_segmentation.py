@@ -0,0 +1,92 @@
+# Compares the row by row event segmentation (reference loop) with the
+# numpy based one on a synthetic phase space and checks that both agree.
+#
+# usage: python benchmarks/benchmark_event_segmentation.py --events 20000 --photons 300
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optigan_segmentation import (
+    particle_codes,
+    process_particles_into_events,
+    extract_event_details,
+    segment_events,
+    event_table_to_details,
+)
+
+
+# builds the ParticleName and Position branches of a phase space with
+# one gamma per event followed by a shuffled mix of e- and optical photons
+def synthesize_particles(number_of_events, mean_photons, mean_electrons, seed):
+    rng = np.random.default_rng(seed)
+    photons_per_event = rng.poisson(mean_photons, number_of_events)
+    electrons_per_event = rng.poisson(mean_electrons, number_of_events)
+
+    particle_types = []
+    for number_of_photons, number_of_electrons in zip(photons_per_event, electrons_per_event):
+        secondaries = ["opticalphoton"] * number_of_photons + ["e-"] * number_of_electrons
+        rng.shuffle(secondaries)
+        particle_types.append("gamma")
+        particle_types.extend(secondaries)
+
+    particle_types = np.array(particle_types, dtype=object)
+    number_of_rows = len(particle_types)
+    position_x = rng.uniform(-1.5, 1.5, number_of_rows)
+    position_y = rng.uniform(-1.5, 1.5, number_of_rows)
+    position_z = rng.uniform(20.015, 20.115, number_of_rows)
+    return particle_types, position_x, position_y, position_z
+
+
+# runs the function a few times and returns the best wall time
+def best_time(function, repeat, *args):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def loop_segmentation(*branches):
+    return extract_event_details(process_particles_into_events(*branches))
+
+
+def vectorized_segmentation(*branches):
+    return event_table_to_details(segment_events(*branches))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the optigan event segmentation")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--photons", type=float, default=300, help="mean number of optical photons per event")
+    parser.add_argument("--electrons", type=float, default=2, help="mean number of electrons per event")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    branches = synthesize_particles(args.events, args.photons, args.electrons, args.seed)
+    print(f"Synthesized {len(branches[0])} rows for {args.events} events")
+
+    loop_time, loop_details = best_time(loop_segmentation, args.repeat, *branches)
+    vectorized_time, vectorized_details = best_time(vectorized_segmentation, args.repeat, *branches)
+    table_time, _ = best_time(segment_events, args.repeat, *branches)
+    # same with the particle types read from PDGCode instead of ParticleName
+    codes_time, pdg_codes = best_time(particle_codes, args.repeat, branches[0])
+    pdg_code_time, _ = best_time(segment_events, args.repeat, pdg_codes, *branches[1:])
+
+    assert len(loop_details) == len(vectorized_details), "the number of events differs"
+    for loop_detail, vectorized_detail in zip(loop_details, vectorized_details):
+        assert loop_detail == vectorized_detail, f"{loop_detail} != {vectorized_detail}"
+
+    print(f"loop segmentation:        {loop_time:.3f} s")
+    print(f"vectorized segmentation:  {vectorized_time:.3f} s (x{loop_time / vectorized_time:.1f})")
+    print(f"vectorized, arrays only:  {table_time:.3f} s (x{loop_time / table_time:.1f})")
+    print(f"vectorized, PDGCode:      {pdg_code_time:.3f} s (x{loop_time / pdg_code_time:.1f}), "
+          f"names to codes once: {codes_time:.3f} s")
@@ -0,0 +1,65 @@
+# Time spent reading the material database and the optical property files at
+# the start of a simulation, with the full files of the repository and with the
+# reduced copies of material_cache.py (only the materials and surfaces of the
+# default geometry). The files are parsed like the simulation does: the Gate
+# material database line by line and the xml files with ElementTree.
+#
+# usage: python benchmarks/benchmark_material_cache.py --repeats 20
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataset_simulation import DEFAULT_SIMULATION_CONFIG
+from material_cache import (MATERIAL_DATABASE_PATH, OPTICAL_PROPERTIES_PATH, SURFACE_PROPERTIES_PATH, get_cached_material_files,
+                            get_config_materials, get_config_surfaces, parse_material_database)
+
+
+# best time of parsing the three files
+def parse_seconds(material_files, repeats):
+    seconds = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        parse_material_database(material_files["material_database"])
+        ElementTree.parse(material_files["optical_properties_file"])
+        ElementTree.parse(material_files["surface_properties_file"])
+        seconds.append(time.perf_counter() - start_time)
+    return min(seconds)
+
+
+def files_size(material_files):
+    return sum(os.path.getsize(path) for path in material_files.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start time of the material and optical surface files, full and cached")
+    parser.add_argument("--repeats", type=int, default=20, help="runs of every measure, the best is kept (default: %(default)s)")
+    args = parser.parse_args()
+
+    full_files = {
+        "material_database": MATERIAL_DATABASE_PATH,
+        "optical_properties_file": OPTICAL_PROPERTIES_PATH,
+        "surface_properties_file": SURFACE_PROPERTIES_PATH,
+    }
+    material_names = get_config_materials(DEFAULT_SIMULATION_CONFIG)
+    surface_names = get_config_surfaces(DEFAULT_SIMULATION_CONFIG)
+    with tempfile.TemporaryDirectory() as cache_folder:
+        start_time = time.perf_counter()
+        cached_files = get_cached_material_files(cache_folder, material_names, surface_names)
+        cold_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        get_cached_material_files(cache_folder, material_names, surface_names)
+        warm_seconds = time.perf_counter() - start_time
+
+        full_seconds = parse_seconds(full_files, args.repeats)
+        cached_seconds = parse_seconds(cached_files, args.repeats)
+        print(f"materials {material_names}, surfaces {surface_names}")
+        print(f"full files:   {files_size(full_files):8d} bytes, parsed in {full_seconds * 1000:7.2f} ms")
+        print(f"cached files: {files_size(cached_files):8d} bytes, parsed in {cached_seconds * 1000:7.2f} ms "
+              f"(x{full_seconds / cached_seconds:.1f})")
+        print(f"cache written in {cold_seconds * 1000:.2f} ms, found in {warm_seconds * 1000:.2f} ms")
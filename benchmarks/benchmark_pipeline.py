@@ -0,0 +1,399 @@
+# Benchmark of the dataset comparison pipeline on synthetic phase space root
+# files (same "Phase" tree schema as 0_dataset_creation.py, no Geant4 needed).
+# Every stage runs in its own process so its peak memory is measured alone,
+# the results are written as json and can be compared with a previous run.
+#
+# usage: python benchmarks/benchmark_pipeline.py --events 1000 10000 --output benchmark.json
+#        python benchmarks/benchmark_pipeline.py --events 1000 10000 --compare benchmark.json
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_event_segmentation import synthesize_particles
+from dataset_simulation import PHASE_SPACE_OUTPUT_PROFILES
+from optigan_segmentation import PARTICLE_PDG_CODES
+from root_streaming import RootTreeWriter
+
+STAGES = [
+    "read",
+    "segmentation",
+    "segmentation_streaming",
+    "inputs_csv",
+    "inputs_root",
+    "inference",
+    "outputs_csv",
+    "outputs_root",
+    "filtering",
+    "histograms",
+]
+
+# branches written by each phase space attribute
+ATTRIBUTE_BRANCHES = {
+    "Position": ["Position_X", "Position_Y", "Position_Z"],
+    "Direction": ["Direction_X", "Direction_Y", "Direction_Z"],
+}
+INTEGER_BRANCHES = {"EventID", "TrackID", "ParentID", "PDGCode"}
+
+# events synthesized (and written) at once
+EVENTS_PER_CHUNK = 2000
+
+
+# branches of the phase space tree for an output profile of dataset_simulation
+def profile_branches(output_profile):
+    return [branch for attribute in PHASE_SPACE_OUTPUT_PROFILES[output_profile]
+            for branch in ATTRIBUTE_BRANCHES.get(attribute, [attribute])]
+
+
+# one chunk of a phase space: gammas followed by e- and optical photons
+# (see benchmark_event_segmentation.synthesize_particles), the photons
+# cross the pixel with positions and directions spread like the simulation ones
+def synthesize_phase_space_chunk(branches, number_of_events, first_event_id, mean_photons, mean_electrons, seed):
+    particle_types, position_x, position_y, position_z = synthesize_particles(number_of_events, mean_photons, mean_electrons, seed)
+    particle_types = particle_types.astype(str)
+    rng = np.random.default_rng(seed + 1)
+    number_of_rows = len(particle_types)
+    is_optical_photon = particle_types == "opticalphoton"
+
+    columns = {
+        "EventID": (first_event_id + np.cumsum(particle_types == "gamma") - 1).astype(np.int32),
+        "ParticleName": particle_types,
+        "PDGCode": np.array([PARTICLE_PDG_CODES[name] for name in ("gamma", "e-", "opticalphoton")], dtype=np.int32)[
+            np.select([particle_types == "gamma", particle_types == "e-"], [0, 1], 2)],
+        "Position_X": position_x,
+        "Position_Y": position_y,
+        "Position_Z": position_z,
+        "TrackCreatorProcess": np.where(is_optical_photon, "Scintillation", "compt"),
+    }
+    direction = rng.normal(size=(number_of_rows, 3))
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    columns.update(Direction_X=direction[:, 0], Direction_Y=direction[:, 1], Direction_Z=direction[:, 2])
+
+    chunk = {}
+    for branch in branches:
+        if branch in columns:
+            chunk[branch] = columns[branch]
+        elif branch in INTEGER_BRANCHES:
+            chunk[branch] = rng.integers(0, 100, number_of_rows, dtype=np.int32)
+        else:
+            chunk[branch] = rng.exponential(1.0, number_of_rows)
+    return chunk
+
+
+# writes a phase space root file chunk by chunk, returns its number of rows
+def synthesize_phase_space(root_file_path, number_of_events, mean_photons=300, mean_electrons=2, seed=0,
+                           output_profile="full"):
+    branches = profile_branches(output_profile)
+    with RootTreeWriter(root_file_path, "Phase") as writer:
+        for chunk_index, first_event in enumerate(range(0, number_of_events, EVENTS_PER_CHUNK)):
+            chunk_events = min(EVENTS_PER_CHUNK, number_of_events - first_event)
+            writer.write(synthesize_phase_space_chunk(branches, chunk_events, first_event, mean_photons, mean_electrons,
+                                                      seed + 2 * chunk_index))
+    return writer.number_of_entries
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(folder) for file in files)
+
+
+# the stages, each returns the number of items processed, their unit and the bytes written
+
+def stage_read(phase_space_path, work_folder, options):
+    import uproot
+    from optigan_segmentation import PARTICLE_TYPE_BRANCHES
+    with uproot.open(phase_space_path) as root_file:
+        tree = root_file["Phase"]
+        particle_type_branch = next(branch for branch in PARTICLE_TYPE_BRANCHES if branch in tree.keys())
+        arrays = tree.arrays([particle_type_branch, "Position_X", "Position_Y", "Position_Z"], library="np")
+    return len(arrays["Position_X"]), "rows", 0
+
+
+def read_event_table(phase_space_path):
+    import uproot
+    from optigan_segmentation import PARTICLE_TYPE_BRANCHES, segment_events
+    with uproot.open(phase_space_path) as root_file:
+        tree = root_file["Phase"]
+        particle_type_branch = next(branch for branch in PARTICLE_TYPE_BRANCHES if branch in tree.keys())
+        arrays = tree.arrays([particle_type_branch, "Position_X", "Position_Y", "Position_Z"], library="np")
+    return segment_events(arrays[particle_type_branch], arrays["Position_X"], arrays["Position_Y"], arrays["Position_Z"])
+
+
+def stage_segmentation(phase_space_path, work_folder, options):
+    import uproot
+    with uproot.open(phase_space_path) as root_file:
+        number_of_rows = root_file["Phase"].num_entries
+    read_event_table(phase_space_path)
+    return number_of_rows, "rows", 0
+
+
+def stage_segmentation_streaming(phase_space_path, work_folder, options):
+    from optigan_segmentation import PARTICLE_TYPE_BRANCHES, StreamingEventSegmenter
+    from root_streaming import iterate_tree_chunks
+    import uproot
+    with uproot.open(phase_space_path) as root_file:
+        tree = root_file["Phase"]
+        particle_type_branch = next(branch for branch in PARTICLE_TYPE_BRANCHES if branch in tree.keys())
+        number_of_rows = tree.num_entries
+    segmenter = StreamingEventSegmenter()
+    for entry_start, arrays in iterate_tree_chunks(phase_space_path, "Phase",
+                                                   [particle_type_branch, "Position_X", "Position_Y", "Position_Z"],
+                                                   options["step_size"]):
+        segmenter.update(arrays[particle_type_branch], arrays["Position_X"], arrays["Position_Y"], arrays["Position_Z"], entry_start)
+    segmenter.finish()
+    return number_of_rows, "rows", 0
+
+
+# optigan inputs of the first csv_max_events events (the csv format writes one file per event)
+def stage_inputs_csv(phase_space_path, work_folder, options):
+    from optigan_storage import read_optigan_inputs_csv, write_optigan_inputs_csv
+    event_table = read_event_table(phase_space_path)
+    number_of_events = min(len(event_table["optical_photon_count"]), options["csv_max_events"])
+    folder = os.path.join(work_folder, "optigan_inputs_csv")
+    os.makedirs(folder, exist_ok=True)
+    start_time = time.perf_counter()
+    write_optigan_inputs_csv(folder, event_table["gamma_position"][:number_of_events], event_table["optical_photon_count"][:number_of_events])
+    read_optigan_inputs_csv(folder)
+    return number_of_events, "events", folder_size(folder), time.perf_counter() - start_time
+
+
+def stage_inputs_root(phase_space_path, work_folder, options):
+    from optigan_storage import read_optigan_inputs_root, write_optigan_inputs_root
+    event_table = read_event_table(phase_space_path)
+    file_path = os.path.join(work_folder, "optigan_inputs.root")
+    start_time = time.perf_counter()
+    write_optigan_inputs_root(file_path, event_table["gamma_position"], event_table["optical_photon_count"])
+    read_optigan_inputs_root(file_path)
+    return len(event_table["optical_photon_count"]), "events", os.path.getsize(file_path), time.perf_counter() - start_time
+
+
+# events of the phase space given to the generator, up to gan_max_photons photons
+def select_inference_events(event_table, max_photons):
+    counts = event_table["optical_photon_count"]
+    number_of_events = int(np.searchsorted(np.cumsum(counts), max_photons, side="right"))
+    return event_table["gamma_position"][:max(number_of_events, 1)], counts[:max(number_of_events, 1)]
+
+
+# generator with random weights (same architecture and cost as the trained one)
+def create_benchmark_generator(options):
+    import torch
+    from optigan_inference import OptiganExecutionProfile
+    from optigan_models import find_optigan_model
+    torch.manual_seed(0)
+    optigan_model = find_optigan_model()
+    profile = OptiganExecutionProfile(options["threads"], 0, options["batch_rows"], options["precision"])
+    return optigan_model, profile, profile.prepare_generator(optigan_model.create_generator().eval())
+
+
+def generate_photons(phase_space_path, options):
+    from optigan_inference import create_random_generator, generate_optigan_batches
+    optigan_model, profile, generator = create_benchmark_generator(options)
+    gamma_positions, optical_photon_counts = select_inference_events(read_event_table(phase_space_path), options["gan_max_photons"])
+    start_time = time.perf_counter()
+    batches = list(generate_optigan_batches(generator, gamma_positions, optical_photon_counts, optigan_model.noise_dimension,
+                                            profile.max_batch_rows, create_random_generator(profile.seed), profile.number_of_threads))
+    return optigan_model, batches, time.perf_counter() - start_time
+
+
+def stage_inference(phase_space_path, work_folder, options):
+    _, batches, seconds = generate_photons(phase_space_path, options)
+    return sum(len(batch["photons"]) for batch in batches), "photons", 0, seconds
+
+
+def write_generated_photons(phase_space_path, options, output_writer_factory):
+    optigan_model, batches, _ = generate_photons(phase_space_path, options)
+    start_time = time.perf_counter()
+    with output_writer_factory(optigan_model.output_columns) as output_writer:
+        for batch in batches:
+            output_writer.write_batch(batch["first_event"], batch["offsets"], batch["photons"])
+    return sum(len(batch["photons"]) for batch in batches), time.perf_counter() - start_time
+
+
+def stage_outputs_csv(phase_space_path, work_folder, options):
+    from optigan_storage import OptiganCsvOutputWriter
+    folder = os.path.join(work_folder, "optigan_outputs_csv")
+    number_of_photons, seconds = write_generated_photons(phase_space_path, options, lambda columns: OptiganCsvOutputWriter(folder, columns))
+    return number_of_photons, "photons", folder_size(folder), seconds
+
+
+def stage_outputs_root(phase_space_path, work_folder, options):
+    from optigan_storage import OptiganOutputWriter
+    file_path = os.path.join(work_folder, "optigan_outputs.root")
+    number_of_photons, seconds = write_generated_photons(phase_space_path, options, lambda columns: OptiganOutputWriter(file_path, columns))
+    return number_of_photons, "photons", os.path.getsize(file_path), seconds
+
+
+# the default filters whose branches are in the phase space (all of them but with the optigan profile)
+def stage_filtering(phase_space_path, work_folder, options):
+    import uproot
+    from root_filter_engine import DEFAULT_FILTERS, RootFilterEngine
+    with uproot.open(phase_space_path) as root_file:
+        tree_branches = root_file["Phase"].keys()
+    filters = [root_filter for root_filter in DEFAULT_FILTERS if all(branch in tree_branches for branch in root_filter.branches)]
+    output_paths = {root_filter.name: os.path.join(work_folder, f"{root_filter.name}.root") for root_filter in filters}
+    number_of_rows, _ = RootFilterEngine(filters, step_size=options["step_size"]).run(phase_space_path, output_paths)
+    return number_of_rows, "rows", sum(os.path.getsize(path) for path in output_paths.values())
+
+
+def stage_histograms(phase_space_path, work_folder, options):
+    from root_histograms import fill_histograms_with_shared_edges, save_histograms
+    histograms = fill_histograms_with_shared_edges([phase_space_path], "Phase", step_size=options["step_size"])
+    histograms_file_path = os.path.join(work_folder, "histograms.npz")
+    save_histograms(histograms_file_path, histograms[phase_space_path])
+    import uproot
+    with uproot.open(phase_space_path) as root_file:
+        number_of_rows = root_file["Phase"].num_entries
+    return number_of_rows, "rows", os.path.getsize(histograms_file_path)
+
+
+STAGE_FUNCTIONS = {stage: globals()[f"stage_{stage}"] for stage in STAGES}
+
+
+# runs a stage in the current (fresh) process. the time is the whole stage,
+# or only the part the stage measures itself (e.g. the csv writes without the
+# segmentation that prepares them)
+def run_stage(stage, phase_space_path, work_folder, options):
+    start_time = time.perf_counter()
+    result = STAGE_FUNCTIONS[stage](phase_space_path, work_folder, options)
+    seconds = time.perf_counter() - start_time
+    number_of_items, unit, bytes_written = result[:3]
+    if len(result) > 3:
+        seconds = result[3]
+    return {
+        "seconds": seconds,
+        "items": int(number_of_items),
+        "unit": unit,
+        "throughput": number_of_items / seconds if seconds > 0 else None,
+        "bytes_written": int(bytes_written),
+        # the whole process, so also the preparation of the stage
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def get_environment():
+    import pandas
+    import torch
+    import uproot
+    try:
+        git_commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        git_commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": {"numpy": np.__version__, "pandas": pandas.__version__, "uproot": uproot.__version__, "torch": torch.__version__},
+        "git_commit": git_commit,
+    }
+
+
+# runs the stages on a synthetic phase space of every size, each stage in a new process
+def run_benchmark(event_counts, stages, options, work_folder):
+    sizes = []
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, max_tasks_per_child=1) as executor:
+        for number_of_events in event_counts:
+            size_folder = os.path.join(work_folder, f"events_{number_of_events}")
+            os.makedirs(size_folder, exist_ok=True)
+            phase_space_path = os.path.join(size_folder, "phase_space.root")
+            start_time = time.perf_counter()
+            number_of_rows = synthesize_phase_space(phase_space_path, number_of_events, options["photons"], options["electrons"],
+                                                    options["seed"], options["output_profile"])
+            print(f"{number_of_events} events, {number_of_rows} rows synthesized in {time.perf_counter() - start_time:.1f} s")
+
+            size = {
+                "events": number_of_events,
+                "rows": number_of_rows,
+                "phase_space_bytes": os.path.getsize(phase_space_path),
+                "stages": {},
+            }
+            for stage in stages:
+                result = executor.submit(run_stage, stage, phase_space_path, size_folder, options).result()
+                size["stages"][stage] = result
+                print(f"    {stage:24s} {result['seconds']:8.3f} s {result['throughput'] or 0:14.0f} {result['unit']}/s "
+                      f"{result['peak_rss_mb']:8.0f} MB")
+            sizes.append(size)
+    return sizes
+
+
+# prints the throughput of this run relative to a previous one (same sizes and stages)
+def print_comparison(report, previous_report):
+    previous_sizes = {size["events"]: size for size in previous_report["sizes"]}
+    print(f"Compared with {previous_report.get('created')} ({previous_report['environment'].get('git_commit')})")
+    for size in report["sizes"]:
+        previous_size = previous_sizes.get(size["events"])
+        if previous_size is None:
+            continue
+        print(f"{size['events']} events")
+        for stage, result in size["stages"].items():
+            previous_result = previous_size["stages"].get(stage)
+            if previous_result is None or not previous_result["throughput"] or not result["throughput"]:
+                continue
+            print(f"    {stage:24s} x{result['throughput'] / previous_result['throughput']:.2f} throughput, "
+                  f"{result['peak_rss_mb'] - previous_result['peak_rss_mb']:+.0f} MB peak memory")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the dataset comparison pipeline on synthetic phase spaces")
+    parser.add_argument("--events", type=int, nargs="+", default=[1000, 10000], help="sizes, in number of events (default: %(default)s)")
+    parser.add_argument("--photons", type=float, default=300, help="mean number of optical photons per event (default: %(default)s)")
+    parser.add_argument("--electrons", type=float, default=2, help="mean number of electrons per event (default: %(default)s)")
+    parser.add_argument("--profile", choices=list(PHASE_SPACE_OUTPUT_PROFILES), default="full",
+                        help="phase space output profile of the synthetic files (default: %(default)s)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="stages to run (default: all)")
+    parser.add_argument("--step-size", default="100 MB", help="uproot step size of the streamed stages (default: %(default)s)")
+    parser.add_argument("--csv-max-events", type=int, default=1000, help="events written by the csv inputs stage (default: %(default)s)")
+    parser.add_argument("--gan-max-photons", type=int, default=1000000, help="photons generated by the inference and outputs stages (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads (default: torch default)")
+    parser.add_argument("--batch-rows", type=int, default=65536, help="photons per forward pass (default: %(default)s)")
+    parser.add_argument("--precision", default="float32", help="generator precision (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-folder", default=None, help="folder of the synthetic files (default: a temporary folder)")
+    parser.add_argument("--output", default=None, help="json file of the results")
+    parser.add_argument("--compare", default=None, help="json file of a previous run to compare with")
+    args = parser.parse_args()
+
+    from root_streaming import parse_step_size
+
+    options = {
+        "photons": args.photons,
+        "electrons": args.electrons,
+        "output_profile": args.profile,
+        "step_size": parse_step_size(args.step_size),
+        "csv_max_events": args.csv_max_events,
+        "gan_max_photons": args.gan_max_photons,
+        "threads": args.threads,
+        "batch_rows": args.batch_rows,
+        "precision": args.precision,
+        "seed": args.seed,
+    }
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        sizes = run_benchmark(args.events, args.stages, options, args.work_folder or temporary_folder)
+
+    report = {
+        "benchmark": "pipeline",
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "environment": get_environment(),
+        "options": options,
+        "sizes": sizes,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Results written in {args.output}")
+    if args.compare is not None:
+        with open(args.compare) as previous_file:
+            print_comparison(report, json.load(previous_file))
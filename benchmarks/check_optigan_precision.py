@@ -0,0 +1,80 @@
+# Checks that the reduced precision execution profiles of the optigan generator
+# (bfloat16, dynamic int8 Linear layers) keep the distributions of the generated
+# photons, and compares their throughput with the float32 generator.
+#
+# usage: python benchmarks/check_optigan_precision.py --model-folder <optigan_models folder> --tolerance 0.01
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optigan_inference import PRECISIONS, OptiganExecutionProfile, generate_optigan_batches, create_random_generator, check_profile_distributions
+from optigan_models import find_optigan_model, get_optigan_generator
+
+
+# gamma positions in the crystal and poisson distributed photon counts
+def synthesize_inputs(number_of_events, mean_photons, crystal_size_mm, seed):
+    rng = np.random.default_rng(seed)
+    gamma_positions = np.stack([
+        rng.uniform(-crystal_size_mm[0] / 2, crystal_size_mm[0] / 2, number_of_events),
+        rng.uniform(-crystal_size_mm[1] / 2, crystal_size_mm[1] / 2, number_of_events),
+        rng.uniform(0, crystal_size_mm[2], number_of_events),
+    ], axis=1)
+    return gamma_positions, rng.poisson(mean_photons, number_of_events)
+
+
+def photons_per_second(generator, profile, gamma_positions, optical_photon_counts, noise_dimension):
+    start_time = time.perf_counter()
+    number_of_photons = sum(len(batch['photons']) for batch in generate_optigan_batches(
+        generator, gamma_positions, optical_photon_counts, noise_dimension, profile.max_batch_rows,
+        create_random_generator(profile.seed), profile.number_of_threads))
+    return number_of_photons / (time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distribution check and throughput of the optigan precisions")
+    parser.add_argument("--model-folder", default=None, help="folder with the optigan checkpoints")
+    parser.add_argument("--model", default=None, help="name of the model (default: the default model)")
+    parser.add_argument("--random-weights", action="store_true", help="untrained generator, to test without checkpoint")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--photons", type=float, default=300, help="mean number of optical photons per event")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--batch-rows", type=int, default=65536)
+    parser.add_argument("--tolerance", type=float, default=0.01, help="maximum binned KS distance per column")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    optigan_model = find_optigan_model(args.model)
+    if args.random_weights:
+        generator = optigan_model.create_generator().eval()
+    else:
+        if args.model_folder is None:
+            parser.error("--model-folder is needed, or --random-weights")
+        generator = get_optigan_generator(optigan_model, args.model_folder)
+    gamma_positions, optical_photon_counts = synthesize_inputs(args.events, args.photons, optigan_model.crystal_size_mm, args.seed)
+    print(f"{int(optical_photon_counts.sum())} photons for {args.events} events")
+
+    all_within_tolerance = True
+    reference_profile = OptiganExecutionProfile(args.threads, args.seed, args.batch_rows)
+    reference_throughput = photons_per_second(generator, reference_profile, gamma_positions, optical_photon_counts,
+                                              optigan_model.noise_dimension)
+    print(f"float32: {reference_throughput:.0f} photons per second")
+    for precision in PRECISIONS[1:]:
+        profile = OptiganExecutionProfile(args.threads, args.seed, args.batch_rows, precision)
+        throughput = photons_per_second(profile.prepare_generator(generator), profile, gamma_positions,
+                                        optical_photon_counts, optigan_model.noise_dimension)
+        columns, within_tolerance = check_profile_distributions(generator, profile, gamma_positions, optical_photon_counts,
+                                                                optigan_model.noise_dimension, optigan_model.output_columns,
+                                                                args.tolerance, seed=args.seed)
+        all_within_tolerance &= within_tolerance
+        print(f"{precision}: {throughput:.0f} photons per second (x{throughput / reference_throughput:.2f}), "
+              f"{'within' if within_tolerance else 'NOT within'} tolerance {args.tolerance}")
+        for column, statistics in columns.items():
+            print(f"    {column}: ks {statistics['ks']:.4f}, wasserstein {statistics['wasserstein']:.4g}, "
+                  f"max abs difference {statistics['max_abs_difference']:.4g}")
+    sys.exit(0 if all_within_tolerance else 1)
@@ -0,0 +1,296 @@
+import argparse
+import json
+import os
+import re
+import time
+
+import numpy as np
+import uproot
+
+from filter_cache import cache_key, file_identity
+from root_streaming import DEFAULT_STEP_SIZE, parse_step_size
+
+# bumped when the cached files change, the older ones are not used anymore
+BRANCH_CACHE_VERSION = 1
+
+# tree name, number of entries and branches of a cached tree
+TREE_MANIFEST_FILE_NAME = "tree.json"
+
+# "100 MB", "1.5 GiB", ... step sizes given as a memory size
+MEMORY_SIZE_PATTERN = re.compile(r"^\s*([0-9.]+)\s*([kKMGT]?i?B)?\s*$")
+MEMORY_UNITS = {None: 1, "B": 1, "kB": 1000, "KB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3, "TB": 1000 ** 4,
+                "KiB": 1024, "kiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4}
+
+
+# number of entries of a step size (see root_streaming.DEFAULT_STEP_SIZE),
+# a memory size is divided by the bytes of one entry of the branches read
+def step_size_entries(step_size, bytes_per_entry):
+    if isinstance(step_size, int):
+        return max(1, step_size)
+    match = MEMORY_SIZE_PATTERN.match(str(step_size))
+    if match is None:
+        raise ValueError(f"Invalid step size '{step_size}', give a number of entries or a memory size like '100 MB'")
+    return max(1, int(float(match.group(1)) * MEMORY_UNITS[match.group(2)] // max(1, bytes_per_entry)))
+
+
+# slice of a cached tree read by CachedTree.iterate, with the entry range
+# of the chunk like the report of uproot.iterate
+class CachedChunkReport:
+
+    def __init__(self, tree_entry_start, tree_entry_stop):
+        self.tree_entry_start = tree_entry_start
+        self.tree_entry_stop = tree_entry_stop
+
+
+# decoded branches of the trees of root files, written once as flat .npy files and
+# read back as memory-mapped arrays: a second read of a branch is a page cache read
+# instead of the decompression and deserialization of its baskets. the files of a
+# tree are in cache_folder/<key>, the key is the identity of the root file (size and
+# modification time, or sha256 with use_hash) and the tree name, so a changed root
+# file gets a new folder. string branches (ParticleName) are stored as int32 codes
+# (<branch>.npy) and the distinct strings (<branch>.categories.npy).
+class BranchCache:
+
+    def __init__(self, cache_folder, use_hash=False, step_size=DEFAULT_STEP_SIZE):
+        self.cache_folder = cache_folder
+        self.use_hash = use_hash
+        # amount read at once when a branch is decoded
+        self.step_size = step_size
+
+    def get_tree_folder(self, root_file_path, tree_name):
+        key = cache_key(BRANCH_CACHE_VERSION, file_identity(root_file_path, self.use_hash), tree_name)
+        return os.path.join(self.cache_folder, key[:16])
+
+    # same use as uproot.open, the trees are CachedTree
+    def open(self, root_file_path):
+        return CachedRootFile(self, root_file_path)
+
+    def open_tree(self, root_file_path, tree_name):
+        return CachedTree(self, root_file_path, tree_name)
+
+
+# a root file opened through a BranchCache, root_file["Phase"] is a CachedTree
+class CachedRootFile:
+
+    def __init__(self, branch_cache, root_file_path):
+        self.branch_cache = branch_cache
+        self.root_file_path = root_file_path
+
+    def __getitem__(self, tree_name):
+        return self.branch_cache.open_tree(self.root_file_path, tree_name)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# a branch of a CachedTree, tree["Position_X"].array(library="np") like uproot
+class CachedBranch:
+
+    def __init__(self, tree, name):
+        self.tree = tree
+        self.name = name
+
+    def array(self, library="np", entry_start=None, entry_stop=None):
+        return self.tree.arrays([self.name], entry_start, entry_stop, library)[self.name]
+
+
+# the subset of the uproot TTree interface used by the pipeline (keys, num_entries,
+# branch.array, arrays, iterate) served from the cached .npy files. the branches
+# not decoded yet are read from the root file once, all at the same time.
+# numeric branches are returned as read-only memory-mapped views (no copy),
+# string branches as fixed width unicode arrays rebuilt from their codes.
+class CachedTree:
+
+    def __init__(self, branch_cache, root_file_path, tree_name):
+        self.branch_cache = branch_cache
+        self.root_file_path = root_file_path
+        self.tree_name = tree_name
+        self.tree_folder = branch_cache.get_tree_folder(root_file_path, tree_name)
+        self.manifest = self.load_manifest()
+        self.branch_arrays = {}
+
+    @property
+    def num_entries(self):
+        return self.manifest["num_entries"]
+
+    def keys(self):
+        return list(self.manifest["branches"])
+
+    def __getitem__(self, branch):
+        if branch not in self.manifest["branches"]:
+            raise KeyError(f"No branch '{branch}' in the tree {self.tree_name} of {self.root_file_path}")
+        return CachedBranch(self, branch)
+
+    # the tree manifest is written when the tree is seen for the first time
+    def load_manifest(self):
+        manifest_file_path = os.path.join(self.tree_folder, TREE_MANIFEST_FILE_NAME)
+        if os.path.exists(manifest_file_path):
+            with open(manifest_file_path) as manifest_file:
+                return json.load(manifest_file)
+        with uproot.open(self.root_file_path) as root_file:
+            tree = root_file[self.tree_name]
+            manifest = {"root_file_path": os.path.abspath(self.root_file_path), "tree_name": self.tree_name,
+                        "num_entries": tree.num_entries, "branches": list(tree.keys())}
+        os.makedirs(self.tree_folder, exist_ok=True)
+        temporary_file_path = f"{manifest_file_path}.{os.getpid()}.tmp"
+        with open(temporary_file_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(temporary_file_path, manifest_file_path)
+        return manifest
+
+    def get_branch_file_path(self, branch):
+        return os.path.join(self.tree_folder, f"{branch}.npy")
+
+    def get_categories_file_path(self, branch):
+        return os.path.join(self.tree_folder, f"{branch}.categories.npy")
+
+    def is_decoded(self, branch):
+        return os.path.exists(self.get_branch_file_path(branch))
+
+    # reads the branches from the root file chunk by chunk into their .npy files.
+    # every file is written under a temporary name and renamed when complete (the
+    # categories before the codes), so another process never maps a partial file.
+    def decode_branches(self, branches):
+        temporary_suffix = f".{os.getpid()}.tmp.npy"
+        outputs = {}
+        categories = {}
+        try:
+            for arrays, report in uproot.iterate({self.root_file_path: self.tree_name}, branches,
+                                                 step_size=self.branch_cache.step_size, library="np", report=True):
+                for branch in branches:
+                    values = arrays[branch]
+                    if values.dtype == object and len(values) > 0 and not isinstance(values[0], str):
+                        raise ValueError(f"The branch {branch} of {self.root_file_path} is not flat, it can not be cached")
+                    if values.dtype == object or values.dtype.kind in "SU":
+                        if branch not in categories:
+                            categories[branch] = {}
+                        values = self.encode_strings(values, categories[branch])
+                    if branch not in outputs:
+                        outputs[branch] = np.lib.format.open_memmap(self.get_branch_file_path(branch) + temporary_suffix, mode="w+",
+                                                                    dtype=values.dtype, shape=(self.num_entries,))
+                    outputs[branch][report.tree_entry_start:report.tree_entry_stop] = values
+            for branch in branches:
+                if branch not in outputs:
+                    # empty tree, the type of the branch is read from uproot
+                    with uproot.open(self.root_file_path) as root_file:
+                        values = root_file[self.tree_name][branch].array(library="np")
+                    if values.dtype == object:
+                        categories[branch] = {}
+                        values = values.astype(np.int32)
+                    outputs[branch] = np.lib.format.open_memmap(self.get_branch_file_path(branch) + temporary_suffix, mode="w+",
+                                                                dtype=values.dtype, shape=(0,))
+                outputs[branch].flush()
+                if branch in categories:
+                    np.save(self.get_categories_file_path(branch) + temporary_suffix, np.array(list(categories[branch]), dtype=str))
+                    os.replace(self.get_categories_file_path(branch) + temporary_suffix, self.get_categories_file_path(branch))
+                os.replace(self.get_branch_file_path(branch) + temporary_suffix, self.get_branch_file_path(branch))
+        finally:
+            outputs.clear()
+            for file_name in os.listdir(self.tree_folder):
+                if file_name.endswith(temporary_suffix):
+                    os.remove(os.path.join(self.tree_folder, file_name))
+
+    # dictionary encoding of a chunk of strings: the codes of the strings already
+    # seen are kept, the new ones get the next codes. the strings are compared once
+    # per distinct value of the chunk, not once per row. pd.factorize hashes the
+    # python strings like optigan_segmentation.particle_codes, np.unique would sort
+    # and copy them to fixed width unicode.
+    @staticmethod
+    def encode_strings(values, categories):
+        import pandas as pd
+        inverse, distinct_values = pd.factorize(np.asarray(values, dtype=object))
+        for value in distinct_values:
+            categories.setdefault(str(value), len(categories))
+        codes = np.array([categories[str(value)] for value in distinct_values], dtype=np.int32)
+        return codes[inverse]
+
+    # memory-mapped codes (and the categories of a string branch) of a decoded branch
+    def load_branch(self, branch):
+        if branch not in self.branch_arrays:
+            self.decode_missing_branches([branch])
+            values = np.load(self.get_branch_file_path(branch), mmap_mode="r")
+            categories = None
+            if os.path.exists(self.get_categories_file_path(branch)):
+                categories = np.load(self.get_categories_file_path(branch))
+            self.branch_arrays[branch] = (values, categories)
+        return self.branch_arrays[branch]
+
+    # decoded values of a branch for entries [entry_start, entry_stop), dictionary
+    # encoded branches give their codes and their categories with categories_of
+    def read_branch(self, branch, entry_start=None, entry_stop=None, decode_strings=True):
+        values, categories = self.load_branch(branch)
+        values = values[entry_start:entry_stop]
+        if categories is not None and decode_strings:
+            return categories[values]
+        return values
+
+    def categories_of(self, branch):
+        return self.load_branch(branch)[1]
+
+    # decodes the branches that are not in the cache yet, in one pass over the root file
+    def decode_missing_branches(self, branches):
+        unknown_branches = [branch for branch in branches if branch not in self.manifest["branches"]]
+        if unknown_branches:
+            raise KeyError(f"No branches {unknown_branches} in the tree {self.tree_name} of {self.root_file_path}")
+        branches_to_decode = [branch for branch in branches if not self.is_decoded(branch)]
+        if branches_to_decode:
+            self.decode_branches(branches_to_decode)
+
+    def arrays(self, branches=None, entry_start=None, entry_stop=None, library="np"):
+        if library != "np":
+            raise ValueError(f"The branch cache only gives numpy arrays, not library='{library}'")
+        branches = self.keys() if branches is None else list(branches)
+        self.decode_missing_branches(branches)
+        return {branch: self.read_branch(branch, entry_start, entry_stop) for branch in branches}
+
+    # entries of about memory_size (e.g. "100 MB") of the branches, like uproot's TTree.num_entries_for
+    def num_entries_for(self, memory_size, branches=None):
+        branches = self.keys() if branches is None else list(branches)
+        self.decode_missing_branches(branches)
+        return step_size_entries(memory_size, sum(self.load_branch(branch)[0].dtype.itemsize for branch in branches))
+
+    # chunks of about step_size (entries or memory size), like uproot's TTree.iterate
+    def iterate(self, branches=None, step_size=DEFAULT_STEP_SIZE, library="np", report=False):
+        if library != "np":
+            raise ValueError(f"The branch cache only gives numpy arrays, not library='{library}'")
+        branches = self.keys() if branches is None else list(branches)
+        entries_per_step = self.num_entries_for(step_size, branches)
+        for entry_start in range(0, self.num_entries, entries_per_step):
+            entry_stop = min(entry_start + entries_per_step, self.num_entries)
+            arrays = self.arrays(branches, entry_start, entry_stop, library)
+            yield (arrays, CachedChunkReport(entry_start, entry_stop)) if report else arrays
+
+
+# root file opened with uproot, or through the branch cache when one is given
+def open_root_file_with_cache(root_file_path, branch_cache=None):
+    if branch_cache is None:
+        return uproot.open(root_file_path)
+    return branch_cache.open(root_file_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decodes branches of root files once into the memory-mapped branch cache")
+    parser.add_argument("root_files", nargs="+", help="root files whose branches are cached")
+    parser.add_argument("--cache-folder", required=True, help="folder of the branch cache")
+    parser.add_argument("--tree", default="Phase", help="name of the tree (default: %(default)s)")
+    parser.add_argument("--branches", nargs="+", default=None, help="branches cached (default: all)")
+    parser.add_argument("--step-size", default=DEFAULT_STEP_SIZE,
+                        help="entries (e.g. 100000) or memory size (e.g. '100 MB') decoded at once (default: %(default)s)")
+    parser.add_argument("--hash", action="store_true", help="identify the root files by content hash instead of size and modification time")
+    args = parser.parse_args()
+
+    branch_cache = BranchCache(args.cache_folder, args.hash, parse_step_size(args.step_size))
+    for root_file_path in args.root_files:
+        start_time = time.perf_counter()
+        tree = branch_cache.open_tree(root_file_path, args.tree)
+        branches = args.branches or tree.keys()
+        tree.decode_missing_branches(branches)
+        cached_bytes = sum(os.path.getsize(os.path.join(tree.tree_folder, file_name)) for file_name in os.listdir(tree.tree_folder))
+        print(f"{root_file_path}: {len(branches)} branches of {tree.num_entries} entries in {tree.tree_folder} "
+              f"({cached_bytes / 1e6:.1f} MB) in {time.perf_counter() - start_time:.2f} s")
@@ -0,0 +1,310 @@
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from dataset_simulation import get_phase_space_output_path, make_simulation_config
+from phase_space_shards import merge_phase_space_files, shard_seeds, shard_time_intervals
+from root_streaming import DEFAULT_STEP_SIZE, parse_step_size
+
+# phase space chunks written by the simulation side, a chunk only gets its final
+# name once it is complete, so the optigan side never reads a partial file
+CHUNK_FILE_NAME = "phase_space_chunk{chunk_index:05d}.root"
+CHUNK_FILE_PATTERN = re.compile(r"^phase_space_chunk(\d{5})\.root$")
+PARTIAL_CHUNK_SUFFIX = ".partial.root"
+
+# written by the simulation side when it has no more chunk to give,
+# with the number of chunks and the ones that failed
+PRODUCER_DONE_FILE_NAME = "producer_done.json"
+
+# generated photons of a chunk, in the optigan output folder
+CHUNK_OUTPUT_FILE_NAME = "optigan_outputs_chunk{chunk_index:05d}.root"
+
+
+def chunk_file_name(chunk_index):
+    return CHUNK_FILE_NAME.format(chunk_index=chunk_index)
+
+
+# completed chunks of the folder, chunk index -> path
+def list_ready_chunks(chunk_folder):
+    ready_chunks = {}
+    for file_name in os.listdir(chunk_folder):
+        match = CHUNK_FILE_PATTERN.match(file_name)
+        if match is not None:
+            ready_chunks[int(match.group(1))] = os.path.join(chunk_folder, file_name)
+    return ready_chunks
+
+
+def read_producer_done(chunk_folder):
+    producer_done_path = os.path.join(chunk_folder, PRODUCER_DONE_FILE_NAME)
+    if not os.path.exists(producer_done_path):
+        return None
+    with open(producer_done_path) as producer_done_file:
+        return json.load(producer_done_file)
+
+
+# removes the chunks and the done marker of a previous run
+def clean_chunk_folder(chunk_folder):
+    os.makedirs(chunk_folder, exist_ok=True)
+    for file_name in os.listdir(chunk_folder):
+        if CHUNK_FILE_PATTERN.match(file_name) or file_name.endswith(PARTIAL_CHUNK_SUFFIX) or file_name == PRODUCER_DONE_FILE_NAME:
+            os.remove(os.path.join(chunk_folder, file_name))
+
+
+# config of every chunk: the run time is cut in number_of_chunks slices (like the
+# shards of 0_dataset_creation.py), each with its own seed, written under a
+# partial name in chunk_folder
+def get_chunk_configs(config, number_of_chunks, chunk_folder):
+    seeds = shard_seeds(number_of_chunks, config["seed"])
+    time_intervals = shard_time_intervals(number_of_chunks, config["start_time_s"], config["end_time_s"])
+    return [make_simulation_config(config, output_dir=chunk_folder, seed=seeds[chunk_index], start_time_s=start_time,
+                                   end_time_s=end_time, output_filename=chunk_file_name(chunk_index) + PARTIAL_CHUNK_SUFFIX)
+            for chunk_index, (start_time, end_time) in enumerate(time_intervals)]
+
+
+# runs the simulation of one chunk in a pool worker and gives the chunk its final
+# name (an atomic rename), returns the wall time in seconds
+def run_chunk_simulation(chunk_config, chunk_file_path):
+    from dataset_simulation import run_simulation
+
+    start_time = time.perf_counter()
+    run_simulation(chunk_config)
+    os.replace(get_phase_space_output_path(chunk_config), chunk_file_path)
+    return time.perf_counter() - start_time
+
+
+# simulation side: runs the chunks in order on a local process pool (one process
+# per chunk, Geant4 runs only one simulation per process) and writes the done
+# marker when every chunk ended, also when some failed. run_chunk(chunk_config,
+# chunk_file_path) runs one chunk, it must be a module level function.
+# stop_requested() is polled every poll_seconds, when it returns True the chunks not
+# started yet are cancelled (the running ones still end, a Geant4 run cannot be cut).
+# returns chunk index -> wall seconds of the completed chunks, raises if a chunk failed
+# or was cancelled.
+def produce_phase_space_chunks(chunk_configs, chunk_folder, jobs=1, run_chunk=run_chunk_simulation, stop_requested=None,
+                               poll_seconds=1.0):
+    chunk_seconds = {}
+    context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context, max_tasks_per_child=1) as executor:
+            futures = {executor.submit(run_chunk, chunk_config, os.path.join(chunk_folder, chunk_file_name(chunk_index))): chunk_index
+                       for chunk_index, chunk_config in enumerate(chunk_configs)}
+            pending_futures = set(futures)
+            while pending_futures:
+                done_futures, pending_futures = wait(pending_futures, timeout=poll_seconds, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    chunk_index = futures[future]
+                    if future.cancelled():
+                        continue
+                    try:
+                        chunk_seconds[chunk_index] = future.result()
+                        print(f"Chunk {chunk_index} simulated in {chunk_seconds[chunk_index]:.1f} s")
+                    except Exception as error:
+                        print(f"Chunk {chunk_index} failed: {error!r}")
+                if stop_requested is not None and stop_requested():
+                    cancelled_chunks = sorted(futures[future] for future in pending_futures if future.cancel())
+                    print(f"Stopping the simulation, chunks {cancelled_chunks} cancelled")
+                    stop_requested = None
+    finally:
+        # chunks that did not end (interrupted producer) count as failed, so the optigan side stops
+        failed_chunks = sorted(set(range(len(chunk_configs))) - set(chunk_seconds))
+        producer_done = {"number_of_chunks": len(chunk_configs), "failed_chunks": failed_chunks}
+        producer_done_path = os.path.join(chunk_folder, PRODUCER_DONE_FILE_NAME)
+        with open(producer_done_path + ".tmp", "w") as producer_done_file:
+            json.dump(producer_done, producer_done_file)
+        os.replace(producer_done_path + ".tmp", producer_done_path)
+    if failed_chunks:
+        raise RuntimeError(f"Chunks {failed_chunks} of the simulation failed")
+    return chunk_seconds
+
+
+# EventID of the gamma starting every event of a chunk (rows gamma_index of its
+# event table) and the largest EventID of the chunk, -1 when it is empty
+def read_chunk_event_ids(chunk_file_path, gamma_index, tree_name="Phase", event_id_branch="EventID"):
+    import uproot
+
+    with uproot.open(chunk_file_path) as root_file:
+        tree = root_file[tree_name]
+        if event_id_branch not in tree.keys():
+            raise KeyError(f"The chunk {chunk_file_path} has no {event_id_branch} branch to number its events")
+        event_ids = tree[event_id_branch].array(library="np")
+    last_event_id = int(event_ids.max()) if len(event_ids) > 0 else -1
+    return event_ids[gamma_index].astype(np.int64), last_event_id
+
+
+# optigan side: waits for the chunks in order and runs every chunk through the
+# event extraction (optigan_segmentation.segment_root_file) and the generator as
+# soon as it appears, the photons of a chunk are written in its own root file of
+# optigan_output_folder. the events are numbered like merge_phase_space_files
+# numbers the merged phase space: the EventID of the gamma of an event plus the
+# offset of its chunk (the largest EventID + 1 of the chunks before it), so the
+# photons can be joined with the merged phase space on EventID.
+# stops when the done marker is written and every completed chunk is processed.
+# returns the chunks processed and the stage metrics ("wait" is the time spent
+# waiting for the simulation).
+def consume_phase_space_chunks(chunk_folder, optigan_model_folder, optigan_output_folder, model_name=None,
+                               crystal_size_mm=None, use_torchscript=False, number_of_threads=None, seed=None,
+                               max_batch_rows=None, precision="float32", tree_name="Phase",
+                               step_size=DEFAULT_STEP_SIZE, poll_seconds=0.5):
+    from optigan_inference import DEFAULT_MAX_BATCH_ROWS, OptiganExecutionProfile, OptiganStageMetrics, create_random_generator, generate_optigan_batches
+    from optigan_models import OPTIGAN_OUTPUT_COLUMNS, find_optigan_model, get_optigan_generator
+    from optigan_segmentation import segment_root_file
+    from optigan_storage import OptiganOutputWriter
+
+    execution_profile = OptiganExecutionProfile(number_of_threads, seed, max_batch_rows or DEFAULT_MAX_BATCH_ROWS, precision)
+    metrics = OptiganStageMetrics()
+    os.makedirs(optigan_output_folder, exist_ok=True)
+
+    with metrics.timed("load"):
+        optigan_model = find_optigan_model(model_name, crystal_size_mm)
+        generator = execution_profile.prepare_generator(
+            get_optigan_generator(optigan_model, optigan_model_folder, use_torchscript=use_torchscript))
+    random_generator = create_random_generator(seed)
+
+    chunks = []
+    first_event = 0
+    event_id_offset = 0
+    chunk_index = 0
+    while True:
+        # the next chunk, the done marker is read before the folder so a chunk
+        # completed just before the marker is not missed
+        with metrics.timed("wait"):
+            while True:
+                producer_done = read_producer_done(chunk_folder)
+                chunk_file_path = list_ready_chunks(chunk_folder).get(chunk_index)
+                if chunk_file_path is not None or producer_done is not None:
+                    break
+                time.sleep(poll_seconds)
+        if chunk_file_path is None:
+            if chunk_index >= producer_done["number_of_chunks"]:
+                break
+            if chunk_index in producer_done["failed_chunks"]:
+                print(f"Skipping chunk {chunk_index}, its simulation failed")
+                chunk_index += 1
+                continue
+            raise RuntimeError(f"Chunk {chunk_index} is missing in {chunk_folder}")
+
+        start_time = time.perf_counter()
+        with metrics.timed("segment"):
+            event_table, number_of_rows = segment_root_file(chunk_file_path, tree_name, step_size)
+            event_ids, last_event_id = read_chunk_event_ids(chunk_file_path, event_table['gamma_index'], tree_name)
+            event_ids += event_id_offset
+        number_of_events = len(event_table['optical_photon_count'])
+        metrics.count("rows_read", number_of_rows)
+        metrics.count("events_found", number_of_events)
+
+        optigan_outputs_file_path = os.path.join(optigan_output_folder, CHUNK_OUTPUT_FILE_NAME.format(chunk_index=chunk_index))
+        with OptiganOutputWriter(optigan_outputs_file_path, OPTIGAN_OUTPUT_COLUMNS) as output_writer:
+            batches = generate_optigan_batches(generator, event_table['gamma_position'], event_table['optical_photon_count'],
+                                               optigan_model.noise_dimension, execution_profile.max_batch_rows,
+                                               random_generator, execution_profile.number_of_threads)
+            for batch in metrics.timed_batches(batches):
+                with metrics.timed("write"):
+                    batch_event_ids = event_ids[batch['first_event']:batch['first_event'] + len(batch['offsets']) - 1]
+                    output_writer.write_batch(first_event + batch['first_event'], batch['offsets'], batch['photons'], batch_event_ids)
+        metrics.record_written(optigan_outputs_file_path)
+
+        chunks.append({
+            "chunk_index": chunk_index,
+            "phase_space_path": chunk_file_path,
+            "optigan_outputs_path": optigan_outputs_file_path,
+            "first_event": first_event,
+            "event_id_offset": event_id_offset,
+            "number_of_events": number_of_events,
+            "number_of_photons": output_writer.number_of_photons,
+            "seconds": time.perf_counter() - start_time,
+        })
+        print(f"Chunk {chunk_index}: {number_of_events} events, {output_writer.number_of_photons} photons "
+              f"in {chunks[-1]['seconds']:.2f} s")
+        first_event += number_of_events
+        event_id_offset += last_event_id + 1
+        chunk_index += 1
+
+    return {"chunks": chunks, "metrics": metrics.report(), "execution_profile": execution_profile.description()}
+
+
+# runs the simulation and the optigan stage at the same time: the simulation is cut
+# in time slice chunks written one by one in chunk_folder, an optigan worker process
+# consumes them as they appear. the total wall time approaches the longest of the two
+# sides instead of their sum. consumer_options are given to consume_phase_space_chunks.
+# with merged_root_file_path the chunks are merged in one phase space at the end.
+# without a model name or crystal size the model is picked for the simulated crystal.
+def run_concurrent_optigan(config, number_of_chunks, chunk_folder, optigan_model_folder, optigan_output_folder, jobs=1,
+                           merged_root_file_path=None, keep_chunks=True, run_chunk=run_chunk_simulation, **consumer_options):
+    if consumer_options.get("model_name") is None and consumer_options.get("crystal_size_mm") is None:
+        consumer_options["crystal_size_mm"] = config["crystal_size_mm"]
+    clean_chunk_folder(chunk_folder)
+    chunk_configs = get_chunk_configs(config, number_of_chunks, chunk_folder)
+
+    start_time = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as consumer_executor:
+        consumer_future = consumer_executor.submit(consume_phase_space_chunks, chunk_folder, optigan_model_folder,
+                                                   optigan_output_folder, **consumer_options)
+        # the consumer only returns once the done marker is written, if it ends while
+        # the chunks are simulated it failed: the next chunks are cancelled and its
+        # error is raised instead of the one of the cancelled chunks
+        try:
+            chunk_seconds = produce_phase_space_chunks(chunk_configs, chunk_folder, jobs, run_chunk, stop_requested=consumer_future.done)
+        except RuntimeError:
+            if consumer_future.done():
+                consumer_future.result()
+            raise
+        simulation_seconds = time.perf_counter() - start_time
+        consumer_result = consumer_future.result()
+    wall_seconds = time.perf_counter() - start_time
+
+    consumer_seconds = consumer_result["metrics"]["seconds"]
+    optigan_seconds = sum(seconds for stage, seconds in consumer_seconds.items() if stage != "wait")
+    chunk_file_paths = [chunk["phase_space_path"] for chunk in consumer_result["chunks"]]
+    if merged_root_file_path is not None:
+        number_of_entries = merge_phase_space_files(chunk_file_paths, merged_root_file_path, consumer_options.get("tree_name", "Phase"))
+        print(f"{len(chunk_file_paths)} chunks merged in {merged_root_file_path} ({number_of_entries} entries)")
+        if not keep_chunks:
+            for chunk_file_path in chunk_file_paths:
+                os.remove(chunk_file_path)
+
+    report = {
+        "number_of_chunks": number_of_chunks,
+        "simulation_seconds": simulation_seconds,
+        "chunk_simulation_seconds": [chunk_seconds[chunk_index] for chunk_index in sorted(chunk_seconds)],
+        "optigan_seconds": optigan_seconds,
+        "optigan_wait_seconds": consumer_seconds.get("wait", 0.0),
+        "wall_seconds": wall_seconds,
+        "sequential_seconds": simulation_seconds + optigan_seconds,
+        **consumer_result,
+    }
+    print(f"Simulation {simulation_seconds:.1f} s, optigan {optigan_seconds:.1f} s, wall {wall_seconds:.1f} s "
+          f"(sequential {report['sequential_seconds']:.1f} s)")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optigan stage consuming the phase space chunks of a running simulation")
+    parser.add_argument("chunk_folder", help="folder where the simulation writes its chunks (see run_concurrent_optigan)")
+    parser.add_argument("--model-folder", required=True, help="folder of the optigan model files")
+    parser.add_argument("--output-folder", required=True, help="folder of the generated photons, one root file per chunk")
+    parser.add_argument("--model", default=None, help="optigan model name (default: the one of --crystal-size, or model_3341)")
+    parser.add_argument("--crystal-size", type=float, nargs=3, default=None, help="crystal size in mm (x y z) selecting the model")
+    parser.add_argument("--torchscript", action="store_true", help="runs the frozen TorchScript export of the generator")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads (default: torch's)")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the generator noise")
+    parser.add_argument("--step-size", default=DEFAULT_STEP_SIZE,
+                        help="entries (e.g. 100000) or memory size (e.g. '100 MB') read at once (default: %(default)s)")
+    parser.add_argument("--poll-seconds", type=float, default=0.5, help="time between two looks for a new chunk (default: %(default)s)")
+    parser.add_argument("--report", default=None, help="json file of the chunks processed and of the stage metrics")
+    args = parser.parse_args()
+
+    result = consume_phase_space_chunks(args.chunk_folder, args.model_folder, args.output_folder, args.model, args.crystal_size,
+                                        args.torchscript, args.threads, args.seed, step_size=parse_step_size(args.step_size),
+                                        poll_seconds=args.poll_seconds)
+    print(f"{len(result['chunks'])} chunks processed")
+    if args.report is not None:
+        with open(args.report, "w") as report_file:
+            json.dump(result, report_file, indent=2)
+        print(f"Report written in {args.report}")
@@ -0,0 +1,277 @@
+import argparse
+import itertools
+import json
+import os
+
+import numpy as np
+import uproot
+
+from root_histograms import (DEFAULT_NUMBER_OF_BINS, HistogramAccumulator, compute_branch_ranges, make_bin_edges,
+                             save_histograms)
+from root_streaming import DEFAULT_STEP_SIZE, parse_step_size
+
+# quantities compared between the datasets and the name of their branch in each
+# simulation: Gate 10 phase space (Position_X, ...), Gate 9 phase space (X, ...)
+# and OptiGAN outputs (X, Y, dX, dY, dZ, Ekine). the first branch found in a tree is used.
+BRANCH_ALIASES = {
+    "X": ["Position_X", "X"],
+    "Y": ["Position_Y", "Y"],
+    "Z": ["Position_Z", "Z"],
+    "dX": ["Direction_X", "dX"],
+    "dY": ["Direction_Y", "dY"],
+    "dZ": ["Direction_Z", "dZ"],
+    "Ekine": ["KineticEnergy", "Ekine"],
+}
+
+
+# a tree to compare, e.g. ComparisonDataset("gate9", "gate9.root", "MyActorPixel_In")
+class ComparisonDataset:
+
+    def __init__(self, label, root_file_path, tree_name):
+        self.label = label
+        self.root_file_path = root_file_path
+        self.tree_name = tree_name
+        self.number_of_entries = None
+        # quantity -> branch of this tree
+        self.branches = {}
+
+    # finds the branch of each quantity in the tree, the quantities without branch are skipped
+    def resolve_branches(self, quantities, branch_aliases=BRANCH_ALIASES):
+        with uproot.open(self.root_file_path) as root_file:
+            tree = root_file[self.tree_name]
+            tree_branches = set(tree.keys())
+            self.number_of_entries = tree.num_entries
+        self.branches = {}
+        for quantity in quantities:
+            for branch in branch_aliases.get(quantity, [quantity]):
+                if branch in tree_branches:
+                    self.branches[quantity] = branch
+                    break
+        return self.branches
+
+    # yields the chunks of the tree as quantity -> values
+    def iterate_quantities(self, quantities, step_size=DEFAULT_STEP_SIZE):
+        branches = [self.branches[quantity] for quantity in quantities]
+        with uproot.open(self.root_file_path) as root_file:
+            for arrays in root_file[self.tree_name].iterate(branches, step_size=step_size, library="np"):
+                yield {quantity: arrays[branch] for quantity, branch in zip(quantities, branches)}
+
+    def description(self):
+        return {
+            "label": self.label,
+            "root_file_path": self.root_file_path,
+            "tree_name": self.tree_name,
+            "number_of_entries": self.number_of_entries,
+            "branches": self.branches,
+        }
+
+
+# quantity -> (minimum, maximum) over all the datasets, only the quantities
+# without a fixed range are read (fixed_ranges: quantity -> (minimum, maximum))
+def compute_quantity_ranges(datasets, quantities, fixed_ranges=None, step_size=DEFAULT_STEP_SIZE):
+    quantity_ranges = {quantity: None for quantity in quantities}
+    fixed_ranges = fixed_ranges or {}
+    quantities_to_read = [quantity for quantity in quantities if quantity not in fixed_ranges]
+    for dataset in datasets:
+        if not quantities_to_read:
+            break
+        branches = [dataset.branches[quantity] for quantity in quantities_to_read]
+        branch_ranges = compute_branch_ranges([dataset.root_file_path], dataset.tree_name, branches, step_size)
+        for quantity, branch in zip(quantities_to_read, branches):
+            branch_range = branch_ranges.get(branch)
+            if branch_range is None:
+                continue
+            if quantity_ranges[quantity] is not None:
+                branch_range = (min(branch_range[0], quantity_ranges[quantity][0]),
+                                max(branch_range[1], quantity_ranges[quantity][1]))
+            quantity_ranges[quantity] = branch_range
+    for quantity, fixed_range in fixed_ranges.items():
+        if quantity in quantity_ranges:
+            quantity_ranges[quantity] = (float(fixed_range[0]), float(fixed_range[1]))
+    return quantity_ranges
+
+
+# binned two sample statistics of many quantities at once. counts_a and counts_b
+# are (number of quantities, number of bins) histograms of the same bin edges
+# (edges: (number of quantities, number of bins + 1)).
+# returns arrays of one value per quantity:
+# - chi2 and ndf: chi-square test of two unweighted histograms with different
+#   totals, sum (Nb a - Na b)^2 / (Na Nb (a + b)) over the bins with entries
+# - ks: maximum distance between the two normalized cumulative distributions
+# - wasserstein: earth mover's distance, integral of |cdf_a - cdf_b| over the bins
+def compare_histograms(counts_a, counts_b, edges):
+    counts_a = np.asarray(counts_a, dtype=np.float64)
+    counts_b = np.asarray(counts_b, dtype=np.float64)
+    total_a = counts_a.sum(axis=1, keepdims=True)
+    total_b = counts_b.sum(axis=1, keepdims=True)
+
+    counts_sum = counts_a + counts_b
+    with np.errstate(divide="ignore", invalid="ignore"):
+        chi2_terms = (total_b * counts_a - total_a * counts_b) ** 2 / (total_a * total_b * counts_sum)
+    chi2 = np.where(counts_sum > 0, chi2_terms, 0.0).sum(axis=1)
+    ndf = np.count_nonzero(counts_sum > 0, axis=1) - 1
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cdf_a = np.cumsum(counts_a, axis=1) / total_a
+        cdf_b = np.cumsum(counts_b, axis=1) / total_b
+    cdf_distance = np.abs(cdf_a - cdf_b)
+    ks = cdf_distance.max(axis=1)
+    wasserstein = (cdf_distance * np.diff(edges, axis=1)).sum(axis=1)
+
+    # undefined when one of the histograms is empty
+    empty = (total_a[:, 0] == 0) | (total_b[:, 0] == 0)
+    chi2[empty] = np.nan
+    ks[empty] = np.nan
+    wasserstein[empty] = np.nan
+    return {"chi2": chi2, "ndf": ndf, "ks": ks, "wasserstein": wasserstein,
+            "entries_a": total_a[:, 0], "entries_b": total_b[:, 0]}
+
+
+# p-values of the chi-square and (asymptotic) ks tests, only if scipy is installed
+def compute_p_values(statistics):
+    try:
+        from scipy.special import kolmogorov
+        from scipy.stats import chi2
+    except ImportError:
+        return None
+    entries_a, entries_b = statistics["entries_a"], statistics["entries_b"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        effective_entries = entries_a * entries_b / (entries_a + entries_b)
+    return {
+        "chi2_p_value": np.where(statistics["ndf"] > 0, chi2.sf(statistics["chi2"], np.maximum(statistics["ndf"], 1)), np.nan),
+        "ks_p_value": kolmogorov(np.sqrt(effective_entries) * statistics["ks"]),
+    }
+
+
+def to_json_value(value):
+    value = value.item() if isinstance(value, np.generic) else value
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+# compares the quantities of two or three datasets with shared bin edges. each
+# tree is read twice chunk by chunk (ranges, then counts), or once if all the
+# ranges are fixed, so the memory does not depend on the number of entries.
+# returns the report (json serializable) and dataset label -> histograms.
+def compare_datasets(datasets, quantities=tuple(BRANCH_ALIASES), number_of_bins=DEFAULT_NUMBER_OF_BINS,
+                     fixed_ranges=None, step_size=DEFAULT_STEP_SIZE):
+    if len(datasets) < 2:
+        raise ValueError("At least two datasets are needed for a comparison")
+    labels = [dataset.label for dataset in datasets]
+    if len(set(labels)) != len(labels):
+        raise ValueError(f"Dataset labels must be unique, got {labels}")
+
+    # only the quantities found in all the datasets are compared
+    for dataset in datasets:
+        dataset.resolve_branches(quantities)
+    quantities = [quantity for quantity in quantities if all(quantity in dataset.branches for dataset in datasets)]
+    for dataset in datasets:
+        dataset.branches = {quantity: dataset.branches[quantity] for quantity in quantities}
+
+    quantity_ranges = compute_quantity_ranges(datasets, quantities, fixed_ranges, step_size)
+    # the non numeric quantities and the quantities without entries are not compared
+    bin_edges = {quantity: edges for quantity, edges in make_bin_edges(quantity_ranges, number_of_bins).items()
+                 if edges is not None}
+    quantities = [quantity for quantity in quantities if quantity in bin_edges]
+
+    histograms = {}
+    for dataset in datasets:
+        accumulator = HistogramAccumulator(bin_edges)
+        for arrays in dataset.iterate_quantities(quantities, step_size):
+            accumulator.fill(arrays)
+        histograms[dataset.label] = accumulator.result()
+
+    report = {
+        "datasets": [dataset.description() for dataset in datasets],
+        "number_of_bins": number_of_bins,
+        "quantities": {quantity: {"range": [float(bin_edges[quantity][0]), float(bin_edges[quantity][-1])],
+                                  "underflow": {label: int(histograms[label][quantity]["underflow"]) for label in labels},
+                                  "overflow": {label: int(histograms[label][quantity]["overflow"]) for label in labels}}
+                       for quantity in quantities},
+        "comparisons": [],
+    }
+    if not quantities:
+        return report, histograms
+
+    # all the quantities of a pair of datasets are compared at once
+    edges = np.stack([bin_edges[quantity] for quantity in quantities])
+    for label_a, label_b in itertools.combinations(labels, 2):
+        counts_a = np.stack([histograms[label_a][quantity]["counts"] for quantity in quantities])
+        counts_b = np.stack([histograms[label_b][quantity]["counts"] for quantity in quantities])
+        statistics = compare_histograms(counts_a, counts_b, edges)
+        statistics.update(compute_p_values(statistics) or {})
+        report["comparisons"].append({
+            "datasets": [label_a, label_b],
+            "quantities": {quantity: {name: to_json_value(values[i]) for name, values in statistics.items()}
+                           for i, quantity in enumerate(quantities)},
+        })
+    return report, histograms
+
+
+def write_report(report_file_path, report):
+    os.makedirs(os.path.dirname(os.path.abspath(report_file_path)), exist_ok=True)
+    with open(report_file_path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+def print_report(report):
+    for comparison in report["comparisons"]:
+        label_a, label_b = comparison["datasets"]
+        print(f"{label_a} vs {label_b}")
+        for quantity, statistics in comparison["quantities"].items():
+            print(f"    {quantity}: chi2/ndf {statistics['chi2']}/{statistics['ndf']}, "
+                  f"ks {statistics['ks']}, wasserstein {statistics['wasserstein']}")
+
+
+# writes the json report, and the histograms of each dataset as <label>_histograms.npz
+# in histograms_folder when it is given, then prints the report
+def write_comparison(report_file_path, report, histograms, histograms_folder=None):
+    write_report(report_file_path, report)
+    if histograms_folder is not None:
+        os.makedirs(histograms_folder, exist_ok=True)
+        for label, dataset_histograms in histograms.items():
+            save_histograms(os.path.join(histograms_folder, f"{label}_histograms.npz"), dataset_histograms)
+    print_report(report)
+    print(f"Report written in {report_file_path}")
+
+
+# "label:root_file_path:tree_name", the path may hold colons (e.g. C:/data/gate9.root)
+def parse_dataset(value):
+    label, _, path_and_tree = value.partition(":")
+    root_file_path, _, tree_name = path_and_tree.rpartition(":")
+    if not label or not root_file_path or not tree_name:
+        raise argparse.ArgumentTypeError(f"Dataset '{value}' must be given as label:root_file_path:tree_name")
+    return ComparisonDataset(label, root_file_path, tree_name)
+
+
+# "quantity=minimum:maximum"
+def parse_range(value):
+    quantity, _, bounds = value.partition("=")
+    minimum, _, maximum = bounds.partition(":")
+    try:
+        return quantity, (float(minimum), float(maximum))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Range '{value}' must be given as quantity=minimum:maximum")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the distributions of Gate 9, Gate 10 and OptiGAN root files.")
+    parser.add_argument("--dataset", dest="datasets", type=parse_dataset, action="append", required=True,
+                        help="label:root_file_path:tree_name, given two or three times "
+                             "(e.g. gate9:gate9.root:MyActorPixel_In gate10:gate10.root:Phase optigan:optigan_outputs.root:OptiganOutputs)")
+    parser.add_argument("--quantities", nargs="+", default=list(BRANCH_ALIASES),
+                        help="quantities to compare (default: %(default)s)")
+    parser.add_argument("--bins", type=int, default=DEFAULT_NUMBER_OF_BINS, help="number of bins (default: %(default)s)")
+    parser.add_argument("--range", dest="ranges", type=parse_range, action="append", default=[],
+                        help="fixed range of a quantity, quantity=minimum:maximum (skips reading its range)")
+    parser.add_argument("--step-size", default=DEFAULT_STEP_SIZE,
+                        help="entries (e.g. 100000) or memory size (e.g. '100 MB') read at once (default: %(default)s)")
+    parser.add_argument("--output", default="dataset_comparison.json", help="json report (default: %(default)s)")
+    parser.add_argument("--histograms-folder", default=None,
+                        help="also saves the histograms of each dataset as <label>_histograms.npz in this folder")
+    args = parser.parse_args()
+
+    report, histograms = compare_datasets(args.datasets, args.quantities, args.bins, dict(args.ranges),
+                                          parse_step_size(args.step_size))
+    write_comparison(args.output, report, histograms, args.histograms_folder)
@@ -0,0 +1,234 @@
+import os
+
+from material_cache import MATERIAL_DATABASE_PATH, get_cached_material_files, get_config_materials, get_config_surfaces
+
+PHASE_SPACE_OUTPUT_FILENAME = "test075_optigan_create_dataset_carlotta_simu_exiting_phase_space.root"
+
+# attributes stored by the phase space actor on the pixel
+PHASE_SPACE_ATTRIBUTES = [
+    "EventID",
+    "ParticleName",
+    "Position",
+    "TrackID",
+    "ParentID",
+    "Direction",
+    "KineticEnergy",
+    "PreKineticEnergy",
+    "PostKineticEnergy",
+    "TotalEnergyDeposit",
+    "LocalTime",
+    "GlobalTime",
+    "TimeFromBeginOfEvent",
+    "StepLength",
+    "TrackCreatorProcess",
+    "TrackLength",
+    "PDGCode",
+]
+
+# named lists of phase space attributes. the compact profiles keep only what
+# their consumers read and the particle type as the integer PDGCode (no strings):
+# - full: everything above
+# - optigan: what OptiganHelpers reads to build the optigan inputs
+# - comparison: what the filters (Position_Z, Direction_Z) and dataset_comparison read
+PHASE_SPACE_OUTPUT_PROFILES = {
+    "full": PHASE_SPACE_ATTRIBUTES,
+    "optigan": ["EventID", "PDGCode", "Position"],
+    "comparison": ["EventID", "PDGCode", "Position", "Direction", "KineticEnergy"],
+}
+
+# configuration of the dataset creation simulation, the values replicate the
+# dataset creation testfile of Gate 9 (verified with C++ macro files).
+# units are given in the key names.
+DEFAULT_SIMULATION_CONFIG = {
+    # geometry: the crystal starts at z = 0, the grease and the pixel follow it along z
+    "world_size_cm": [10, 10, 15],
+    "optical_system_size_cm": [10, 10, 14],
+    "crystal_size_mm": [3, 3, 20],
+    "crystal_material": "BGO",
+    "grease_thickness_mm": 0.015,
+    "grease_material": "Epoxy",
+    "pixel_thickness_mm": 0.1,
+    "pixel_material": "SiO2",
+    # physics
+    "physics_list": "G4EmStandardPhysics_option4",
+    # optical surfaces (both directions)
+    # RoughESR_LUT.z -> Customized3_LUT.z, Rough_LUT.z -> Customized2_LUT.z, RoughESRGrease_LUT.z -> Customized4_LUT.z
+    "crystal_surface": "Customized3_LUT",
+    "grease_surface": "Customized2_LUT",
+    "pixel_surface": "Customized4_LUT",
+    # source
+    "source_particle": "e-",
+    "source_energy_keV": 420,
+    "source_activity_Bq": 1000,
+    "source_theta_deg": [163, 165],
+    "source_phi_deg": [100, 110],
+    "source_position_mm": [0, 0, 19],
+    # run
+    "number_of_threads": 1,
+    "seed": None,
+    "start_time_s": 0,
+    "end_time_s": 1,
+    "g4_verbose": True,
+    # output, the material database is the one of this folder if not given
+    "output_dir": None,
+    "output_filename": PHASE_SPACE_OUTPUT_FILENAME,
+    "output_profile": "full",
+    "material_database": None,
+    # optical properties of the materials and surfaces (e.g. Materials.xml and
+    # Surfaces.xml of this folder), the opengate ones if not given
+    "optical_properties_file": None,
+    "surface_properties_file": None,
+    # when given, the simulation reads reduced copies of the material database and of the
+    # optical property files with only the materials and surfaces of the geometry,
+    # written once in this folder (see material_cache.py)
+    "material_cache_folder": None,
+}
+
+
+# default config with some values replaced, unknown keys are rejected
+# so a typo in a sweep does not silently run the default simulation
+def make_simulation_config(config=None, **overrides):
+    overrides = {**(config or {}), **overrides}
+    unknown_keys = sorted(set(overrides) - set(DEFAULT_SIMULATION_CONFIG))
+    if unknown_keys:
+        raise ValueError(f"Unknown simulation config keys {unknown_keys}, use some of {list(DEFAULT_SIMULATION_CONFIG)}")
+    config = {**DEFAULT_SIMULATION_CONFIG, **overrides}
+    if config["output_profile"] not in PHASE_SPACE_OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile '{config['output_profile']}', use one of {list(PHASE_SPACE_OUTPUT_PROFILES)}")
+    return config
+
+
+# path of the phase space root file written by the simulation of config
+def get_phase_space_output_path(config):
+    return os.path.join(config["output_dir"] or ".", config["output_filename"])
+
+
+# builds the simulation of config, opengate is only imported here so the
+# configs can be prepared (e.g. by the sweep driver) without loading Geant4
+def create_simulation(config):
+    import opengate as gate
+
+    config = make_simulation_config(config)
+
+    # create simulation
+    sim = gate.Simulation()
+    sim.g4_verbose = config["g4_verbose"]
+    if config["output_dir"] is not None:
+        sim.output_dir = config["output_dir"]
+    sim.number_of_threads = config["number_of_threads"]
+    if config["seed"] is not None:
+        sim.random_seed = config["seed"]
+
+    # units
+    cm = gate.g4_units.cm
+    mm = gate.g4_units.mm
+    um = gate.g4_units.um
+    eV = gate.g4_units.eV
+    MeV = gate.g4_units.MeV
+    keV = gate.g4_units.keV
+    Bq = gate.g4_units.Bq
+    deg = gate.g4_units.deg
+    sec = gate.g4_units.s
+
+    # run time, the number of events is the activity times the run time
+    sim.run_timing_intervals = [[config["start_time_s"] * sec, config["end_time_s"] * sec]]
+
+    # set the world size like in the Gate macro
+    sim.world.size = [size * cm for size in config["world_size_cm"]]
+
+    # optical_system
+    optical_system = sim.add_volume("Box", "optical_system")
+    optical_system.size = [size * cm for size in config["optical_system_size_cm"]]
+    optical_system.material = "G4_AIR"
+    optical_system.translation = [0 * cm, 0 * cm, 0 * cm]
+
+    # add a material database
+    material_files = {
+        "material_database": config["material_database"] or MATERIAL_DATABASE_PATH,
+        "optical_properties_file": config["optical_properties_file"],
+        "surface_properties_file": config["surface_properties_file"],
+    }
+    if config["material_cache_folder"] is not None:
+        material_files.update(get_cached_material_files(
+            config["material_cache_folder"], get_config_materials(config), get_config_surfaces(config),
+            material_database_path=str(material_files["material_database"]),
+            optical_properties_path=material_files["optical_properties_file"],
+            surface_properties_path=material_files["surface_properties_file"]))
+    sim.volume_manager.add_material_database(str(material_files["material_database"]))
+    if material_files["optical_properties_file"] is not None:
+        sim.physics_manager.optical_properties_file = str(material_files["optical_properties_file"])
+    if material_files["surface_properties_file"] is not None:
+        sim.physics_manager.surface_properties_file = str(material_files["surface_properties_file"])
+
+    crystal_length = config["crystal_size_mm"][2]
+    grease_thickness = config["grease_thickness_mm"]
+    pixel_thickness = config["pixel_thickness_mm"]
+
+    # crystal
+    crystal = sim.add_volume("Box", "crystal")
+    crystal.mother = optical_system.name
+    crystal.size = [size * mm for size in config["crystal_size_mm"]]
+    crystal.translation = [0 * mm, 0 * mm, crystal_length / 2 * mm]
+    crystal.material = config["crystal_material"]
+
+    # grease
+    grease = sim.add_volume("Box", "grease")
+    grease.mother = optical_system.name
+    grease.size = [config["crystal_size_mm"][0] * mm, config["crystal_size_mm"][1] * mm, grease_thickness * mm]
+    grease.material = config["grease_material"]
+    grease.translation = [0 * mm, 0 * mm, (crystal_length + grease_thickness / 2) * mm]
+
+    # pixel
+    pixel = sim.add_volume("Box", "pixel")
+    pixel.mother = optical_system.name
+    pixel.size = [config["crystal_size_mm"][0] * mm, config["crystal_size_mm"][1] * mm, pixel_thickness * mm]
+    pixel.material = config["pixel_material"]
+    pixel.translation = [0 * mm, 0 * mm, (crystal_length + grease_thickness + pixel_thickness / 2) * mm]
+
+    # physics
+    sim.physics_manager.physics_list_name = config["physics_list"]
+    sim.physics_manager.set_production_cut("world", "electron", 10 * mm) #same as SetCutInRegion?
+    sim.physics_manager.set_production_cut("world", "positron", 10 * um)
+    sim.physics_manager.set_production_cut("crystal", "electron", 10 * um)
+    sim.physics_manager.set_production_cut("crystal", "positron", 10 * um)
+    sim.physics_manager.energy_range_min = 10 * eV
+    sim.physics_manager.energy_range_max = 1 * MeV
+    sim.physics_manager.special_physics_constructors.G4OpticalPhysics = True
+
+    # surfaces
+    sim.physics_manager.add_optical_surface("optical_system", "crystal", config["crystal_surface"])
+    sim.physics_manager.add_optical_surface("crystal", "optical_system", config["crystal_surface"])
+    sim.physics_manager.add_optical_surface("grease", "crystal", config["grease_surface"])
+    sim.physics_manager.add_optical_surface("crystal", "grease", config["grease_surface"])
+    sim.physics_manager.add_optical_surface("pixel", "grease", config["pixel_surface"])
+    sim.physics_manager.add_optical_surface("grease", "pixel", config["pixel_surface"])
+
+    # source
+    source = sim.add_source("GenericSource", "my_source")
+    source.particle = config["source_particle"]
+    source.energy.type = "mono"
+    source.energy.mono = config["source_energy_keV"] * keV
+    source.position.type = "sphere"
+    source.position.radius = 0 * mm
+    source.activity = config["source_activity_Bq"] * Bq
+    source.direction.type = "iso"
+    source.direction.theta = [angle * deg for angle in config["source_theta_deg"]]
+    source.direction.phi = [angle * deg for angle in config["source_phi_deg"]]
+    source.position.translation = [position * mm for position in config["source_position_mm"]]
+
+    # add a phase space actor to the pixel
+    phase = sim.add_actor("PhaseSpaceActor", "Phase")
+    phase.attached_to = pixel.name
+    phase.output_filename = config["output_filename"]
+    phase.attributes = list(PHASE_SPACE_OUTPUT_PROFILES[config["output_profile"]])
+    phase.steps_to_store = "exiting"
+
+    sim.user_hook_after_run = gate.userhooks.user_hook_dump_material_properties
+    return sim
+
+
+# builds and runs the simulation of config, returns the simulation
+def run_simulation(config):
+    sim = create_simulation(config)
+    sim.run()
+    return sim
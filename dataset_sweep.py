@@ -0,0 +1,131 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dataset_simulation import get_phase_space_output_path, make_simulation_config
+from filter_cache import cache_key
+
+RUN_REGISTRY_FILE_NAME = "run_registry.jsonl"
+
+
+# configs of every combination of the grid values on top of base,
+# e.g. grid = {"source_energy_keV": [300, 420], "crystal_surface": ["Customized3_LUT", "Customized2_LUT"]}
+# gives 4 configs. the grid is expanded in the order of its keys.
+def expand_config_grid(base=None, grid=None):
+    grid = grid or {}
+    keys = list(grid)
+    return [make_simulation_config(base, **dict(zip(keys, values)))
+            for values in itertools.product(*(grid[key] for key in keys))]
+
+
+# key identifying a run: everything in the config except where it is written
+def get_config_key(config):
+    return cache_key({key: value for key, value in config.items() if key not in ("output_dir", "material_cache_folder")})
+
+
+# configs without seed get one derived from their key,
+# so a restarted campaign runs them with the same seed
+def get_config_seed(config, config_key):
+    if config["seed"] is not None:
+        return config["seed"]
+    return int(config_key[:8], 16)
+
+
+# registry of the runs of a campaign, one json record per line, appended when a
+# run ends (an interrupted campaign keeps the records of the finished runs).
+# the last record of a config key is its current state.
+class RunRegistry:
+
+    def __init__(self, registry_file_path):
+        self.registry_file_path = registry_file_path
+        self.records = {}
+        if os.path.exists(registry_file_path):
+            with open(registry_file_path) as registry_file:
+                for line in registry_file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.records[record["config_key"]] = record
+
+    # completed runs whose output was deleted are run again
+    def is_completed(self, config_key):
+        record = self.records.get(config_key)
+        return record is not None and record["status"] == "completed" and os.path.exists(record["output_path"])
+
+    def add(self, record):
+        self.records[record["config_key"]] = record
+        os.makedirs(os.path.dirname(os.path.abspath(self.registry_file_path)), exist_ok=True)
+        with open(self.registry_file_path, "a") as registry_file:
+            registry_file.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+# runs one config in a pool worker, returns the wall time in seconds
+def run_sweep_config(config):
+    from dataset_simulation import run_simulation
+
+    start_time = time.perf_counter()
+    run_simulation(config)
+    return time.perf_counter() - start_time
+
+
+# runs the configs not completed yet on a local process pool, every run is
+# written in its own folder output_dir/run_<key> and recorded in the registry.
+# Geant4 runs only one simulation per process, so each run gets a new process
+# (also with jobs = 1). returns the records of the runs of this call.
+def run_sweep(configs, output_dir, jobs=1, registry_file_path=None):
+    if registry_file_path is None:
+        registry_file_path = os.path.join(output_dir, RUN_REGISTRY_FILE_NAME)
+    registry = RunRegistry(registry_file_path)
+
+    runs = []
+    for config in configs:
+        config_key = get_config_key(config)
+        if registry.is_completed(config_key):
+            print(f"Skipping run_{config_key[:12]}, already completed")
+            continue
+        run_config = dict(config, output_dir=os.path.join(output_dir, f"run_{config_key[:12]}"))
+        run_config["seed"] = get_config_seed(config, config_key)
+        runs.append((config_key, run_config))
+
+    records = []
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, max_tasks_per_child=1) as executor:
+        futures = {executor.submit(run_sweep_config, run_config): (config_key, run_config) for config_key, run_config in runs}
+        for future in as_completed(futures):
+            config_key, run_config = futures[future]
+            record = {
+                "run_name": f"run_{config_key[:12]}",
+                "config_key": config_key,
+                "config": run_config,
+                "seed": run_config["seed"],
+                "output_path": get_phase_space_output_path(run_config),
+            }
+            try:
+                record.update(status="completed", wall_seconds=future.result())
+            except Exception as error:
+                record.update(status="failed", error=repr(error))
+            registry.add(record)
+            records.append(record)
+            print(f"{record['run_name']} {record['status']}" +
+                  (f" in {record['wall_seconds']:.1f} s" if record["status"] == "completed" else f": {record['error']}"))
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a grid of dataset creation simulations on a local process pool.")
+    parser.add_argument("sweep", help='json file {"base": {config values}, "grid": {config key: [values]}}')
+    parser.add_argument("--output-folder", required=True, help="folder of the runs and of the run registry")
+    parser.add_argument("--jobs", type=int, default=1, help="number of simulations run at the same time (default: %(default)s)")
+    parser.add_argument("--registry", default=None, help=f"run registry file (default: <output folder>/{RUN_REGISTRY_FILE_NAME})")
+    args = parser.parse_args()
+
+    with open(args.sweep) as sweep_file:
+        sweep = json.load(sweep_file)
+    configs = expand_config_grid(sweep.get("base"), sweep.get("grid"))
+    print(f"{len(configs)} configs in the sweep")
+    records = run_sweep(configs, args.output_folder, args.jobs, args.registry)
+    failed_records = [record for record in records if record["status"] != "completed"]
+    print(f"{len(records) - len(failed_records)} runs completed, {len(failed_records)} failed")
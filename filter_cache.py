@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+
+# name of the manifest written in the filtered root files folder
+CACHE_MANIFEST_FILE_NAME = "filter_cache_manifest.json"
+
+
+# identity of a source file: size and modification time, and the sha256 of
+# its content if use_hash is set (slower, but survives copies and touches)
+def file_identity(file_path, use_hash=False):
+    stat = os.stat(file_path)
+    identity = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if use_hash:
+        sha256 = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha256.update(block)
+        identity = {"size": stat.st_size, "sha256": sha256.hexdigest()}
+    return identity
+
+
+# key of anything json serializable (file identities, filter definitions, parameters)
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# manifest of the outputs already computed: entry name -> key of the inputs it was
+# computed from. an output is up to date when its key did not change and its files exist.
+class CacheManifest:
+
+    def __init__(self, manifest_file_path):
+        self.manifest_file_path = manifest_file_path
+        self.entries = {}
+        if os.path.exists(manifest_file_path):
+            with open(manifest_file_path) as manifest_file:
+                self.entries = json.load(manifest_file)
+        # stage -> number of cache hits and misses
+        self.hits = {}
+        self.misses = {}
+
+    # checks (and counts) if the entry was computed with the same key
+    def is_up_to_date(self, stage, entry_name, key, output_paths=()):
+        up_to_date = self.entries.get(entry_name) == key and all(os.path.exists(path) for path in output_paths)
+        counter = self.hits if up_to_date else self.misses
+        counter[stage] = counter.get(stage, 0) + 1
+        return up_to_date
+
+    # counts a miss of an entry recomputed without looking it up (e.g. its inputs are rewritten)
+    def record_miss(self, stage):
+        self.misses[stage] = self.misses.get(stage, 0) + 1
+
+    def update(self, entry_name, key):
+        self.entries[entry_name] = key
+
+    # written in a temporary file first, so an interrupted run keeps the old manifest
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_file_path)), exist_ok=True)
+        temporary_file_path = f"{self.manifest_file_path}.tmp"
+        with open(temporary_file_path, "w") as manifest_file:
+            json.dump(self.entries, manifest_file, indent=2, sort_keys=True)
+        os.replace(temporary_file_path, self.manifest_file_path)
+
+    def print_report(self):
+        for stage in sorted(set(self.hits) | set(self.misses)):
+            print(f"Cache {stage}: {self.hits.get(stage, 0)} hits, {self.misses.get(stage, 0)} misses")
@@ -1,11 +1,34 @@
 import uproot
-import pandas as pd
 import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
 
-#FIX_ME - Need to refactor into a class.  
+from root_streaming import DEFAULT_STEP_SIZE, parse_step_size
+from root_filter_engine import DEFAULT_FILTERS, RootFilterEngine
+from branch_cache import BranchCache
+from filter_cache import CACHE_MANIFEST_FILE_NAME, CacheManifest, cache_key, file_identity
+from pipeline_instrumentation import PROFILERS, Instrumentation
+from quick_look import (
+    DEFAULT_SAMPLE_SIZE,
+    DEFAULT_WINDOW_SIZE,
+    SAMPLING_MODES,
+    fill_sampled_histograms,
+    get_sample_scale,
+    sample_branch_ranges,
+    sample_tree,
+)
+from root_histograms import (
+    DEFAULT_NUMBER_OF_BINS,
+    make_bin_edges,
+    fill_histograms_with_shared_edges,
+    save_histograms,
+    render_histograms_file,
+)
 
 # Path variables
 # Parent folder where all root sub-directories are present.
@@ -20,19 +43,6 @@ Root file categories based on filtering:
 simu_unfiltered_root_files_folder = os.path.join(simu_root_files_parent_folder, "non_filtered_root_files")
 simu_filtered_global_root_files_folder = os.path.join(simu_root_files_parent_folder, "filtered_root_files")
 
-# DELETE - These path variables are now redundant.
-"""
-Inside simu_filtered_root_files_folder, root files are divided based on filter used.
-- simu_positive_dZ_filtered_root_files_folder: Path to store root files with +dZ filter.
-- simu_negative_dZ_filtered_root_files_folder: Path to store root files with -dZ filter. 
-- simu_lt_threshold_pos_Z_root_files_folder: Path to store root files with posZ < 20.02.
-- simu_gt_threshold_pos_Z_root_files_folder: Path to store root files with posZ > 20.11. 
-"""
-simu_positive_dZ_filtered_root_files_folder = os.path.join(simu_filtered_global_root_files_folder, "filtered_positive_dZ_files")
-simu_positive_dZ_filtered_root_files_folder = os.path.join(simu_filtered_global_root_files_folder, "filtered_negative_dZ_files")
-simu_lt_threshold_pos_Z_root_files_folder = os.path.join(simu_filtered_global_root_files_folder, "filtered_pos_Z_lt_threshold_files")
-simu_gt_threshold_pos_Z_root_files_folder = os.path.join(simu_filtered_global_root_files_folder, "filtered_pos_Z_gt_threshold_files")
-
 # Change this to use with your own root file
 # simu_unfiltered_root_file_name = "test075_optigan_create_dataset_carlotta_simu_entering_phase_space.root" 
 # filtered_dz_root_file_name = "test075_optigan_create_dataset_carlotta_simu_entering_phase_space_filtered_positive_dz.root"
@@ -43,93 +53,351 @@ def save_to_root(dataframe, filename):
         file["tree"] = dataframe
         return file["tree"]
 
-# Loop through the root files in simu_unfiltered_root_files_folder.
-for simu_unfiltered_root_file_name in os.listdir(simu_unfiltered_root_files_folder):
-    if simu_unfiltered_root_file_name.endswith(".root"):
-        print(simu_unfiltered_root_file_name)
-
-        # Open root file and store the root tree.
-        with uproot.open(os.path.join(simu_unfiltered_root_files_folder, simu_unfiltered_root_file_name)) as simu_root_file:
-            tree = simu_root_file["Phase"]
-        
-        # Convert the tree to a Pandas DataFrame.
-        df = tree.arrays(library="pd")
-
-        # Filter DataFrame where pos_Z is <20.02 or >20.11.
-        lt_threshold_filtered_pos_Z_df = df[df['Position_Z'] < 20.02]
-        gt_threshold_filtered_pos_Z_df = df[df['Position_Z'] > 20.11]
-
-        # Filter DataFrame based on +dZ and -dZ.
-        positive_dZ_filtered_df = df[df['Direction_Z'] > 0]
-        negative_dZ_filtered_df = df[df['Direction_Z'] < 0]
-
-        # Create an individual folder for every root file to store filtered output.
-        simu_filtered_individual_root_file_folder = os.path.join(simu_filtered_global_root_files_folder, simu_unfiltered_root_file_name.replace(".root", ""))
-        os.makedirs(simu_filtered_individual_root_file_folder, exist_ok="True")
-
-        # Dictionary mapping file name with data stored in it. 
-        file_names = {
-            "lt_20.02_filter.root": lt_threshold_filtered_pos_Z_df,
-            "gt_20.11_filter.root": gt_threshold_filtered_pos_Z_df,
-            "positive_dZ_filter.root": positive_dZ_filtered_df,
-            "negative_dZ_filter.root": negative_dZ_filtered_df
-        }
-
-        """
-        Create root files from data filtered from simulation root files. 
-        - root_file_filter_folder: Folder in which final filtered root files are created.
-        - final_filtered_root_file_save_path: Path of the filtered root file. 
-        """
-        for file_name, data in file_names.items():
-            filtered_tree = None
-
-            root_file_filter_folder = os.path.join(simu_filtered_individual_root_file_folder, file_name.replace(".root", ""))
-            os.makedirs(root_file_filter_folder, exist_ok=True)
-
-            final_filtered_root_file_save_path = os.path.join(root_file_filter_folder, file_name)
-            exists = os.path.exists(final_filtered_root_file_save_path)
-            
-            if not exists:
-            # Create root file. 
-                print("I am inside if statement")
-                filtered_tree = save_to_root(data, final_filtered_root_file_save_path)
-                print(f"The information of the tree is {tree}")
-
-            print(filtered_tree)
-
-            """
-            Create histogram graphs for each filter. 
-            """
-            # Filtered root file graphs folder
-            root_file_histograms_graphs_folder = os.path.join(root_file_filter_folder, "distribution_graphs")
-            os.makedirs(root_file_histograms_graphs_folder, exist_ok=True)
-
-            if filtered_tree == None:
-                with uproot.open(final_filtered_root_file_save_path) as simu_root_file:
-                    filtered_tree = simu_root_file["tree"]
-
-            for branch_name, branch in filtered_tree.iteritems():
-                data = branch.array()
-
-                # Plot and save histogram for this branch
-                plt.figure(figsize=(10,6))
-                plt.ticklabel_format(axis='x', style='plain')
-                sns.histplot(data, bins=50, kde=False, color="teal")
-                plt.title(f"Histograms of {branch_name}", fontsize=16, fontweight='bold')
-                plt.xlabel(branch_name, fontsize=14)
-                plt.ylabel("Frequency", fontsize=14)
-
-                # Improve layout
-                plt.tight_layout()
-
-                simu_root_distribution_graph_output_path = os.path.join(root_file_histograms_graphs_folder, f"{branch_name}_histogram.png")
-                plt.savefig(simu_root_distribution_graph_output_path, dpi=300)
-                plt.close()
-
-        # DELETE after testing.
-        # Debug statements.
-        print(f"The length of unfiltered df is {len(df)}")
-        print(f"The length of lt_threshold_filtered_pos_Z_df is {len(lt_threshold_filtered_pos_Z_df)}")
-        print(f"The length of gt_threshold_filtered_pos_Z_df is {len(gt_threshold_filtered_pos_Z_df)}")
-        print(f"The length of positive_dZ_filtered_df is {len(positive_dZ_filtered_df)}")
-        print(f"The length of negative_dZ_filtered_df is {len(negative_dZ_filtered_df)}")
\ No newline at end of file
+"""
+Filtered root files of a simulation root file.
+- root_file_filter_folder: Folder in which final filtered root files are created.
+- final_filtered_root_file_save_path: Path of the filtered root file. 
+Returns filter name -> final_filtered_root_file_save_path.
+"""
+def get_filtered_root_file_paths(simu_unfiltered_root_file_name, filters=DEFAULT_FILTERS, filtered_root_files_folder=None):
+    if filtered_root_files_folder is None:
+        filtered_root_files_folder = simu_filtered_global_root_files_folder
+
+    # Create an individual folder for every root file to store filtered output.
+    simu_filtered_individual_root_file_folder = os.path.join(filtered_root_files_folder, simu_unfiltered_root_file_name.replace(".root", ""))
+    os.makedirs(simu_filtered_individual_root_file_folder, exist_ok=True)
+
+    final_filtered_root_file_save_paths = {}
+    for root_filter in filters:
+        root_file_filter_folder = os.path.join(simu_filtered_individual_root_file_folder, root_filter.name)
+        os.makedirs(root_file_filter_folder, exist_ok=True)
+        final_filtered_root_file_save_paths[root_filter.name] = os.path.join(root_file_filter_folder, f"{root_filter.name}.root")
+    return final_filtered_root_file_save_paths
+
+"""
+Histograms of every branch of the filtered root files of one simulation root file,
+with bin edges shared by all the filters. They are saved as distribution_histograms.npz
+next to every filtered root file, so the numbers are available without plotting.
+"""
+def compute_filtered_histograms(final_filtered_root_file_save_paths, step_size=DEFAULT_STEP_SIZE, number_of_bins=DEFAULT_NUMBER_OF_BINS):
+    histograms = fill_histograms_with_shared_edges(list(final_filtered_root_file_save_paths), "tree",
+                                                   number_of_bins=number_of_bins, step_size=step_size)
+    for final_filtered_root_file_save_path, filtered_histograms in histograms.items():
+        save_histograms(get_histograms_file_path(final_filtered_root_file_save_path), filtered_histograms)
+    return [get_histograms_file_path(path) for path in histograms]
+
+def get_histograms_file_path(final_filtered_root_file_save_path):
+    return os.path.join(os.path.dirname(final_filtered_root_file_save_path), "distribution_histograms.npz")
+
+"""
+Create histogram graphs of every branch of a filtered root file, from its saved histograms,
+in the distribution_graphs folder next to it.
+Returns the time spent in seconds.
+"""
+def plot_filtered_root_file(final_filtered_root_file_save_path, dpi=300):
+    start_time = time.perf_counter()
+
+    # Filtered root file graphs folder
+    render_histograms_file(get_histograms_file_path(final_filtered_root_file_save_path),
+                           get_graphs_folder(final_filtered_root_file_save_path), dpi)
+
+    return time.perf_counter() - start_time
+
+def get_graphs_folder(final_filtered_root_file_save_path):
+    return os.path.join(os.path.dirname(final_filtered_root_file_save_path), "distribution_graphs")
+
+"""
+Filter one simulation root file with all the filters in a single pass, then compute the
+histograms of the filtered root files.
+- filter_names_to_write: filters whose root file is (re)written, by default the ones
+  whose filtered root file does not exist yet.
+- compute_histograms: recompute the histograms of all the filtered root files.
+- profiler: "cprofile" or "pyinstrument" to profile the filter and histograms spans,
+  the profiles are written in profile_folder/<root file name>.
+- branch_cache_folder: the unfiltered tree is read from its decoded branches kept in this
+  folder (see branch_cache.py), they are decoded from the root file at the first run.
+Returns a summary dictionary with the file name, the number of unfiltered rows,
+filter name -> number of filtered rows, the filtered root file paths, the filtering and histogram time
+and the instrumentation summary (spans, rows read, files and bytes written).
+"""
+def filter_root_file(simu_unfiltered_root_file_name, filters=DEFAULT_FILTERS, step_size=DEFAULT_STEP_SIZE,
+                     unfiltered_root_files_folder=None, filtered_root_files_folder=None,
+                     filter_names_to_write=None, compute_histograms=True, number_of_bins=DEFAULT_NUMBER_OF_BINS,
+                     profiler=None, profile_folder="profiles", branch_cache_folder=None):
+    instrumentation = Instrumentation(profiler, profile_folder=os.path.join(profile_folder, simu_unfiltered_root_file_name.replace(".root", "")))
+    if unfiltered_root_files_folder is None:
+        unfiltered_root_files_folder = simu_unfiltered_root_files_folder
+
+    simu_unfiltered_root_file_path = os.path.join(unfiltered_root_files_folder, simu_unfiltered_root_file_name)
+    final_filtered_root_file_save_paths = get_filtered_root_file_paths(simu_unfiltered_root_file_name, filters, filtered_root_files_folder)
+
+    if filter_names_to_write is None:
+        filter_names_to_write = [filter_name for filter_name, final_filtered_root_file_save_path in final_filtered_root_file_save_paths.items()
+                                 if not os.path.exists(final_filtered_root_file_save_path)]
+    filtered_root_file_save_paths_to_write = {filter_name: final_filtered_root_file_save_paths[filter_name] for filter_name in filter_names_to_write}
+
+    with instrumentation.span("filter"):
+        branch_cache = BranchCache(branch_cache_folder) if branch_cache_folder is not None else None
+        engine = RootFilterEngine(filters, step_size=step_size, branch_cache=branch_cache)
+        number_of_unfiltered_rows, filtered_row_counts = engine.run(simu_unfiltered_root_file_path, filtered_root_file_save_paths_to_write)
+        instrumentation.count("rows_read", number_of_unfiltered_rows)
+        for filter_name in filtered_row_counts:
+            instrumentation.count("rows_written", filtered_row_counts[filter_name])
+            instrumentation.record_written(filtered_root_file_save_paths_to_write[filter_name])
+
+        for filter_name, final_filtered_root_file_save_path in final_filtered_root_file_save_paths.items():
+            if filter_name not in filtered_row_counts:
+                with uproot.open(final_filtered_root_file_save_path) as filtered_root_file:
+                    filtered_row_counts[filter_name] = filtered_root_file["tree"].num_entries
+
+    if compute_histograms:
+        with instrumentation.span("histograms"):
+            for histograms_file_path in compute_filtered_histograms(final_filtered_root_file_save_paths.values(), step_size, number_of_bins):
+                instrumentation.record_written(histograms_file_path)
+
+    return {
+        "file_name": simu_unfiltered_root_file_name,
+        "number_of_unfiltered_rows": number_of_unfiltered_rows,
+        "filtered_row_counts": {filter_name: filtered_row_counts[filter_name] for filter_name in final_filtered_root_file_save_paths},
+        "filtered_root_file_paths": final_filtered_root_file_save_paths,
+        "written_filter_names": list(filter_names_to_write),
+        "filter_seconds": instrumentation.span_seconds("filter"),
+        "histogram_seconds": instrumentation.span_seconds("histograms"),
+        "instrumentation": instrumentation.summary(),
+    }
+
+"""
+Loop through the root files in simu_unfiltered_root_files_folder: filter every root file
+and compute its histograms, then (optionally) plot every filtered root file. With jobs > 1
+the root files, then the filtered root files, are given to a pool of processes.
+
+A cache manifest in the filtered root files folder records, for every output, the key of
+what it was computed from (source file size and modification time or sha256 with use_hash,
+filter definition, number of bins, dpi). Only the outputs whose key changed are computed
+again, force recomputes everything.
+
+The stages are timed as spans of instrumentation ("plan", "files" and "plots"), the summaries of the root files are merged under the files span. With a
+profiler ("cprofile" or "pyinstrument") the filtering and histograms of every root file are
+profiled in profile_folder (see filter_root_file).
+Returns the summaries of filter_root_file with the plotting time added, and the manifest.
+"""
+def filter_root_files(filters=DEFAULT_FILTERS, step_size=DEFAULT_STEP_SIZE, jobs=1, plot=True,
+                      unfiltered_root_files_folder=None, filtered_root_files_folder=None,
+                      number_of_bins=DEFAULT_NUMBER_OF_BINS, dpi=300, force=False, use_hash=False,
+                      instrumentation=None, profiler=None, profile_folder="profiles", branch_cache_folder=None):
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    if unfiltered_root_files_folder is None:
+        unfiltered_root_files_folder = simu_unfiltered_root_files_folder
+    if filtered_root_files_folder is None:
+        filtered_root_files_folder = simu_filtered_global_root_files_folder
+
+    # decide what has to be computed for every root file
+    with instrumentation.span("plan"):
+        simu_unfiltered_root_file_names = sorted(
+            file_name for file_name in os.listdir(unfiltered_root_files_folder) if file_name.endswith(".root"))
+
+        manifest = CacheManifest(os.path.join(filtered_root_files_folder, CACHE_MANIFEST_FILE_NAME))
+
+        filter_tasks = []
+        histogram_keys = {}
+        for simu_unfiltered_root_file_name in simu_unfiltered_root_file_names:
+            source_identity = file_identity(os.path.join(unfiltered_root_files_folder, simu_unfiltered_root_file_name), use_hash)
+            final_filtered_root_file_save_paths = get_filtered_root_file_paths(simu_unfiltered_root_file_name, filters, filtered_root_files_folder)
+
+            filter_keys = {root_filter.name: cache_key(source_identity, root_filter.definition()) for root_filter in filters}
+            filter_names_to_write = [
+                filter_name for filter_name, filter_key in filter_keys.items()
+                if force or not manifest.is_up_to_date("filter", f"{simu_unfiltered_root_file_name}/{filter_name}/filter", filter_key,
+                                                       [final_filtered_root_file_save_paths[filter_name]])
+            ]
+
+            # the bin edges are shared by all the filters, so the histograms depend on all of them
+            histogram_key = cache_key(filter_keys, number_of_bins)
+            histogram_keys[simu_unfiltered_root_file_name] = histogram_key
+            if force or filter_names_to_write:
+                # rewritten filtered root files always get new histograms, still a miss of the report
+                manifest.record_miss("histograms")
+                compute_histograms = True
+            else:
+                compute_histograms = not manifest.is_up_to_date(
+                    "histograms", f"{simu_unfiltered_root_file_name}/histograms", histogram_key,
+                    [get_histograms_file_path(path) for path in final_filtered_root_file_save_paths.values()])
+
+            for filter_name in filter_names_to_write:
+                manifest.update(f"{simu_unfiltered_root_file_name}/{filter_name}/filter", filter_keys[filter_name])
+            filter_tasks.append((simu_unfiltered_root_file_name, filter_names_to_write, compute_histograms))
+
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as executor:
+        map_function = executor.map if executor is not None else map
+
+        with instrumentation.span("files"):
+            summaries = list(map_function(
+                partial(run_filter_task, filters=filters, step_size=step_size,
+                        unfiltered_root_files_folder=unfiltered_root_files_folder,
+                        filtered_root_files_folder=filtered_root_files_folder, number_of_bins=number_of_bins,
+                        profiler=profiler, profile_folder=profile_folder, branch_cache_folder=branch_cache_folder),
+                filter_tasks))
+            for summary in summaries:
+                instrumentation.merge(summary["instrumentation"])
+        for simu_unfiltered_root_file_name, _, compute_histograms in filter_tasks:
+            if compute_histograms:
+                manifest.update(f"{simu_unfiltered_root_file_name}/histograms", histogram_keys[simu_unfiltered_root_file_name])
+        manifest.save()
+
+        # each filtered root file is plotted on its own
+        for summary in summaries:
+            summary["plot_seconds"] = 0.0
+        if plot:
+            with instrumentation.span("plots"):
+                plot_tasks = []
+                for summary in summaries:
+                    plot_key = cache_key(histogram_keys[summary["file_name"]], dpi)
+                    for filter_name, final_filtered_root_file_save_path in summary["filtered_root_file_paths"].items():
+                        plot_entry_name = f"{summary['file_name']}/{filter_name}/plots"
+                        if not force and manifest.is_up_to_date("plots", plot_entry_name, plot_key, [get_graphs_folder(final_filtered_root_file_save_path)]):
+                            continue
+                        plot_tasks.append((summary, final_filtered_root_file_save_path, plot_entry_name, plot_key))
+
+                plot_seconds = map_function(partial(plot_filtered_root_file, dpi=dpi), [task[1] for task in plot_tasks])
+                for (summary, final_filtered_root_file_save_path, plot_entry_name, plot_key), seconds in zip(plot_tasks, plot_seconds):
+                    summary["plot_seconds"] += seconds
+                    instrumentation.record_written(get_graphs_folder(final_filtered_root_file_save_path))
+                    manifest.update(plot_entry_name, plot_key)
+                manifest.save()
+
+    return summaries, manifest
+
+"""
+Quick look at the filtered distributions of one simulation root file, without writing the
+filtered root files: a sample of the unfiltered tree (sample_size rows with "reservoir", or
+the rows of sample_size events with "event") is drawn from windows read in random order
+until max_seconds, every filter is applied to the sample and its histograms are scaled to
+the whole tree with Poisson error bands (see quick_look.py). They are saved as
+quick_look_histograms.npz and plotted in quick_look_graphs next to where the filtered root
+files go, with bin edges shared by all the filters.
+Returns a summary with the sampling description and the estimated rows of every filter.
+"""
+def quick_look_root_file(simu_unfiltered_root_file_name, filters=DEFAULT_FILTERS, sample_size=DEFAULT_SAMPLE_SIZE,
+                         sampling_mode="reservoir", max_seconds=None, step_size=DEFAULT_WINDOW_SIZE, seed=None,
+                         unfiltered_root_files_folder=None, filtered_root_files_folder=None,
+                         number_of_bins=DEFAULT_NUMBER_OF_BINS, plot=True, dpi=150, branch_cache_folder=None):
+    if unfiltered_root_files_folder is None:
+        unfiltered_root_files_folder = simu_unfiltered_root_files_folder
+    simu_unfiltered_root_file_path = os.path.join(unfiltered_root_files_folder, simu_unfiltered_root_file_name)
+    final_filtered_root_file_save_paths = get_filtered_root_file_paths(simu_unfiltered_root_file_name, filters, filtered_root_files_folder)
+
+    branch_cache = BranchCache(branch_cache_folder) if branch_cache_folder is not None else None
+    sample, description = sample_tree(simu_unfiltered_root_file_path, "Phase", None, sample_size, sampling_mode,
+                                      step_size, max_seconds, seed, branch_cache)
+    scale = get_sample_scale(description["number_of_entries"], description["number_of_rows_sampled"])
+    filtered_samples = {}
+    for root_filter in filters:
+        mask = np.asarray(root_filter.for_branches(list(sample)).mask(sample))
+        filtered_samples[root_filter.name] = {branch: values[mask] for branch, values in sample.items()}
+    bin_edges = make_bin_edges(sample_branch_ranges(filtered_samples.values()), number_of_bins)
+
+    estimated_row_counts = {}
+    for filter_name, filtered_sample in filtered_samples.items():
+        filter_folder = os.path.dirname(final_filtered_root_file_save_paths[filter_name])
+        histograms_file_path = os.path.join(filter_folder, "quick_look_histograms.npz")
+        save_histograms(histograms_file_path, fill_sampled_histograms(filtered_sample, bin_edges, scale))
+        if plot:
+            render_histograms_file(histograms_file_path, os.path.join(filter_folder, "quick_look_graphs"), dpi)
+        number_of_sampled_rows = len(next(iter(filtered_sample.values()))) if filtered_sample else 0
+        estimated_row_counts[filter_name] = (number_of_sampled_rows * scale, np.sqrt(number_of_sampled_rows) * scale)
+
+    return {**description, "file_name": simu_unfiltered_root_file_name, "estimated_row_counts": estimated_row_counts}
+
+"""
+Quick look (see quick_look_root_file) at every root file of unfiltered_root_files_folder,
+with jobs > 1 the root files are given to a pool of processes. max_seconds bounds the
+reading of every root file, so the run time does not grow with the size of the files.
+"""
+def quick_look_root_files(filters=DEFAULT_FILTERS, jobs=1, unfiltered_root_files_folder=None, **kwargs):
+    if unfiltered_root_files_folder is None:
+        unfiltered_root_files_folder = simu_unfiltered_root_files_folder
+    simu_unfiltered_root_file_names = sorted(
+        file_name for file_name in os.listdir(unfiltered_root_files_folder) if file_name.endswith(".root"))
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as executor:
+        map_function = executor.map if executor is not None else map
+        return list(map_function(partial(quick_look_root_file, filters=filters,
+                                         unfiltered_root_files_folder=unfiltered_root_files_folder, **kwargs),
+                                 simu_unfiltered_root_file_names))
+
+def print_quick_look_summaries(summaries):
+    for summary in summaries:
+        print(f"{summary['file_name']}: {summary['number_of_rows_sampled']} rows sampled ({summary['sampling_mode']}) from "
+              f"{summary['number_of_entries_read']} of {summary['number_of_entries']} entries in {summary['seconds']:.2f} s")
+        for filter_name, (estimated_row_count, error) in summary["estimated_row_counts"].items():
+            print(f"The estimated length of {filter_name} df is {estimated_row_count:.0f} +- {error:.0f}")
+
+# unpacks a task of filter_root_files for the process pool
+def run_filter_task(task, **kwargs):
+    simu_unfiltered_root_file_name, filter_names_to_write, compute_histograms = task
+    return filter_root_file(simu_unfiltered_root_file_name, filter_names_to_write=filter_names_to_write,
+                            compute_histograms=compute_histograms, **kwargs)
+
+"""
+Prints the row counts and the timing of every root file, and the totals.
+"""
+def print_filter_summaries(summaries):
+    total_number_of_unfiltered_rows = 0
+    total_filtered_row_counts = {}
+    for summary in summaries:
+        print(summary["file_name"])
+        print(f"The length of unfiltered df is {summary['number_of_unfiltered_rows']}")
+        for filter_name, filtered_row_count in summary["filtered_row_counts"].items():
+            print(f"The length of {filter_name} df is {filtered_row_count}")
+            total_filtered_row_counts[filter_name] = total_filtered_row_counts.get(filter_name, 0) + filtered_row_count
+        print(f"Filtering took {summary['filter_seconds']:.2f} s, histograms took {summary['histogram_seconds']:.2f} s, plotting took {summary['plot_seconds']:.2f} s")
+        total_number_of_unfiltered_rows += summary["number_of_unfiltered_rows"]
+
+    print(f"Total over {len(summaries)} root files")
+    print(f"The length of unfiltered df is {total_number_of_unfiltered_rows}")
+    for filter_name, filtered_row_count in total_filtered_row_counts.items():
+        print(f"The length of {filter_name} df is {filtered_row_count}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Filter the simulation root files and plot the distributions of the filtered root files")
+    parser.add_argument("--input-folder", default=simu_unfiltered_root_files_folder, help="folder with the unfiltered root files")
+    parser.add_argument("--output-folder", default=simu_filtered_global_root_files_folder, help="folder where the filtered root files are written")
+    parser.add_argument("--jobs", type=int, default=1, help="number of processes")
+    parser.add_argument("--step-size", default=DEFAULT_STEP_SIZE, help="entries (e.g. 100000) or memory size (e.g. '100 MB') read at once")
+    parser.add_argument("--no-plots", action="store_true", help="only compute the histograms, do not plot them")
+    parser.add_argument("--bins", type=int, default=DEFAULT_NUMBER_OF_BINS, help="number of bins of the histograms")
+    parser.add_argument("--dpi", type=int, default=300, help="resolution of the graphs")
+    parser.add_argument("--force", action="store_true", help="ignore the cache manifest and recompute everything")
+    parser.add_argument("--hash", action="store_true", help="identify the source root files by content hash instead of size and modification time")
+    parser.add_argument("--instrumentation-summary", default=None, help="json file where the spans and counters of the run are written")
+    parser.add_argument("--profile", choices=PROFILERS, default=None, help="profile the filtering and histograms of every root file")
+    parser.add_argument("--profile-folder", default="profiles", help="folder where the profiles are written")
+    parser.add_argument("--branch-cache", default=None, help="folder where the decoded branches of the root files are kept for the next runs")
+    parser.add_argument("--quick-look", type=int, default=None, metavar="SAMPLE_SIZE",
+                        help="only histogram a sample of this many rows (or events) of every root file, scaled to the whole file")
+    parser.add_argument("--sampling", choices=SAMPLING_MODES, default="reservoir", help="quick look sampling of rows or of events")
+    parser.add_argument("--max-seconds", type=float, default=None, help="quick look reading time limit of every root file")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the quick look sampling")
+    args = parser.parse_args()
+
+    if args.quick_look is not None:
+        summaries = quick_look_root_files(jobs=args.jobs, unfiltered_root_files_folder=args.input_folder,
+                                          filtered_root_files_folder=args.output_folder, sample_size=args.quick_look,
+                                          sampling_mode=args.sampling, max_seconds=args.max_seconds, seed=args.seed,
+                                          number_of_bins=args.bins, plot=not args.no_plots, dpi=args.dpi,
+                                          branch_cache_folder=args.branch_cache)
+        print_quick_look_summaries(summaries)
+        raise SystemExit(0)
+
+    instrumentation = Instrumentation()
+    summaries, manifest = filter_root_files(step_size=parse_step_size(args.step_size), jobs=args.jobs, plot=not args.no_plots,
+                                            unfiltered_root_files_folder=args.input_folder,
+                                            filtered_root_files_folder=args.output_folder,
+                                            number_of_bins=args.bins, dpi=args.dpi, force=args.force, use_hash=args.hash,
+                                            instrumentation=instrumentation, profiler=args.profile, profile_folder=args.profile_folder,
+                                            branch_cache_folder=args.branch_cache)
+    print_filter_summaries(summaries)
+    manifest.print_report()
+    instrumentation.print_summary()
+    if args.instrumentation_summary is not None:
+        instrumentation.write_summary(args.instrumentation_summary)
@@ -0,0 +1,179 @@
+import argparse
+import os
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+
+from filter_cache import cache_key, file_identity
+
+# GateMaterials.db, Materials.xml (optical properties of the materials) and
+# Surfaces.xml (optical surfaces) shipped in the folder of this file
+DATA_FOLDER = os.path.dirname(os.path.abspath(__file__))
+MATERIAL_DATABASE_PATH = os.path.join(DATA_FOLDER, "GateMaterials.db")
+OPTICAL_PROPERTIES_PATH = os.path.join(DATA_FOLDER, "Materials.xml")
+SURFACE_PROPERTIES_PATH = os.path.join(DATA_FOLDER, "Surfaces.xml")
+
+# bumped when the cached files change, the older ones are not used anymore
+MATERIAL_CACHE_VERSION = 1
+
+# "+el: name=Bismuth; n=4" or "+mat: name=Water; f=0.5" lines of a material
+COMPONENT_PATTERN = re.compile(r"^\+(el|mat):\s*name\s*=\s*([^;\s]+)")
+
+
+# sections of a Gate material database, section name ("Elements", "Materials")
+# -> entry name -> lines of the entry (an element is one line, a material is its
+# line and its +el/+mat component lines). the source order is kept.
+def parse_material_database(material_database_path):
+    sections = {}
+    section = None
+    entry_lines = None
+    with open(material_database_path) as material_database_file:
+        for line in material_database_file:
+            line = line.rstrip("\n")
+            stripped = line.strip()
+            if not stripped:
+                entry_lines = None
+            elif stripped.startswith("#"):
+                continue
+            elif stripped.startswith("[") and stripped.endswith("]"):
+                section = sections.setdefault(stripped[1:-1], {})
+                entry_lines = None
+            elif stripped.startswith("+") and entry_lines is not None:
+                entry_lines.append(line)
+            elif section is not None:
+                entry_lines = section[stripped.split(":", 1)[0].strip()] = [line]
+    return sections
+
+
+# the materials (and the materials and elements they are made of) of the database,
+# Geant4 NIST materials (G4_*) are not in the database and are skipped
+def select_materials(sections, material_names):
+    materials = sections.get("Materials", {})
+    elements = sections.get("Elements", {})
+    selected_materials = set()
+    selected_elements = set()
+
+    def add_material(material_name):
+        if material_name in selected_materials:
+            return
+        if material_name not in materials:
+            raise KeyError(f"Unknown material '{material_name}' in the material database")
+        selected_materials.add(material_name)
+        for line in materials[material_name][1:]:
+            match = COMPONENT_PATTERN.match(line.strip())
+            if match is None:
+                continue
+            kind, component_name = match.groups()
+            if kind == "mat":
+                add_material(component_name)
+            else:
+                # "auto" is the element with the name of the material
+                selected_elements.add(material_name if component_name == "auto" else component_name)
+
+    for material_name in material_names:
+        if not material_name.startswith("G4_"):
+            add_material(material_name)
+    unknown_elements = sorted(selected_elements - set(elements))
+    if unknown_elements:
+        raise KeyError(f"Unknown elements {unknown_elements} in the material database")
+    return {
+        "Elements": {name: lines for name, lines in elements.items() if name in selected_elements},
+        "Materials": {name: lines for name, lines in materials.items() if name in selected_materials},
+    }
+
+
+def write_material_database(material_database_path, sections):
+    with open(material_database_path, "w") as material_database_file:
+        for section_name, entries in sections.items():
+            material_database_file.write(f"[{section_name}]\n")
+            for lines in entries.values():
+                material_database_file.write("\n".join(lines) + "\n")
+                if section_name != "Elements":
+                    material_database_file.write("\n")
+            material_database_file.write("\n")
+
+
+# keeps the <tag name="..."> children of the root of an xml file (materials of
+# Materials.xml, surfaces of Surfaces.xml) whose name is given, without the
+# indentation and comments of the source. returns the names kept.
+def write_selected_xml_entries(source_path, output_path, tag, names):
+    tree = ElementTree.parse(source_path)
+    root = tree.getroot()
+    for child in list(root):
+        if child.tag != tag or child.get("name") not in names:
+            root.remove(child)
+    for element in root.iter():
+        if element.text is not None and not element.text.strip():
+            element.text = None
+        if element.tail is not None and not element.tail.strip():
+            element.tail = None
+    tree.write(output_path, encoding="utf-8", xml_declaration=True)
+    return [child.get("name") for child in root]
+
+
+# names of the materials and surfaces used by the geometry of a simulation config
+def get_config_materials(config):
+    return ["G4_AIR", config["crystal_material"], config["grease_material"], config["pixel_material"]]
+
+
+def get_config_surfaces(config):
+    return [config["crystal_surface"], config["grease_surface"], config["pixel_surface"]]
+
+
+# writes the output of a cache entry in a temporary file first, so the runs
+# (shards, sweep) starting at the same time never read a partial file
+def write_cache_file(output_path, write_function):
+    temporary_file_path = f"{output_path}.{os.getpid()}.tmp"
+    write_function(temporary_file_path)
+    os.replace(temporary_file_path, output_path)
+
+
+# reduced copies of the material database and of the optical property files that only
+# hold the given materials and surfaces, so the simulation parses a few entries instead
+# of the full files at every start. they are written once in cache_folder, the name of a
+# file is the key of its source (size and modification time, or sha256 with use_hash)
+# and of the selection, so a changed source or selection writes a new file.
+# a source given as None is skipped. returns source kind -> path of the cached file.
+def get_cached_material_files(cache_folder, material_names, surface_names, material_database_path=MATERIAL_DATABASE_PATH,
+                              optical_properties_path=OPTICAL_PROPERTIES_PATH, surface_properties_path=SURFACE_PROPERTIES_PATH,
+                              use_hash=False):
+    os.makedirs(cache_folder, exist_ok=True)
+    material_names = sorted(set(material_names))
+    surface_names = sorted(set(surface_names))
+    cache_entries = {
+        "material_database": (material_database_path, material_names, lambda source_path, output_path: write_material_database(
+            output_path, select_materials(parse_material_database(source_path), material_names))),
+        "optical_properties_file": (optical_properties_path, material_names, lambda source_path, output_path: write_selected_xml_entries(
+            source_path, output_path, "material", material_names)),
+        "surface_properties_file": (surface_properties_path, surface_names, lambda source_path, output_path: write_selected_xml_entries(
+            source_path, output_path, "surface", surface_names)),
+    }
+
+    cached_files = {}
+    for kind, (source_path, names, write_function) in cache_entries.items():
+        if source_path is None:
+            continue
+        key = cache_key(MATERIAL_CACHE_VERSION, kind, file_identity(source_path, use_hash), names)
+        output_path = os.path.join(cache_folder, f"{key[:16]}_{os.path.basename(source_path)}")
+        if not os.path.exists(output_path):
+            write_cache_file(output_path, lambda path: write_function(source_path, path))
+        cached_files[kind] = output_path
+    return cached_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes the reduced material and optical surface files used by the simulation")
+    parser.add_argument("--cache-folder", default="material_cache", help="folder of the cached files (default: %(default)s)")
+    parser.add_argument("--materials", nargs="+", default=None, help="materials (default: the ones of the default simulation config)")
+    parser.add_argument("--surfaces", nargs="+", default=None, help="surfaces (default: the ones of the default simulation config)")
+    parser.add_argument("--hash", action="store_true", help="identify the sources by content hash instead of size and modification time")
+    args = parser.parse_args()
+
+    from dataset_simulation import DEFAULT_SIMULATION_CONFIG
+
+    start_time = time.perf_counter()
+    cached_files = get_cached_material_files(args.cache_folder, args.materials or get_config_materials(DEFAULT_SIMULATION_CONFIG),
+                                             args.surfaces or get_config_surfaces(DEFAULT_SIMULATION_CONFIG), use_hash=args.hash)
+    for kind, cached_file_path in cached_files.items():
+        print(f"{kind}: {cached_file_path} ({os.path.getsize(cached_file_path)} bytes)")
+    print(f"Took {time.perf_counter() - start_time:.3f} s")
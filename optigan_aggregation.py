@@ -0,0 +1,153 @@
+import argparse
+import os
+
+import numpy as np
+
+from optigan_models import OPTICAL_PHOTON_ENERGY_RANGE_MEV, OPTIGAN_OUTPUT_COLUMNS
+from root_histograms import (DEFAULT_NUMBER_OF_BINS, HistogramAccumulator, load_histograms, render_histograms_file,
+                             save_histograms, uniform_bin_index)
+
+OPTIGAN_RESPONSE_FILE_NAME = "optigan_response.npz"
+
+# size (x, y) in mm of the pixel of dataset_simulation.py, centered on the axis of
+# the crystal like Gate 9's MyActorPixel_In
+DEFAULT_PIXEL_SIZE_MM = (3.0, 3.0)
+
+# cells (x, y) of the hit map of the pixel
+DEFAULT_PIXEL_GRID = (30, 30)
+
+# range of the direction cosines dX, dY, dZ
+DIRECTION_RANGE = (-1.0, 1.0)
+
+# range in MeV of the kinetic energy of the generated photons, OptiganHelpers uses
+# the one of the model (OptiganModel.energy_range_mev). the photons outside are
+# counted as underflow and overflow, print_response_summary warns about them
+DEFAULT_ENERGY_RANGE_MEV = OPTICAL_PHOTON_ENERGY_RANGE_MEV
+
+
+# edges of the hit map: the pixel cut in pixel_grid cells
+def make_pixel_grid_edges(pixel_size_mm=DEFAULT_PIXEL_SIZE_MM, pixel_grid=DEFAULT_PIXEL_GRID):
+    return [np.linspace(-size / 2, size / 2, number_of_cells + 1) for size, number_of_cells in zip(pixel_size_mm, pixel_grid)]
+
+
+# detector response of the generated photons accumulated batch by batch, same
+# interface as the writers of optigan_storage.py so it can be given to
+# OptiganHelpers.iterate_optigan_batches. only fixed size arrays are kept:
+# - the hit map of the pixel (photons per cell of the X, Y grid)
+# - the histograms of dX, dY, dZ and Ekine on fixed edges
+# - the number of photons and of photons on the pixel of every event
+# the raw photons can then be dropped, the response size does not grow with them.
+# when closed the response is saved in optigan_response_file_path (if given).
+class OptiganResponseAggregator:
+
+    def __init__(self, optigan_response_file_path=None, column_names=OPTIGAN_OUTPUT_COLUMNS, pixel_size_mm=DEFAULT_PIXEL_SIZE_MM,
+                 pixel_grid=DEFAULT_PIXEL_GRID, number_of_bins=DEFAULT_NUMBER_OF_BINS, energy_range_mev=DEFAULT_ENERGY_RANGE_MEV):
+        self.optigan_response_file_path = optigan_response_file_path
+        self.column_names = list(column_names)
+        self.pixel_size_mm = tuple(pixel_size_mm)
+        self.x_edges, self.y_edges = make_pixel_grid_edges(pixel_size_mm, pixel_grid)
+        self.hit_map = np.zeros((len(self.x_edges) - 1, len(self.y_edges) - 1), dtype=np.int64)
+        self.spectra = HistogramAccumulator({
+            "dX": np.linspace(*DIRECTION_RANGE, number_of_bins + 1),
+            "dY": np.linspace(*DIRECTION_RANGE, number_of_bins + 1),
+            "dZ": np.linspace(*DIRECTION_RANGE, number_of_bins + 1),
+            "Ekine": np.linspace(*energy_range_mev, number_of_bins + 1),
+        })
+        self.number_of_photons = 0
+        self.event_ids = []
+        self.photon_counts = []
+        self.pixel_photon_counts = []
+
+    # photons holds the photons of the events first_event, first_event + 1, ...
+    # and offsets[i]:offsets[i + 1] the rows of event first_event + i, event_ids
+    # replaces these event ids like in OptiganOutputWriter
+    def write_batch(self, first_event, offsets, photons, event_ids=None):
+        photon_counts = np.diff(offsets)
+        if event_ids is None:
+            event_ids = first_event + np.arange(len(photon_counts), dtype=np.int64)
+        self.event_ids.append(np.asarray(event_ids, dtype=np.int64))
+        self.photon_counts.append(photon_counts)
+        columns = {column: photons[:, i] for i, column in enumerate(self.column_names)}
+
+        x_index = uniform_bin_index(columns["X"], self.x_edges)
+        y_index = uniform_bin_index(columns["Y"], self.y_edges)
+        on_pixel = (x_index >= 0) & (x_index < self.hit_map.shape[0]) & (y_index >= 0) & (y_index < self.hit_map.shape[1])
+        self.hit_map += np.bincount(x_index[on_pixel] * self.hit_map.shape[1] + y_index[on_pixel],
+                                    minlength=self.hit_map.size).reshape(self.hit_map.shape)
+        photon_events = np.repeat(np.arange(len(photon_counts)), photon_counts)
+        self.pixel_photon_counts.append(np.bincount(photon_events[on_pixel], minlength=len(photon_counts)))
+
+        self.spectra.fill(columns)
+        self.number_of_photons += len(photons)
+
+    # the response as histograms (see root_histograms.save_histograms):
+    # - "XY": hit map with its "x_edges" and "y_edges" and the photons off the pixel
+    # - "dX", "dY", "dZ", "Ekine": spectra with their edges, underflow and overflow
+    # - "events": photon counts of every event, on the pixel or not
+    def result(self):
+        photon_counts = np.concatenate(self.photon_counts) if self.photon_counts else np.zeros(0, dtype=np.int64)
+        pixel_photon_counts = np.concatenate(self.pixel_photon_counts) if self.pixel_photon_counts else np.zeros(0, dtype=np.int64)
+        response = {
+            "XY": {
+                "x_edges": self.x_edges,
+                "y_edges": self.y_edges,
+                "counts": self.hit_map,
+                "off_pixel": self.number_of_photons - int(self.hit_map.sum()),
+            },
+            "events": {
+                "EventID": np.concatenate(self.event_ids) if self.event_ids else np.zeros(0, dtype=np.int64),
+                "photon_counts": photon_counts,
+                "pixel_photon_counts": pixel_photon_counts,
+            },
+        }
+        response.update(self.spectra.result())
+        return response
+
+    def close(self):
+        if self.optigan_response_file_path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.optigan_response_file_path)), exist_ok=True)
+        save_histograms(self.optigan_response_file_path, self.result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# prints the totals of a response (as returned by result or load_histograms) and
+# warns when photons fall outside the hit map or the fixed ranges of the spectra,
+# e.g. an Ekine range that does not match the units of the model
+def print_response_summary(response):
+    photon_counts = response["events"]["photon_counts"]
+    pixel_photon_counts = response["events"]["pixel_photon_counts"]
+    number_of_photons = int(photon_counts.sum())
+    print(f"{len(photon_counts)} events, {number_of_photons} photons, "
+          f"{int(pixel_photon_counts.sum())} on the pixel ({response['XY']['off_pixel']} off the pixel)")
+    if len(photon_counts) > 0:
+        print(f"photons on the pixel per event: mean {pixel_photon_counts.mean():.1f}, "
+              f"min {pixel_photon_counts.min()}, max {pixel_photon_counts.max()}")
+    for column in ("dX", "dY", "dZ", "Ekine"):
+        if column not in response:
+            continue
+        histogram = response[column]
+        print(f"{column:6s} underflow {histogram['underflow']}, overflow {histogram['overflow']}")
+        outside = int(histogram['underflow']) + int(histogram['overflow'])
+        if outside > 0:
+            print(f"Warning: {outside} of {number_of_photons} photons ({100 * outside / number_of_photons:.1f}%) are outside "
+                  f"the {column} range [{histogram['edges'][0]:g}, {histogram['edges'][-1]:g}], check the units of the "
+                  f"model or change the range")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summary and graphs of an optigan response file")
+    parser.add_argument("response_file", help=f"response file ({OPTIGAN_RESPONSE_FILE_NAME})")
+    parser.add_argument("--graphs-folder", default=None, help="folder of the graphs (default: no graphs)")
+    parser.add_argument("--dpi", type=int, default=150, help="resolution of the graphs (default: %(default)s)")
+    args = parser.parse_args()
+
+    print_response_summary(load_histograms(args.response_file))
+    if args.graphs_folder is not None:
+        render_histograms_file(args.response_file, args.graphs_folder, args.dpi)
+        print(f"Graphs written in {args.graphs_folder}")
@@ -1,45 +1,81 @@
-import uproot
-import opengate.tests.utility as tu
 import os
 import shutil
 import pandas as pd
-import re
-import seaborn as sns
-import matplotlib.pyplot as plt
+from functools import lru_cache
 
-import torch
 import math
 import numpy as np
 
-import torch.nn as nn
-
-paths = tu.get_default_test_paths(__file__, "")
-
-def extract_number(filename):
-    match = re.search(r'\d+', filename)
-    if match:
-        return int(match.group())
-    return 0 
-
-# Generator class architecture for 3x3x3 crystal
-class WGAN_Generator(nn.Module):
-
-    def __init__(self, input_dim, output_dim, hidden_dim, labels_len):
-        super(WGAN_Generator, self).__init__()
-        self.model = nn.Sequential(nn.Linear(input_dim + labels_len, hidden_dim),
-                                   nn.ReLU(True),
-
-                                   nn.Linear(hidden_dim, 2 * hidden_dim),
-                                   nn.ReLU(True),
-
-                                   nn.Linear(2 * hidden_dim, 4 * hidden_dim),
-                                   nn.ReLU(True),
-
-                                   nn.Linear(4 * hidden_dim, output_dim),
-        )
-
-    def forward(self, x):
-        return self.model(x)
+from optigan_segmentation import (
+    process_particles_into_events,
+    extract_event_details,
+    segment_events,
+    find_particle_type_branch,
+    particle_codes,
+    segment_root_file,
+    event_table_to_details,
+    event_details_to_table,
+)
+from branch_cache import BranchCache, open_root_file_with_cache
+from phase_space_index import find_event_index, load_event_index
+from root_streaming import DEFAULT_STEP_SIZE
+from optigan_storage import (
+    OPTIGAN_INPUTS_FILE_NAME,
+    OPTIGAN_OUTPUTS_FILE_NAME,
+    check_storage_format,
+    write_optigan_inputs_csv,
+    read_optigan_inputs_csv,
+    write_optigan_inputs_root,
+    read_optigan_inputs_root,
+    OptiganOutputWriter,
+    OptiganCsvOutputWriter,
+    read_optigan_outputs_root,
+)
+# the dimensions of the generator are re-exported from here, where they were first
+# defined, for the scripts that still import them from optigan_helpers
+from optigan_models import (
+    OPTIGAN_OUTPUT_COLUMNS,
+    NOISE_DIMENSION,
+    HIDDEN_DIMENSION,
+    LABELS_LENGTH,
+    find_optigan_model,
+    get_optigan_generator,
+    get_wgan_generator_class,
+)
+from optigan_aggregation import (
+    OPTIGAN_RESPONSE_FILE_NAME,
+    DEFAULT_PIXEL_GRID,
+    OptiganResponseAggregator,
+    print_response_summary,
+)
+from quick_look import fill_sampled_histograms, get_sample_scale, sample_branch_ranges, sample_phase_space_events
+from root_histograms import DEFAULT_NUMBER_OF_BINS, make_bin_edges, render_histograms_file, save_histograms
+from optigan_inference import (
+    DEFAULT_MAX_BATCH_ROWS,
+    OptiganExecutionProfile,
+    OptiganStageMetrics,
+    create_random_generator,
+    generate_optigan_batches,
+    split_batch_by_event,
+)
+
+
+# default folders of the opengate tests, paths.data holds the optigan models, inputs
+# and outputs. opengate is only imported when they are needed, not with this module
+@lru_cache(maxsize=None)
+def get_default_paths():
+    import opengate.tests.utility as tu
+    return tu.get_default_test_paths(__file__, "")
+
+
+# optigan_helpers.paths is still available, computed on first access, and so is
+# the re-exported optigan_models.WGAN_Generator, so importing this module does not import torch
+def __getattr__(name):
+    if name == "paths":
+        return get_default_paths()
+    if name == "WGAN_Generator":
+        return get_wgan_generator_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # all the methods that will help to extract the input info from root file 
 # and save them as .csv file to give as input to optigan
@@ -47,25 +83,100 @@ class OptiganHelpers:
     """
     Everything related to Optigan should be here
     """
-    def __init__(self, root_file_path):
+    def __init__(self, root_file_path, use_vectorized_segmentation=True, step_size=None,
+                 batched_inference=True, max_batch_rows=DEFAULT_MAX_BATCH_ROWS, number_of_threads=None, seed=None,
+                 storage_format="csv", save_event_graphs=True, pipeline_mode="disk", write_outputs=False,
+                 model_name=None, crystal_size_mm=None, use_torchscript=False, precision="float32", execution_profile=None,
+                 instrumentation=None, instrumentation_summary_path=None, data_folder=None, use_event_index=False,
+                 branch_cache_folder=None, aggregate_response=False, keep_photons=True, pixel_grid=DEFAULT_PIXEL_GRID,
+                 energy_range_mev=None):
         self.root_file_path = root_file_path
+        # the decoded phase space branches are kept as memory-mapped .npy files in
+        # branch_cache_folder (see branch_cache.py), the next runs on the same root
+        # file read them instead of decompressing the root file again
+        self.branch_cache = BranchCache(branch_cache_folder) if branch_cache_folder is not None else None
+        # numpy based event segmentation, set to False to use the
+        # reference python loop (needed to fill self.events)
+        self.use_vectorized_segmentation = use_vectorized_segmentation
+        # when set (number of entries or size like "100 MB") the phase space
+        # is streamed chunk by chunk instead of being loaded in memory at once
+        self.step_size = step_size
+        # the events are taken from the sidecar event index of the phase space
+        # (see phase_space_index.py), the file is only read when it is built
+        self.use_event_index = use_event_index
+        # the generator runs on batches of up to max_batch_rows photons from
+        # many events instead of once per event, number_of_threads is given
+        # to torch.set_num_threads and seed makes the noise reproducible
+        self.batched_inference = batched_inference
+        # an execution profile replaces max_batch_rows, number_of_threads, seed and
+        # precision ("float32", "bfloat16" or "dynamic_int8", see optigan_inference.py)
+        if execution_profile is None:
+            execution_profile = OptiganExecutionProfile(number_of_threads, seed, max_batch_rows, precision)
+        self.execution_profile = execution_profile
+        self.max_batch_rows = execution_profile.max_batch_rows
+        self.number_of_threads = execution_profile.number_of_threads
+        self.seed = execution_profile.seed
+        # spans (time spent in segment/load/generate/write), counters (rows read, events,
+        # photons, files and bytes written) and peak memory of the last run. give an
+        # OptiganStageMetrics(profiler="cprofile") to also profile the stages, and
+        # instrumentation_summary_path to write the summary as json after run_optigan
+        self.metrics = instrumentation if instrumentation is not None else OptiganStageMetrics()
+        self.instrumentation_summary_path = instrumentation_summary_path
+        # "csv": one csv file per event for inputs and outputs (original format)
+        # "root": one root file for all the inputs and one for all the outputs
+        check_storage_format(storage_format)
+        self.storage_format = storage_format
+        # plots the distributions of the generated photons of every event
+        self.save_event_graphs = save_event_graphs
+        # "disk": root file -> csv inputs -> generator -> csv outputs and graphs
+        # "memory": root file -> generator, the photons are returned by run_optigan
+        # and only written (with storage_format) if write_outputs is set
+        if pipeline_mode not in ("disk", "memory"):
+            raise ValueError(f"Unknown optigan pipeline mode '{pipeline_mode}', use 'disk' or 'memory'")
+        self.pipeline_mode = pipeline_mode
+        self.write_outputs = write_outputs
+        # the generated photons are aggregated batch by batch into the response of the
+        # pixel (hit map on a pixel_grid of cells, dX/dY/dZ/Ekine spectra and photon
+        # counts per event, see optigan_aggregation.py) saved in optigan_response.npz.
+        # with keep_photons=False the raw photons are dropped: no csv/root outputs and
+        # event graphs, nothing returned in memory mode, so the outputs stop growing
+        # with the number of photons
+        if not keep_photons and not aggregate_response:
+            raise ValueError("The generated photons can only be discarded when their response is aggregated")
+        self.aggregate_response = aggregate_response
+        self.keep_photons = keep_photons
+        self.pixel_grid = tuple(pixel_grid)
+        self.response_aggregator = None
         self.events = {}
         self.extracted_events_details = []
-        self.optigan_model_folder= os.path.join(paths.data, "optigan_models")
-        # this is one model (model_3341.pt) for 3*3*3 crystal dimension
-        # which we have trained and will be used as default model for now
-        # in the future there might me multiple models (just like physics lists)
-        # users can use their own model depending on crystal size
-        self.optigan_model_file_path = os.path.join(self.optigan_model_folder, "model_3341.pt")
-        self.optigan_input_folder = os.path.join(paths.data, "optigan_inputs")
-        self.optigan_output_folder = os.path.join(paths.data, "optigan_outputs")
+        # same information as extracted_events_details, as arrays
+        self.event_table = None
+        # folder with the optigan_models, optigan_inputs and optigan_outputs folders,
+        # the data folder of the opengate tests by default
+        if data_folder is None:
+            data_folder = get_default_paths().data
+        self.data_folder = data_folder
+        self.optigan_model_folder= os.path.join(data_folder, "optigan_models")
+        # the model is picked by name, or by the size of the simulated crystal (x, y, z in mm),
+        # the default one is model_3341.pt for 3*3*3 crystal dimension (see optigan_models.py).
+        # the generator is loaded once per process, use_torchscript loads its frozen export.
+        self.optigan_model = find_optigan_model(model_name, crystal_size_mm)
+        # range in MeV of the Ekine spectrum of the response, the one of the model by default
+        self.energy_range_mev = tuple(energy_range_mev) if energy_range_mev is not None else self.optigan_model.energy_range_mev
+        self.optigan_model_file_path = os.path.join(self.optigan_model_folder, self.optigan_model.file_name)
+        self.use_torchscript = use_torchscript
+        self.optigan_input_folder = os.path.join(data_folder, "optigan_inputs")
+        self.optigan_output_folder = os.path.join(data_folder, "optigan_outputs")
+        self.optigan_inputs_file_path = os.path.join(self.optigan_input_folder, OPTIGAN_INPUTS_FILE_NAME)
+        self.optigan_outputs_file_path = os.path.join(self.optigan_output_folder, OPTIGAN_OUTPUTS_FILE_NAME)
         self.optigan_csv_output_folder = os.path.join(self.optigan_output_folder, "csv_files")
         self.optigan_output_graphs_folder = os.path.join(self.optigan_output_folder, "graphs")
+        self.optigan_response_file_path = os.path.join(self.optigan_output_folder, OPTIGAN_RESPONSE_FILE_NAME)
 
 
     # opens root file and return the phase info 
     def open_root_file(self):
-        file = uproot.open(self.root_file_path)
+        file = open_root_file_with_cache(self.root_file_path, self.branch_cache)
         tree = file["Phase"]
         return file, tree
     
@@ -91,6 +202,7 @@ class OptiganHelpers:
             print()
     
     # this method will save the extracted information into csv files
+    # (or a single root file, see storage_format)
     def save_optigan_inputs(self):
         # check if the folder exists
         if os.path.exists(self.optigan_input_folder):
@@ -101,39 +213,45 @@ class OptiganHelpers:
         
         print(f"The optigan input files will be saved at {self.optigan_input_folder}")
 
-        for event_id, detail in enumerate(self.extracted_events_details):
-            gamma_pos_x = detail['gamma_position'][0]
-            gamma_pos_y = detail['gamma_position'][1]
-            gamma_pos_z = detail['gamma_position'][2]
-            num_optical_photons = detail['optical_photon_count']
+        gamma_positions = [detail['gamma_position'] for detail in self.extracted_events_details]
+        optical_photon_counts = [detail['optical_photon_count'] for detail in self.extracted_events_details]
 
-            filename = f"optigan_input_{event_id}.csv"
-            filepath = os.path.join(self.optigan_input_folder, filename)
+        if self.storage_format == "root":
+            write_optigan_inputs_root(self.optigan_inputs_file_path, gamma_positions, optical_photon_counts)
+        else:
+            write_optigan_inputs_csv(self.optigan_input_folder, gamma_positions, optical_photon_counts)
+        self.metrics.record_written(self.optigan_input_folder)
 
-            data = {
-                "gamma_pos_x": [gamma_pos_x],
-                "gamma_pos_y": [gamma_pos_y],
-                "gamma_pos_z": [gamma_pos_z],
-                "num_optical_photons": [num_optical_photons]
-            }
+        for event_id, (gamma_position, num_optical_photons) in enumerate(zip(gamma_positions, optical_photon_counts)):
+            print(f"Event ID: {event_id}, Gamma Position: {gamma_position[0]}, {gamma_position[1]}, {gamma_position[2]}, Number of Optical Photons: {num_optical_photons}")
+            print()
 
-            df = pd.DataFrame(data)
-            df.to_csv(filepath, index=False)
+    # reads the gamma positions and optical photon counts of the
+    # events [first_event, last_event) saved by save_optigan_inputs
+    def read_optigan_inputs(self, first_event=0, last_event=None):
+        if self.storage_format == "root":
+            return read_optigan_inputs_root(self.optigan_inputs_file_path, first_event, last_event)
+        return read_optigan_inputs_csv(self.optigan_input_folder, first_event, last_event)
 
-            print(f"Event ID: {event_id}, Gamma Position: {gamma_pos_x}, {gamma_pos_y}, {gamma_pos_z}, Number of Optical Photons: {num_optical_photons}")
-            print()
+    # generator of the selected model with pre-trained weights, ready for inference.
+    # the checkpoint is only read the first time (see optigan_models.load_cached_generator)
+    # torch is only imported here and in get_optigan_outputs, when the generator runs
+    def load_generator(self, device=None):
+        import torch
+
+        if device is None:
+            device = torch.device("cpu")
+        generator = get_optigan_generator(self.optigan_model, self.optigan_model_folder, device, self.use_torchscript)
+        return self.execution_profile.prepare_generator(generator)
 
     # Loads the model with pre-trained weights and generates output of optigan
     def get_optigan_outputs(self):
+        import torch
 
         # Check if CUDA is available and set device accordingly
         device = torch.device("cpu")
 
-        # Define your model dimensions
-        noise_dimension = 10
-        output_dimension = 6
-        hidden_dimension = 128
-        labels_length = 3
+        noise_dimension = self.optigan_model.noise_dimension
 
         # Clean and recreate the output folder
         if os.path.exists(self.optigan_output_folder):
@@ -141,234 +259,418 @@ class OptiganHelpers:
         os.makedirs(self.optigan_output_folder)
         print(f"The optigan output files will be saved at {self.optigan_output_folder}")
 
-        # Sort and list CSV files
-        csv_files = sorted([file for file in os.listdir(self.optigan_input_folder) if file.endswith('.csv')], key = extract_number)
-        print(f"The csv files in the folder are {csv_files}")
-
-        # Load the saved model checkpoint
-        checkpoint = torch.load(self.optigan_model_file_path, map_location = device)
-
-        # Initialize the model 
-        generator = WGAN_Generator(noise_dimension, output_dimension, hidden_dimension, labels_length)
-
-        # Print model and checkpoint state_dict sizes
-        print("Model's state_dict:")
-        for param_tensor in generator.state_dict():
-            print(param_tensor, "\t", generator.state_dict()[param_tensor].size())
-
-        print("\nCheckpoint's state_dict:")
-        for param_tensor in checkpoint['generator_state_dict']:
-            print(param_tensor, "\t", checkpoint['generator_state_dict'][param_tensor].size())
-
-        # Load the state_dict into the model
-        generator.load_state_dict(checkpoint['generator_state_dict'])
-
-        # Move the model to the appropriate device
-        generator.to(device)
-
-        # Set the model to evaluation mode
-        generator.eval()
-
-        for file_index, file_name in enumerate(csv_files):
-
-            # Prepare input file path and read csv
-            csv_file_path = os.path.join(self.optigan_input_folder, file_name)
-            df = pd.read_csv(csv_file_path)
-
-            # Extract and ensure total number of photons is a valid integer
-            total_number_of_photons = df["num_optical_photons"].values[0]
-            print(f"Processing {file_name} with {total_number_of_photons} photons.")
-
-            # Move the initial conditional values to the device
-            classX_single = torch.tensor(df["gamma_pos_x"].values, dtype=torch.float32).to(device)
-            classY_single = torch.tensor(df["gamma_pos_y"].values, dtype=torch.float32).to(device)
-            classZ_single = torch.tensor(df["gamma_pos_z"].values, dtype=torch.float32).to(device)
-
-            # Expand the conditional input vectors to match the total number of rows
-            classX = classX_single.expand(total_number_of_photons)
-            classY = classY_single.expand(total_number_of_photons)
-            classZ = classZ_single.expand(total_number_of_photons)
-
-            # Create the random noise vector and combine conditions
-            noise = torch.randn(total_number_of_photons, noise_dimension).to(device)
-            conditions = torch.stack([classX, classY, classZ], dim=1)
-
-            # Concatenate noise and conditional input into one tensor
-            generator_input = torch.cat((noise, conditions), dim=1)
-
-            # Generate data using the model
-            with torch.no_grad():
-                generated_data = generator(generator_input)
-            
-            # Convert generated data to a DataFrame and save as a CSV file
-            generated_data_np = generated_data.cpu().numpy()
-            # generated_data_np = generated_data.to('cpu').detach().numpy()
-            column_names = ['X', 'Y', 'dX', 'dY', 'dZ', 'Ekine']
-            generated_df = pd.DataFrame(generated_data_np, columns=column_names)
-
+        # Read the inputs of all the events
+        with self.metrics.timed("read_inputs"):
+            gamma_positions, optical_photon_counts = self.read_optigan_inputs()
+        print(f"The number of events given to optigan is {len(optical_photon_counts)}")
+
+        with self.metrics.timed("load"):
+            generator = self.load_generator(device)
+
+        # With the root storage all the photons go in one file, the response
+        # aggregator gets the same batches
+        output_writers = []
+        if self.keep_photons and self.storage_format == "root":
+            output_writers.append(OptiganOutputWriter(self.optigan_outputs_file_path, OPTIGAN_OUTPUT_COLUMNS))
+        if self.aggregate_response:
+            output_writers.append(self.create_response_aggregator())
+
+        if self.batched_inference:
+            # Run the generator on batches of many events
+            random_generator = create_random_generator(self.seed)
+            batches = generate_optigan_batches(generator, gamma_positions, optical_photon_counts, noise_dimension,
+                                               self.max_batch_rows, random_generator, self.number_of_threads)
+            for batch in self.metrics.timed_batches(batches):
+                print(f"Processing events {batch['first_event']} to {batch['first_event'] + len(batch['offsets']) - 2} with {len(batch['photons'])} photons.")
+                with self.metrics.timed("write"):
+                    for output_writer in output_writers:
+                        output_writer.write_batch(batch['first_event'], batch['offsets'], batch['photons'])
+                    if self.keep_photons:
+                        for event_index, generated_data_np in split_batch_by_event(batch):
+                            self.save_optigan_event_outputs(event_index, generated_data_np)
+        else:
+            # the thread count of the process is restored after the events, like generate_optigan_batches
+            previous_number_of_threads = torch.get_num_threads()
+            if self.number_of_threads is not None:
+                torch.set_num_threads(self.number_of_threads)
+            if self.seed is not None:
+                torch.manual_seed(self.seed)
+
+            try:
+                for file_index, (gamma_position, total_number_of_photons) in enumerate(zip(gamma_positions, optical_photon_counts)):
+                    total_number_of_photons = int(total_number_of_photons)
+                    print(f"Processing event {file_index} with {total_number_of_photons} photons.")
+
+                    # Move the initial conditional values to the device
+                    classX_single = torch.tensor([gamma_position[0]], dtype=torch.float32).to(device)
+                    classY_single = torch.tensor([gamma_position[1]], dtype=torch.float32).to(device)
+                    classZ_single = torch.tensor([gamma_position[2]], dtype=torch.float32).to(device)
+
+                    # Expand the conditional input vectors to match the total number of rows
+                    classX = classX_single.expand(total_number_of_photons)
+                    classY = classY_single.expand(total_number_of_photons)
+                    classZ = classZ_single.expand(total_number_of_photons)
+
+                    # Create the random noise vector and combine conditions
+                    noise = torch.randn(total_number_of_photons, noise_dimension).to(device)
+                    conditions = torch.stack([classX, classY, classZ], dim=1)
+
+                    # Concatenate noise and conditional input into one tensor
+                    generator_input = torch.cat((noise, conditions), dim=1)
+
+                    # Generate data using the model
+                    with self.metrics.timed("generate"), torch.no_grad():
+                        generated_data = generator(generator_input)
+
+                    generated_data_np = generated_data.cpu().numpy()
+                    # generated_data_np = generated_data.to('cpu').detach().numpy()
+                    self.metrics.count("events_generated")
+                    self.metrics.count("photons_generated", total_number_of_photons)
+                    with self.metrics.timed("write"):
+                        for output_writer in output_writers:
+                            output_writer.write_batch(file_index, [0, total_number_of_photons], generated_data_np)
+                        if self.keep_photons:
+                            self.save_optigan_event_outputs(file_index, generated_data_np)
+            finally:
+                torch.set_num_threads(previous_number_of_threads)
+
+        with self.metrics.timed("write"):
+            for output_writer in output_writers:
+                output_writer.close()
+        if self.keep_photons and self.storage_format == "root":
+            self.metrics.record_written(self.optigan_outputs_file_path)
+            print(f"Saved generated data to {self.optigan_outputs_file_path}.")
+        if self.aggregate_response:
+            self.metrics.record_written(self.optigan_response_file_path)
+            print_response_summary(self.response_aggregator.result())
+            print(f"Saved the response to {self.optigan_response_file_path}.")
+
+    # reads the generated photons of the events [first_event, last_event)
+    # from the root outputs, returns the photons and the offsets of each event
+    def read_optigan_outputs(self, first_event=0, last_event=None):
+        return read_optigan_outputs_root(self.optigan_outputs_file_path, OPTIGAN_OUTPUT_COLUMNS, first_event, last_event)
+
+    # saves the generated photons of one event as csv file (csv storage)
+    # and plots their distributions (if save_event_graphs is set)
+    def save_optigan_event_outputs(self, file_index, generated_data_np):
+        # Convert generated data to a DataFrame and save as a CSV file
+        column_names = OPTIGAN_OUTPUT_COLUMNS
+        generated_df = pd.DataFrame(generated_data_np, columns=column_names)
+
+        if self.storage_format == "csv":
             # Save the output CSV file
             optigan_output_csv_file_save_path = os.path.join(self.optigan_csv_output_folder, f"optigan_output_{file_index + 1}.csv")
             os.makedirs(os.path.dirname(optigan_output_csv_file_save_path), exist_ok=True)
             generated_df.to_csv(optigan_output_csv_file_save_path, index=False)
+            self.metrics.record_written(optigan_output_csv_file_save_path)
             print(f"Saved generated data to {optigan_output_csv_file_save_path}.")
 
+        if not self.save_event_graphs:
+            return
+
+        # the plotting libraries are only imported when graphs are saved
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
         # Plot histograms using Seaborn for each column
-            for column in column_names:
-                # Define the sub-directory path where each event graph will be stored
-                optigan_output_graph_file_save_path = os.path.join(self.optigan_output_graphs_folder, f"event{file_index + 1}")
-
-                # Create the directory if it doesn't exist
-                os.makedirs(optigan_output_graph_file_save_path, exist_ok=True)
-
-                # Plot the graph using seaborn
-                plt.figure(figsize=(10, 6))
-                sns.histplot(data=generated_df, x=column, bins=30, kde=True, color="blue", edgecolor="black")
-                plt.xlabel(column)
-                plt.ylabel("Frequency")
-                plt.title(f"{column} Distribution for Event {file_index + 1}")
-                plt.tight_layout()
-
-                # Construct the file path and save the plot
-                graph_path = os.path.join(optigan_output_graph_file_save_path, f"{column}_event_{file_index + 1}.png")
-                plt.savefig(graph_path)
-                plt.close()
-
-            # Create a single figure containing all columns
-            # Create a grid layout (e.g., 2 rows, 3 columns)
-            num_columns = len(column_names)
-            num_cols_per_row = 3
-            num_rows = math.ceil(num_columns / num_cols_per_row)
-
-            fig, axs = plt.subplots(nrows=num_rows, ncols=num_cols_per_row, figsize=(18, 10))
-            fig.suptitle(f"All Graphs for Event {file_index + 1}")
-
-            for i, column in enumerate(column_names):
-                row = i // num_cols_per_row
-                col = i % num_cols_per_row
-                sns.histplot(data=generated_df, x=column, bins=30, kde=True, color="blue", edgecolor="black", ax=axs[row][col])
-                axs[row][col].set_xlabel(column)
-                axs[row][col].set_ylabel("Frequency")
-                axs[row][col].set_title(f"{column} Distribution")
-
-            # If there are empty subplots, hide them
-            for i in range(num_columns, num_rows * num_cols_per_row):
-                row = i // num_cols_per_row
-                col = i % num_cols_per_row
-                fig.delaxes(axs[row][col])
-
-            plt.tight_layout(rect=[0, 0, 1, 0.96])
-            all_graphs_path = os.path.join(optigan_output_graph_file_save_path, f"all_graphs_{file_index + 1}.png")
-            plt.savefig(all_graphs_path)
+        for column in column_names:
+            # Define the sub-directory path where each event graph will be stored
+            optigan_output_graph_file_save_path = os.path.join(self.optigan_output_graphs_folder, f"event{file_index + 1}")
+
+            # Create the directory if it doesn't exist
+            os.makedirs(optigan_output_graph_file_save_path, exist_ok=True)
+
+            # Plot the graph using seaborn
+            plt.figure(figsize=(10, 6))
+            sns.histplot(data=generated_df, x=column, bins=30, kde=True, color="blue", edgecolor="black")
+            plt.xlabel(column)
+            plt.ylabel("Frequency")
+            plt.title(f"{column} Distribution for Event {file_index + 1}")
+            plt.tight_layout()
+
+            # Construct the file path and save the plot
+            graph_path = os.path.join(optigan_output_graph_file_save_path, f"{column}_event_{file_index + 1}.png")
+            plt.savefig(graph_path)
             plt.close()
+            self.metrics.record_written(graph_path)
+
+        # Create a single figure containing all columns
+        # Create a grid layout (e.g., 2 rows, 3 columns)
+        num_columns = len(column_names)
+        num_cols_per_row = 3
+        num_rows = math.ceil(num_columns / num_cols_per_row)
+
+        fig, axs = plt.subplots(nrows=num_rows, ncols=num_cols_per_row, figsize=(18, 10))
+        fig.suptitle(f"All Graphs for Event {file_index + 1}")
+
+        for i, column in enumerate(column_names):
+            row = i // num_cols_per_row
+            col = i % num_cols_per_row
+            sns.histplot(data=generated_df, x=column, bins=30, kde=True, color="blue", edgecolor="black", ax=axs[row][col])
+            axs[row][col].set_xlabel(column)
+            axs[row][col].set_ylabel("Frequency")
+            axs[row][col].set_title(f"{column} Distribution")
+
+        # If there are empty subplots, hide them
+        for i in range(num_columns, num_rows * num_cols_per_row):
+            row = i // num_cols_per_row
+            col = i % num_cols_per_row
+            fig.delaxes(axs[row][col])
+
+        plt.tight_layout(rect=[0, 0, 1, 0.96])
+        all_graphs_path = os.path.join(optigan_output_graph_file_save_path, f"all_graphs_{file_index + 1}.png")
+        plt.savefig(all_graphs_path)
+        plt.close()
+        self.metrics.record_written(all_graphs_path)
+
+    # creates the writer of the generated photons for the selected storage format,
+    # the output folder is cleaned first
+    def create_output_writer(self):
+        if os.path.exists(self.optigan_output_folder):
+            shutil.rmtree(self.optigan_output_folder)
+        os.makedirs(self.optigan_output_folder)
+        print(f"The optigan output files will be saved at {self.optigan_output_folder}")
+        if self.storage_format == "root":
+            return OptiganOutputWriter(self.optigan_outputs_file_path, OPTIGAN_OUTPUT_COLUMNS)
+        return OptiganCsvOutputWriter(self.optigan_csv_output_folder, OPTIGAN_OUTPUT_COLUMNS)
+
+    # creates the aggregator of the response of the pixel of the crystal of the
+    # model (see optigan_aggregation.py), kept as self.response_aggregator
+    def create_response_aggregator(self):
+        self.response_aggregator = OptiganResponseAggregator(self.optigan_response_file_path, OPTIGAN_OUTPUT_COLUMNS,
+                                                             self.optigan_model.crystal_size_mm[:2], self.pixel_grid,
+                                                             energy_range_mev=self.energy_range_mev)
+        return self.response_aggregator
+
+    # in memory pipeline: the events found in the phase space go directly to the
+    # generator and the generated photons are yielded batch by batch (see
+    # optigan_inference.generate_optigan_batches). nothing is written on disk,
+    # unless output writers (objects with write_batch and close) are given.
+    def iterate_optigan_batches(self, output_writers=()):
+        if self.event_table is None:
+            with self.metrics.timed("segment"):
+                self.event_table = self.find_event_table()
+        with self.metrics.timed("load"):
+            generator = self.load_generator()
+        random_generator = create_random_generator(self.seed)
+        try:
+            batches = generate_optigan_batches(generator, self.event_table['gamma_position'], self.event_table['optical_photon_count'],
+                                               self.optigan_model.noise_dimension, self.max_batch_rows, random_generator, self.number_of_threads)
+            for batch in self.metrics.timed_batches(batches):
+                with self.metrics.timed("write"):
+                    for output_writer in output_writers:
+                        output_writer.write_batch(batch['first_event'], batch['offsets'], batch['photons'])
+                yield batch
+        finally:
+            with self.metrics.timed("write"):
+                for output_writer in output_writers:
+                    output_writer.close()
+            if output_writers:
+                self.metrics.record_written(self.optigan_output_folder)
+
+    # same as above but returns all the generated photons at once:
+    # - event_table: events given to the generator
+    # - photons: (number of photons, 6) array with OPTIGAN_OUTPUT_COLUMNS,
+    #   None when keep_photons is not set
+    # - offsets: photons of event i are photons[offsets[i]:offsets[i + 1]]
+    # - response: response of the pixel when aggregate_response is set
+    def run_optigan_in_memory(self, output_writers=()):
+        batches = [batch['photons'] for batch in self.iterate_optigan_batches(output_writers) if self.keep_photons]
+        photons = None
+        if self.keep_photons:
+            photons = np.concatenate(batches) if batches else np.zeros((0, len(OPTIGAN_OUTPUT_COLUMNS)), dtype=np.float32)
+        offsets = np.concatenate([[0], np.cumsum(self.event_table['optical_photon_count'])])
+        return {
+            'event_table': self.event_table,
+            'photons': photons,
+            'offsets': offsets,
+            'response': self.response_aggregator.result() if self.aggregate_response else None,
+            'metrics': self.metrics.report(),
+        }
+
+    # events of the quick look and the optical photons of the whole phase space:
+    # - a uniform sample of the event table when it is known, or of the event table of
+    #   the event index when use_event_index is set or an up-to-date index exists
+    #   (see phase_space_index.py), the photon total is then exact
+    # - otherwise the events are drawn while streaming the tree for at most max_seconds
+    #   (see quick_look.sample_phase_space_events), the photon total is then estimated
+    #   from the sample, the tree is never segmented as a whole
+    def sample_quick_look_events(self, number_of_events, sampling_mode="event", max_seconds=None):
+        event_table = self.event_table
+        if event_table is None:
+            event_index = (load_event_index(self.root_file_path, "Phase", self.step_size or DEFAULT_STEP_SIZE) if self.use_event_index
+                           else find_event_index(self.root_file_path, "Phase"))
+            event_table = event_index.event_table() if event_index is not None else None
+        if event_table is not None:
+            optical_photon_counts = event_table['optical_photon_count']
+            sampled_events = np.sort(np.random.default_rng(self.seed).choice(
+                len(optical_photon_counts), size=min(number_of_events, len(optical_photon_counts)), replace=False))
+            print(f"Quick look at {len(sampled_events)} of {len(optical_photon_counts)} events")
+            return {key: values[sampled_events] for key, values in event_table.items()}, int(optical_photon_counts.sum())
+
+        event_table, description = sample_phase_space_events(self.root_file_path, "Phase", number_of_events, sampling_mode,
+                                                             max_seconds=max_seconds, seed=self.seed, branch_cache=self.branch_cache)
+        print(f"Quick look at {description['number_of_events_sampled']} events sampled ({sampling_mode}) from "
+              f"{description['number_of_entries_read']} of {description['number_of_entries']} rows in {description['seconds']:.1f} s")
+        return event_table, description['estimated_number_of_photons']
+
+    # quick look at the generated photons: only a sample of number_of_events events
+    # goes to the generator (see sample_quick_look_events), the histograms of the photon
+    # columns are scaled to all the photons of the phase space with Poisson error
+    # bands (see quick_look.py). no photon is written, the histograms are saved in
+    # optigan_output_folder/quick_look and plotted in its graphs folder when
+    # save_event_graphs is set. the run time grows with number_of_events (and is
+    # bounded by max_seconds for the sampling), not with the dataset.
+    def run_optigan_quick_look(self, number_of_events=1000, number_of_bins=DEFAULT_NUMBER_OF_BINS, dpi=150,
+                               sampling_mode="event", max_seconds=None):
+        self.metrics.reset()
+        with self.metrics.span("run_optigan_quick_look"):
+            with self.metrics.timed("sample"):
+                sampled_event_table, number_of_photons = self.sample_quick_look_events(number_of_events, sampling_mode, max_seconds)
+
+            with self.metrics.timed("load"):
+                generator = self.load_generator()
+            batches = generate_optigan_batches(generator, sampled_event_table['gamma_position'], sampled_event_table['optical_photon_count'],
+                                               self.optigan_model.noise_dimension, self.max_batch_rows,
+                                               create_random_generator(self.seed), self.number_of_threads)
+            photons = [batch['photons'] for batch in self.metrics.timed_batches(batches)]
+
+            quick_look_folder = os.path.join(self.optigan_output_folder, "quick_look")
+            histograms_file_path = os.path.join(quick_look_folder, "quick_look_histograms.npz")
+            with self.metrics.timed("histograms"):
+                photons = np.concatenate(photons) if photons else np.zeros((0, len(OPTIGAN_OUTPUT_COLUMNS)), dtype=np.float32)
+                sample = {column: photons[:, i] for i, column in enumerate(OPTIGAN_OUTPUT_COLUMNS)}
+                scale = get_sample_scale(number_of_photons, len(photons))
+                histograms = fill_sampled_histograms(sample, make_bin_edges(sample_branch_ranges([sample]), number_of_bins), scale)
+                os.makedirs(quick_look_folder, exist_ok=True)
+                save_histograms(histograms_file_path, histograms)
+            self.metrics.record_written(histograms_file_path)
+            if self.save_event_graphs:
+                with self.metrics.timed("plot"):
+                    render_histograms_file(histograms_file_path, os.path.join(quick_look_folder, "graphs"), dpi)
+                self.metrics.record_written(os.path.join(quick_look_folder, "graphs"))
+        self.metrics.print_report()
+        print(f"Saved the quick look histograms to {histograms_file_path}")
+        return histograms
 
     # this method is called from engines.py and takes care of 
     # running all other methods. 
     def run_optigan(self):
-        # store all the processed events in a dictionary format
-        # key: event id, value: all the particles belonging to that event
-        self.events = self.process_root_output_into_events()
-        self.extracted_events_details = self.extract_event_details()
-        # self.pretty_print_events()
-        # self.print_details_of_events()
-        self.save_optigan_inputs()
-        self.get_optigan_outputs()
+        self.metrics.reset()
+        result = None
+        with self.metrics.span("run_optigan"):
+            if self.pipeline_mode == "memory":
+                output_writers = [self.create_output_writer()] if self.write_outputs and self.keep_photons else []
+                if self.aggregate_response:
+                    output_writers.append(self.create_response_aggregator())
+                result = self.run_optigan_in_memory(output_writers)
+                if self.aggregate_response:
+                    print_response_summary(result['response'])
+            else:
+                with self.metrics.timed("segment"):
+                    self.find_events()
+                # self.pretty_print_events()
+                # self.print_details_of_events()
+                with self.metrics.timed("write_inputs"):
+                    self.save_optigan_inputs()
+                self.get_optigan_outputs()
+        self.metrics.print_report()
+        if self.instrumentation_summary_path is not None:
+            self.metrics.write_summary(self.instrumentation_summary_path)
+            print(f"Saved the instrumentation summary to {self.instrumentation_summary_path}")
+        return result
     
     def print_root_info(self):
-        self.events = self.process_root_output_into_events()
-        self.extracted_events_details = self.extract_event_details()
+        self.find_events()
         # self.pretty_print_events()
         self.print_details_of_events()
             
-    # this method will take the root file and extract gamma, electron
-    # and optical photon information from the file. 
-    def process_root_output_into_events(self):
-        print(f"This is inside OptiganHelpers class, the root file is {self.root_file_path}")
+    # branch with the particle types, PDGCode when it is stored (integers
+    # are faster to read and compare) and ParticleName otherwise
+    def find_particle_type_branch(self, root_tree):
+        return find_particle_type_branch(root_tree.keys(), self.root_file_path)
+
+    # reads the branches needed by optigan from the phase space tree
+    def read_phase_space_branches(self):
         file, root_tree = self.open_root_file()
 
         # save the particle co-ordinates and other information
+        # (the branches listed in OPTIGAN_POSITION_BRANCHES and the particle type)
         position_x = root_tree["Position_X"].array(library="np")
         position_y = root_tree["Position_Y"].array(library="np")
         position_z = root_tree["Position_Z"].array(library="np")
-        particle_types = root_tree["ParticleName"].array(library="np")
+        particle_type_branch = self.find_particle_type_branch(root_tree)
+        if self.branch_cache is not None and root_tree.categories_of(particle_type_branch) is not None:
+            # the particle names are cached as codes, only their categories are compared
+            particle_types = particle_codes(root_tree.categories_of(particle_type_branch))[
+                root_tree.read_branch(particle_type_branch, decode_strings=False)]
+        else:
+            particle_types = root_tree[particle_type_branch].array(library="np")
 
         file.close()
+        self.metrics.count("rows_read", len(particle_types))
 
-        # variables
-        events = {} # will store all the events 
-        current_event = []
-        event_id = 0
-
-        # flag to check if gamma is followed by electrons or photons
-        gamma_has_electrons_or_photons = False
-
-        # counts the occurence of optical photons in current event
-        optical_photon_count = 0
-
-        # process each particle and segregate into events
-        for index, (ptype, x, y, z) in enumerate(zip(particle_types, position_x, position_y, position_z)):
-            if ptype == "gamma":
-                # store the previous event if it started with a gamma
-                # and is followed by electrons or photons
-                if current_event and gamma_has_electrons_or_photons:
-                    current_event.append({'type': "opticalphoton", 'optical_photon_count': optical_photon_count})
-                    # print(f"The optical photon count is {optical_photon_count}")
-                    events[event_id] = current_event
-                    event_id += 1
-                    optical_photon_count = 0
-                # if it is a new event, add the gamma particle to it
-                current_event = [{'index': index, 'type': ptype, 'x':x, 'y':y, 'z': z}]
-                gamma_has_electrons_or_photons = False
-            elif ptype == "opticalphoton":
-                # if the particle is optical photon, just increment the count
-                optical_photon_count += 1
-                gamma_has_electrons_or_photons = True
-            elif ptype == "e-":
-                # Only add e- if there is an ongoing event (started by gamma)
-                if current_event:
-                    current_event.append({'index': index, 'type': ptype, 'x': x, 'y': y, 'z': z})
-                    gamma_has_electrons_or_photons = True
-
-        # print(f"Outside the for loop, the optical photon count is {optical_photon_count}")
-
-        # Store the last event if it is not empty
-        if len(current_event) > 1:
-            current_event.append({'type': "opticalphoton", 'optical_photon_count': optical_photon_count})
-            events[event_id] = current_event
-
-        # print(f"The length of events is {len(events)}") # debugging
-
-        return events
+        return particle_types, position_x, position_y, position_z
+
+    # this method will take the root file and extract gamma, electron
+    # and optical photon information from the file. 
+    def process_root_output_into_events(self):
+        print(f"This is inside OptiganHelpers class, the root file is {self.root_file_path}")
+        particle_types, position_x, position_y, position_z = self.read_phase_space_branches()
+        return process_particles_into_events(particle_types, position_x, position_y, position_z)
     
     # this method will divide the extracted information 
     # from above method to various events
     def extract_event_details(self):
-        event_details = []
-        for event_id, event in self.events.items():
-            # dictionary format to store each event
-            event_info = {
-                'gamma_position': None,
-                'electron_count': 0,
-                'optical_photon_count': 0
-            }
-
-            # loop through the particles in the event
-            for particle in event:
-                if particle['type'] == 'gamma':
-                    # save the position of the gamma particle
-                    event_info['gamma_position'] = (particle['x'], particle['y'], particle['z'])
-                elif particle['type'] == 'e-':
-                    # increment the count of electrons
-                    # FIX_ME: maybe implement this in process_roo_output func
-                    event_info['electron_count'] += 1
-                elif particle['type'] == "opticalphoton":
-                    event_info['optical_photon_count'] = particle['optical_photon_count'] 
-
-            if event_info['optical_photon_count'] != 0:
-                event_details.append(event_info)
-
-        return event_details
-          
-        # print(f"This is for test.\nThe length of position_x, position_y, position_z, and particle_type are {len(position_x)}, {len(position_y)}, {len(position_z)}, and {len(particle_types)}")
-        
-        
+        return extract_event_details(self.events)
+
+    # vectorized equivalent of process_root_output_into_events + extract_event_details,
+    # it does not fill self.events (only needed by pretty_print_events)
+    def extract_event_details_vectorized(self):
+        return event_table_to_details(self.segment_events_vectorized())
+
+    # same as above but streams the phase space with uproot.iterate, so the
+    # memory used is proportional to self.step_size and not to the file size
+    def extract_event_details_streaming(self):
+        return event_table_to_details(self.segment_events_streaming())
 
+    # event table of the phase space loaded in memory at once
+    def segment_events_vectorized(self):
+        print(f"This is inside OptiganHelpers class, the root file is {self.root_file_path}")
+        particle_types, position_x, position_y, position_z = self.read_phase_space_branches()
+        return segment_events(particle_types, position_x, position_y, position_z)
+
+    # event table of the phase space read chunk by chunk
+    def segment_events_streaming(self):
+        print(f"This is inside OptiganHelpers class, the root file is {self.root_file_path}")
+        event_table, number_of_rows = segment_root_file(self.root_file_path, "Phase", self.step_size, self.branch_cache)
+        self.metrics.count("rows_read", number_of_rows)
+        return event_table
+
+    # returns the event table (see optigan_segmentation.segment_events)
+    # of the phase space with the selected segmentation
+    def find_event_table(self):
+        if self.use_event_index:
+            event_table = load_event_index(self.root_file_path, "Phase", self.step_size or DEFAULT_STEP_SIZE).event_table()
+        elif self.step_size is not None:
+            event_table = self.segment_events_streaming()
+        elif self.use_vectorized_segmentation:
+            event_table = self.segment_events_vectorized()
+        else:
+            self.events = self.process_root_output_into_events()
+            event_table = event_details_to_table(self.extract_event_details())
+        self.metrics.count("events_found", len(event_table['optical_photon_count']))
+        return event_table
+
+    # fills self.extracted_events_details with the selected segmentation
+    def find_events(self):
+        if self.use_vectorized_segmentation or self.step_size is not None or self.use_event_index:
+            self.event_table = self.find_event_table()
+            self.extracted_events_details = event_table_to_details(self.event_table)
+        else:
+            # store all the processed events in a dictionary format
+            # key: event id, value: all the particles belonging to that event
+            self.events = self.process_root_output_into_events()
+            self.extracted_events_details = self.extract_event_details()
+            self.event_table = event_details_to_table(self.extracted_events_details)
+            self.metrics.count("events_found", len(self.extracted_events_details))
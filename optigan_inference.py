@@ -0,0 +1,241 @@
+import copy
+from functools import lru_cache
+
+import numpy as np
+
+from pipeline_instrumentation import Instrumentation, peak_memory_mb
+
+# maximum number of photons (rows) given to the generator in one forward pass
+DEFAULT_MAX_BATCH_ROWS = 65536
+
+# numerical precision of the generator
+# - float32: the trained weights as they are
+# - bfloat16: weights and activations in bfloat16
+# - dynamic_int8: Linear layers quantized to int8 (weights), activations quantized on the fly
+PRECISIONS = ("float32", "bfloat16", "dynamic_int8")
+
+
+# groups consecutive events into batches of at most max_batch_rows photons,
+# returns the (first_event, last_event) boundaries of every batch.
+# an event with more photons than max_batch_rows is a batch on its own.
+def split_events_into_batches(optical_photon_counts, max_batch_rows=DEFAULT_MAX_BATCH_ROWS):
+    batches = []
+    first_event = 0
+    batch_rows = 0
+    for event_index, optical_photon_count in enumerate(optical_photon_counts):
+        if batch_rows > 0 and batch_rows + optical_photon_count > max_batch_rows:
+            batches.append((first_event, event_index))
+            first_event = event_index
+            batch_rows = 0
+        batch_rows += optical_photon_count
+    if first_event < len(optical_photon_counts):
+        batches.append((first_event, len(optical_photon_counts)))
+    return batches
+
+
+# creates the random generator used for the noise, None keeps the global torch one
+def create_random_generator(seed=None):
+    if seed is None:
+        return None
+    import torch
+    return torch.Generator().manual_seed(seed)
+
+
+# runs the generator on many events at once. the gamma position of every event
+# is repeated once per optical photon and concatenated with the noise, so one
+# forward pass covers all the events of a batch. yields for each batch a
+# dictionary with:
+# - first_event: index of the first event of the batch
+# - offsets: photons of event first_event + i are photons[offsets[i]:offsets[i + 1]]
+# - photons: (number of photons, output dimension) array
+def generate_optigan_batches(generator, gamma_positions, optical_photon_counts, noise_dimension,
+                             max_batch_rows=DEFAULT_MAX_BATCH_ROWS, random_generator=None, number_of_threads=None):
+    import torch
+
+    gamma_positions = np.asarray(gamma_positions, dtype=np.float32).reshape(-1, 3)
+    optical_photon_counts = np.asarray(optical_photon_counts, dtype=np.int64)
+
+    # the thread count of the process is restored once the batches are done (or dropped)
+    previous_number_of_threads = torch.get_num_threads()
+    if number_of_threads is not None:
+        torch.set_num_threads(number_of_threads)
+    try:
+        for first_event, last_event in split_events_into_batches(optical_photon_counts, max_batch_rows):
+            batch_counts = optical_photon_counts[first_event:last_event]
+            offsets = np.concatenate([[0], np.cumsum(batch_counts)])
+
+            # conditions of every photon, then noise and conditions in one tensor
+            conditions = torch.from_numpy(np.repeat(gamma_positions[first_event:last_event], batch_counts, axis=0))
+            noise = torch.randn(int(offsets[-1]), noise_dimension, generator=random_generator)
+            generator_input = torch.cat((noise, conditions), dim=1)
+
+            with torch.inference_mode():
+                generated_data = generator(generator_input)
+
+            yield {
+                'first_event': first_event,
+                'offsets': offsets,
+                'photons': generated_data.cpu().numpy(),
+            }
+    finally:
+        torch.set_num_threads(previous_number_of_threads)
+
+
+# splits a batch from generate_optigan_batches back into its events,
+# yields (event_index, photons of the event)
+def split_batch_by_event(batch):
+    offsets = batch['offsets']
+    for i in range(len(offsets) - 1):
+        yield batch['first_event'] + i, batch['photons'][offsets[i]:offsets[i + 1]]
+
+
+# runs a generator in bfloat16 and returns float32 photons, the class is
+# defined on first use like optigan_models.WGAN_Generator
+@lru_cache(maxsize=None)
+def get_bfloat16_generator_class():
+    import torch
+    import torch.nn as nn
+
+    class Bfloat16Generator(nn.Module):
+
+        def __init__(self, generator):
+            super().__init__()
+            self.generator = copy.deepcopy(generator).to(torch.bfloat16)
+
+        def forward(self, x):
+            return self.generator(x.to(torch.bfloat16)).float()
+
+    Bfloat16Generator.__qualname__ = "Bfloat16Generator"
+    return Bfloat16Generator
+
+
+# optigan_inference.Bfloat16Generator is still available, defined on first access
+def __getattr__(name):
+    if name == "Bfloat16Generator":
+        return get_bfloat16_generator_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# how the optigan stage runs on the cpu: number of intra-op threads, seed of the
+# noise, maximum number of photons per forward pass and precision of the generator
+class OptiganExecutionProfile:
+
+    def __init__(self, number_of_threads=None, seed=None, max_batch_rows=DEFAULT_MAX_BATCH_ROWS, precision="float32"):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown optigan precision '{precision}', use one of {PRECISIONS}")
+        self.number_of_threads = number_of_threads
+        self.seed = seed
+        self.max_batch_rows = max_batch_rows
+        self.precision = precision
+
+    # generator with the precision of the profile, the given generator is not modified
+    def prepare_generator(self, generator):
+        if self.precision == "float32":
+            return generator
+        import torch
+        import torch.nn as nn
+
+        if isinstance(generator, torch.jit.ScriptModule):
+            raise ValueError(f"The {self.precision} precision needs the python generator, not the TorchScript one")
+        if self.precision == "bfloat16":
+            return get_bfloat16_generator_class()(generator).eval()
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(generator), {nn.Linear}, dtype=torch.qint8).eval()
+
+    def description(self):
+        import torch
+
+        return {
+            "number_of_threads": self.number_of_threads if self.number_of_threads is not None else torch.get_num_threads(),
+            "seed": self.seed,
+            "max_batch_rows": self.max_batch_rows,
+            "precision": self.precision,
+        }
+
+
+# instrumentation of the optigan stage: spans of the stages (segment, load,
+# generate, write, ...), events and photons generated, peak memory
+class OptiganStageMetrics(Instrumentation):
+
+    def timed(self, stage):
+        return self.span(stage)
+
+    @property
+    def number_of_events(self):
+        return self.counters.get("events_generated", 0)
+
+    @property
+    def number_of_photons(self):
+        return self.counters.get("photons_generated", 0)
+
+    # wraps the batches of generate_optigan_batches: the time to produce every
+    # batch counts as "generate", the time of the caller's loop body does not
+    def timed_batches(self, batches):
+        batches = iter(batches)
+        while True:
+            with self.span("generate"):
+                batch = next(batches, None)
+            if batch is None:
+                return
+            self.count("events_generated", len(batch['offsets']) - 1)
+            self.count("photons_generated", len(batch['photons']))
+            yield batch
+
+    # seconds of every stage (whatever their parent span), photons per second of generation and peak memory
+    def report(self):
+        stage_names = []
+        for span_path in self.spans:
+            stage_name = span_path.rsplit("/", 1)[-1]
+            if stage_name not in stage_names:
+                stage_names.append(stage_name)
+        generate_seconds = self.span_seconds("generate")
+        return {
+            "seconds": {stage_name: self.span_seconds(stage_name) for stage_name in stage_names},
+            "number_of_events": self.number_of_events,
+            "number_of_photons": self.number_of_photons,
+            "photons_per_second": self.number_of_photons / generate_seconds if generate_seconds > 0 else None,
+            "peak_memory_mb": peak_memory_mb(),
+            "instrumentation": self.summary(),
+        }
+
+    def print_report(self):
+        report = self.report()
+        print(f"Optigan stage: {report['number_of_photons']} photons for {report['number_of_events']} events")
+        self.print_summary()
+        if report["photons_per_second"] is not None:
+            print(f"{report['photons_per_second']:.0f} photons per second")
+
+
+# checks that a profile (e.g. bfloat16 or dynamic_int8) keeps the distributions of
+# the generated photons: the reference generator and the generator of the profile
+# get the same noise and conditions, and every output column is compared with the
+# binned KS distance (dataset_comparison.compare_histograms) on shared bin edges.
+# returns column -> {ks, wasserstein, max_abs_difference} and whether all ks <= tolerance.
+def check_profile_distributions(generator, profile, gamma_positions, optical_photon_counts, noise_dimension,
+                                column_names, tolerance=0.01, number_of_bins=100, seed=0):
+    from dataset_comparison import compare_histograms
+    from root_histograms import uniform_bin_counts
+
+    outputs = []
+    for candidate_generator in (generator, profile.prepare_generator(generator)):
+        batches = generate_optigan_batches(candidate_generator, gamma_positions, optical_photon_counts, noise_dimension,
+                                           profile.max_batch_rows, create_random_generator(seed), profile.number_of_threads)
+        outputs.append(np.concatenate([batch['photons'] for batch in batches]))
+    reference, candidate = outputs
+
+    minimum = np.minimum(reference.min(axis=0), candidate.min(axis=0)).astype(np.float64)
+    maximum = np.maximum(reference.max(axis=0), candidate.max(axis=0)).astype(np.float64)
+    maximum = np.where(maximum > minimum, maximum, minimum + 1)
+    edges = np.linspace(minimum, maximum, number_of_bins + 1, axis=1)
+    reference_counts = np.stack([uniform_bin_counts(reference[:, i], edges[i])[0] for i in range(len(column_names))])
+    candidate_counts = np.stack([uniform_bin_counts(candidate[:, i], edges[i])[0] for i in range(len(column_names))])
+    statistics = compare_histograms(reference_counts, candidate_counts, edges)
+
+    columns = {
+        column: {
+            "ks": float(statistics["ks"][i]),
+            "wasserstein": float(statistics["wasserstein"][i]),
+            "max_abs_difference": float(np.abs(reference[:, i] - candidate[:, i]).max()),
+        }
+        for i, column in enumerate(column_names)
+    }
+    return columns, all(column["ks"] <= tolerance for column in columns.values())
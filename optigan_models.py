@@ -0,0 +1,201 @@
+import os
+import warnings
+from functools import lru_cache
+
+# columns of the photons generated by optigan
+OPTIGAN_OUTPUT_COLUMNS = ['X', 'Y', 'dX', 'dY', 'dZ', 'Ekine']
+
+# dimensions of the generator (model_3341.pt)
+NOISE_DIMENSION = 10
+HIDDEN_DIMENSION = 128
+LABELS_LENGTH = 3
+
+# range in MeV of the kinetic energy (Ekine) of the generated photons (1 to 5 eV
+# optical photons), gives the fixed bins of the response (see optigan_aggregation.py)
+OPTICAL_PHOTON_ENERGY_RANGE_MEV = (1e-6, 5e-6)
+
+# maximum number of generators kept loaded in a process
+MODEL_CACHE_SIZE = 4
+
+# suffix of the TorchScript (frozen) export written next to a checkpoint
+TORCHSCRIPT_SUFFIX = ".torchscript.pt"
+
+
+# Generator class architecture for 3x3x3 crystal. torch is only imported when the
+# class is first needed, so the model registry below can be used without it
+@lru_cache(maxsize=None)
+def get_wgan_generator_class():
+    import torch.nn as nn
+
+    class WGAN_Generator(nn.Module):
+
+        def __init__(self, input_dim, output_dim, hidden_dim, labels_len):
+            super(WGAN_Generator, self).__init__()
+            self.model = nn.Sequential(nn.Linear(input_dim + labels_len, hidden_dim),
+                                       nn.ReLU(True),
+
+                                       nn.Linear(hidden_dim, 2 * hidden_dim),
+                                       nn.ReLU(True),
+
+                                       nn.Linear(2 * hidden_dim, 4 * hidden_dim),
+                                       nn.ReLU(True),
+
+                                       nn.Linear(4 * hidden_dim, output_dim),
+            )
+
+        def forward(self, x):
+            return self.model(x)
+
+    WGAN_Generator.__qualname__ = "WGAN_Generator"
+    return WGAN_Generator
+
+
+# optigan_models.WGAN_Generator is still available, defined on first access
+def __getattr__(name):
+    if name == "WGAN_Generator":
+        return get_wgan_generator_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# a trained generator: its checkpoint file (in the optigan models folder),
+# the crystal it was trained for, the dimensions of its architecture and the
+# energy range of the photons it generates
+class OptiganModel:
+
+    def __init__(self, name, file_name, crystal_size_mm, noise_dimension=NOISE_DIMENSION,
+                 hidden_dimension=HIDDEN_DIMENSION, labels_length=LABELS_LENGTH, output_columns=OPTIGAN_OUTPUT_COLUMNS,
+                 energy_range_mev=OPTICAL_PHOTON_ENERGY_RANGE_MEV):
+        self.name = name
+        self.file_name = file_name
+        self.crystal_size_mm = tuple(float(size) for size in crystal_size_mm)
+        self.noise_dimension = noise_dimension
+        self.hidden_dimension = hidden_dimension
+        self.labels_length = labels_length
+        self.output_columns = list(output_columns)
+        self.energy_range_mev = tuple(float(energy) for energy in energy_range_mev)
+
+    def create_generator(self):
+        return get_wgan_generator_class()(self.noise_dimension, len(self.output_columns), self.hidden_dimension, self.labels_length)
+
+    def __repr__(self):
+        return f"OptiganModel({self.name!r}, {self.file_name!r}, {self.crystal_size_mm!r})"
+
+
+# the models that can be used, like physics lists users pick
+# one by name or by the size of the simulated crystal
+OPTIGAN_MODELS = {}
+
+# this is one model (model_3341.pt) for 3*3*3 crystal dimension
+# which we have trained and is used as default model
+DEFAULT_OPTIGAN_MODEL_NAME = "model_3341"
+
+
+def register_optigan_model(optigan_model):
+    OPTIGAN_MODELS[optigan_model.name] = optigan_model
+    return optigan_model
+
+
+register_optigan_model(OptiganModel(DEFAULT_OPTIGAN_MODEL_NAME, "model_3341.pt", crystal_size_mm=(3, 3, 3)))
+
+
+# model of a name, or of a crystal size (x, y, z in mm), or the default one.
+# without a model trained for the exact size, the model of the same x, y section
+# (the face the photons are generated on) with the closest length is used with a
+# warning, e.g. the 3*3*3 model for the 3*3*20 crystal of dataset_simulation.py
+def find_optigan_model(model_name=None, crystal_size_mm=None):
+    if model_name is not None:
+        if model_name not in OPTIGAN_MODELS:
+            raise KeyError(f"Unknown optigan model '{model_name}', use one of {list(OPTIGAN_MODELS)}")
+        return OPTIGAN_MODELS[model_name]
+    if crystal_size_mm is not None:
+        crystal_size_mm = tuple(float(size) for size in crystal_size_mm)
+        for optigan_model in OPTIGAN_MODELS.values():
+            if optigan_model.crystal_size_mm == crystal_size_mm:
+                return optigan_model
+        same_section_models = [optigan_model for optigan_model in OPTIGAN_MODELS.values()
+                               if optigan_model.crystal_size_mm[:2] == crystal_size_mm[:2]]
+        if same_section_models:
+            optigan_model = min(same_section_models, key=lambda model: abs(model.crystal_size_mm[2] - crystal_size_mm[2]))
+            warnings.warn(f"No optigan model for a {crystal_size_mm} mm crystal, using {optigan_model.name} trained "
+                          f"for a {optigan_model.crystal_size_mm} mm crystal of the same section")
+            return optigan_model
+        available_sizes = {name: optigan_model.crystal_size_mm for name, optigan_model in OPTIGAN_MODELS.items()}
+        raise KeyError(f"No optigan model for a {crystal_size_mm} mm crystal, the models are trained for {available_sizes}")
+    return OPTIGAN_MODELS[DEFAULT_OPTIGAN_MODEL_NAME]
+
+
+# loads the model with pre-trained weights, ready for inference
+def load_generator_checkpoint(optigan_model, model_file_path, device=None, verbose=True):
+    import torch
+
+    if device is None:
+        device = torch.device("cpu")
+    # Load the saved model checkpoint
+    checkpoint = torch.load(model_file_path, map_location = device)
+
+    # Initialize the model
+    generator = optigan_model.create_generator()
+
+    if verbose:
+        # Print model and checkpoint state_dict sizes
+        print("Model's state_dict:")
+        for param_tensor in generator.state_dict():
+            print(param_tensor, "\t", generator.state_dict()[param_tensor].size())
+
+        print("\nCheckpoint's state_dict:")
+        for param_tensor in checkpoint['generator_state_dict']:
+            print(param_tensor, "\t", checkpoint['generator_state_dict'][param_tensor].size())
+
+    # Load the state_dict into the model
+    generator.load_state_dict(checkpoint['generator_state_dict'])
+
+    # Move the model to the appropriate device
+    generator.to(device)
+
+    # Set the model to evaluation mode
+    generator.eval()
+
+    return generator
+
+
+# traces and freezes the generator, the TorchScript module starts without
+# building the python model and runs without the python layer calls
+def export_torchscript(generator, optigan_model, torchscript_file_path):
+    import torch
+
+    example_input = torch.zeros(1, optigan_model.noise_dimension + optigan_model.labels_length)
+    with torch.inference_mode():
+        scripted_generator = torch.jit.freeze(torch.jit.trace(generator.eval(), example_input))
+    torch.jit.save(scripted_generator, torchscript_file_path)
+    return scripted_generator
+
+
+# loads (and caches) the generator of a model. with use_torchscript the frozen
+# export next to the checkpoint is loaded instead, it is (re)written when it
+# is missing or older than the checkpoint.
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_cached_generator(model_name, model_file_path, device_name="cpu", use_torchscript=False):
+    import torch
+
+    optigan_model = OPTIGAN_MODELS[model_name]
+    device = torch.device(device_name)
+    if not use_torchscript:
+        return load_generator_checkpoint(optigan_model, model_file_path, device)
+
+    torchscript_file_path = model_file_path + TORCHSCRIPT_SUFFIX
+    if os.path.exists(torchscript_file_path) and os.path.getmtime(torchscript_file_path) >= os.path.getmtime(model_file_path):
+        print(f"Loading the TorchScript generator {torchscript_file_path}")
+        return torch.jit.load(torchscript_file_path, map_location=device)
+    generator = load_generator_checkpoint(optigan_model, model_file_path, device)
+    print(f"Exporting the TorchScript generator to {torchscript_file_path}")
+    return export_torchscript(generator, optigan_model, torchscript_file_path)
+
+
+# generator of a model of the models folder, loaded once per process
+def get_optigan_generator(optigan_model, optigan_model_folder, device=None, use_torchscript=False):
+    model_file_path = os.path.abspath(os.path.join(optigan_model_folder, optigan_model.file_name))
+    return load_cached_generator(optigan_model.name, model_file_path, "cpu" if device is None else str(device), use_torchscript)
+
+
+def clear_model_cache():
+    load_cached_generator.cache_clear()
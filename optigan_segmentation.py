@@ -0,0 +1,349 @@
+import numpy as np
+import uproot
+
+from root_streaming import DEFAULT_STEP_SIZE, iterate_tree_chunks
+
+# particle names as written by the PhaseSpaceActor in the "ParticleName" branch
+GAMMA = "gamma"
+ELECTRON = "e-"
+OPTICAL_PHOTON = "opticalphoton"
+
+# the same particles in the "PDGCode" branch (stored instead of
+# ParticleName by the compact output profiles of dataset_simulation)
+PARTICLE_PDG_CODES = {
+    GAMMA: 22,
+    ELECTRON: 11,
+    OPTICAL_PHOTON: -22,
+}
+
+# branches holding the particle type, in order of preference: the integer
+# codes are smaller to read and faster to compare than the names
+PARTICLE_TYPE_BRANCHES = ["PDGCode", "ParticleName"]
+
+# branches of the phase space tree with the particle positions
+OPTIGAN_POSITION_BRANCHES = ["Position_X", "Position_Y", "Position_Z"]
+
+# code of the particles that are neither gamma, e- nor optical photon
+# when the particle types are given as names
+OTHER_PARTICLE_CODE = 0
+
+
+# particle types as an integer array of PDG codes. names are mapped once per
+# distinct name, not once per row, other particles get OTHER_PARTICLE_CODE.
+# pd.factorize gives the same inverse and distinct names as np.unique(return_inverse=True)
+# but with a hash table: np.unique sorts the python strings of the object array
+# uproot returns, which is slower than the string comparisons it replaces.
+# pandas is only imported for names, reading PDGCode does not pay its import.
+def particle_codes(particle_types):
+    particle_types = np.asarray(particle_types)
+    if particle_types.dtype.kind in "iu":
+        return particle_types
+    import pandas as pd
+    inverse, names = pd.factorize(particle_types)
+    name_codes = np.array([PARTICLE_PDG_CODES.get(name, OTHER_PARTICLE_CODE) for name in names], dtype=np.int32)
+    return name_codes[inverse]
+
+
+# gamma, electron and optical photon masks of particle types given
+# either as names (ParticleName) or as integer codes (PDGCode)
+def particle_masks(particle_types):
+    codes = particle_codes(particle_types)
+    return tuple(codes == PARTICLE_PDG_CODES[particle] for particle in (GAMMA, ELECTRON, OPTICAL_PHOTON))
+
+
+# this is the reference (row by row) implementation, it takes the
+# phase space branches and groups the particles into events.
+# key: event id, value: all the particles belonging to that event
+def process_particles_into_events(particle_types, position_x, position_y, position_z):
+    # the particle types are compared as codes (python ints), not as strings
+    particle_types = particle_codes(particle_types).tolist()
+    gamma_code = PARTICLE_PDG_CODES[GAMMA]
+    electron_code = PARTICLE_PDG_CODES[ELECTRON]
+    optical_photon_code = PARTICLE_PDG_CODES[OPTICAL_PHOTON]
+    events = {} # will store all the events
+    current_event = []
+    event_id = 0
+
+    # flag to check if gamma is followed by electrons or photons
+    gamma_has_electrons_or_photons = False
+
+    # counts the occurence of optical photons in current event
+    optical_photon_count = 0
+
+    # process each particle and segregate into events
+    for index, (ptype, x, y, z) in enumerate(zip(particle_types, position_x, position_y, position_z)):
+        if ptype == gamma_code:
+            # store the previous event if it started with a gamma
+            # and is followed by electrons or photons
+            if current_event and gamma_has_electrons_or_photons:
+                current_event.append({'type': OPTICAL_PHOTON, 'optical_photon_count': optical_photon_count})
+                events[event_id] = current_event
+                event_id += 1
+                optical_photon_count = 0
+            # if it is a new event, add the gamma particle to it
+            current_event = [{'index': index, 'type': GAMMA, 'x':x, 'y':y, 'z': z}]
+            gamma_has_electrons_or_photons = False
+        elif ptype == optical_photon_code:
+            # if the particle is optical photon, just increment the count
+            optical_photon_count += 1
+            gamma_has_electrons_or_photons = True
+        elif ptype == electron_code:
+            # Only add e- if there is an ongoing event (started by gamma)
+            if current_event:
+                current_event.append({'index': index, 'type': ELECTRON, 'x': x, 'y': y, 'z': z})
+                gamma_has_electrons_or_photons = True
+
+    # Store the last event if it is not empty
+    if len(current_event) > 1:
+        current_event.append({'type': OPTICAL_PHOTON, 'optical_photon_count': optical_photon_count})
+        events[event_id] = current_event
+
+    return events
+
+
+# reference implementation of the event summary, it reduces the events
+# from above function to gamma position, electron and photon counts
+def extract_event_details(events):
+    event_details = []
+    for event_id, event in events.items():
+        # dictionary format to store each event
+        event_info = {
+            'gamma_position': None,
+            'electron_count': 0,
+            'optical_photon_count': 0
+        }
+
+        # loop through the particles in the event
+        for particle in event:
+            if particle['type'] == GAMMA:
+                # save the position of the gamma particle
+                event_info['gamma_position'] = (particle['x'], particle['y'], particle['z'])
+            elif particle['type'] == ELECTRON:
+                # increment the count of electrons
+                event_info['electron_count'] += 1
+            elif particle['type'] == OPTICAL_PHOTON:
+                event_info['optical_photon_count'] = particle['optical_photon_count']
+
+        if event_info['optical_photon_count'] != 0:
+            event_details.append(event_info)
+
+    return event_details
+
+
+# vectorized version of process_particles_into_events + extract_event_details.
+# every gamma starts a segment that runs until the next gamma, the counts of
+# each segment are computed with np.add.reduceat instead of a python loop.
+# returns a dictionary of arrays (one entry per kept event):
+# - gamma_index: row of the gamma that starts the event
+# - gamma_position: (n, 3) array with the gamma position
+# - electron_count, optical_photon_count: per event counts
+def segment_events(particle_types, position_x, position_y, position_z):
+    is_gamma, is_electron, is_optical_photon = particle_masks(particle_types)
+    return segment_events_from_masks(is_gamma, is_electron, is_optical_photon, position_x, position_y, position_z)
+
+
+# same as above but takes boolean masks, so the caller can build
+# them from any particle type encoding
+def segment_events_from_masks(is_gamma, is_electron, is_optical_photon, position_x, position_y, position_z):
+    gamma_index = np.flatnonzero(is_gamma)
+
+    # without a gamma there is never an ongoing event
+    if len(gamma_index) == 0:
+        return empty_event_table()
+
+    electron_count = np.add.reduceat(np.asarray(is_electron, dtype=np.int64), gamma_index)
+    optical_photon_count = np.add.reduceat(np.asarray(is_optical_photon, dtype=np.int64), gamma_index)
+
+    # an event is stored when its gamma is followed by electrons or photons,
+    # the last one only when it contains at least one electron
+    is_stored = (electron_count + optical_photon_count) > 0
+    is_stored[-1] = electron_count[-1] > 0
+
+    # photons seen before the first gamma are never reset,
+    # so they end up in the first stored event
+    stored_index = np.flatnonzero(is_stored)
+    if len(stored_index) > 0:
+        optical_photon_count[stored_index[0]] += np.count_nonzero(is_optical_photon[:gamma_index[0]])
+
+    # events without optical photons are not given to optigan
+    keep = is_stored & (optical_photon_count != 0)
+    gamma_index = gamma_index[keep]
+
+    gamma_position = np.stack([
+        np.asarray(position_x)[gamma_index],
+        np.asarray(position_y)[gamma_index],
+        np.asarray(position_z)[gamma_index],
+    ], axis=1)
+
+    return {
+        'gamma_index': gamma_index,
+        'gamma_position': gamma_position,
+        'electron_count': electron_count[keep],
+        'optical_photon_count': optical_photon_count[keep],
+    }
+
+
+# event table without any event
+def empty_event_table():
+    return {
+        'gamma_index': np.zeros(0, dtype=np.int64),
+        'gamma_position': np.zeros((0, 3), dtype=np.float64),
+        'electron_count': np.zeros(0, dtype=np.int64),
+        'optical_photon_count': np.zeros(0, dtype=np.int64),
+    }
+
+
+# converts the event table into the list of dictionaries
+# returned by extract_event_details
+def event_table_to_details(event_table):
+    event_details = []
+    for gamma_position, electron_count, optical_photon_count in zip(event_table['gamma_position'],
+                                                                    event_table['electron_count'],
+                                                                    event_table['optical_photon_count']):
+        event_details.append({
+            'gamma_position': tuple(gamma_position),
+            'electron_count': int(electron_count),
+            'optical_photon_count': int(optical_photon_count),
+        })
+    return event_details
+
+
+# streaming version of segment_events, the phase space is given chunk by chunk
+# (in file order) and the event that is still open at the end of a chunk is
+# carried over to the next one, so an event whose gamma is in chunk N and
+# photons in chunk N+1 is counted like in the non streaming version.
+class StreamingEventSegmenter:
+
+    def __init__(self):
+        # photons seen before the first stored event (see segment_events_from_masks)
+        self.pending_optical_photon_count = 0
+        # event started by the last gamma seen, None before the first gamma
+        self.open_event = None
+        self.event_tables = []
+
+    # adds a chunk of the phase space, entry_start is the
+    # row of the first particle of the chunk in the tree
+    def update(self, particle_types, position_x, position_y, position_z, entry_start=0):
+        is_gamma, is_electron, is_optical_photon = particle_masks(particle_types)
+        self.update_from_masks(is_gamma, is_electron, is_optical_photon, position_x, position_y, position_z, entry_start)
+
+    def update_from_masks(self, is_gamma, is_electron, is_optical_photon, position_x, position_y, position_z, entry_start=0):
+        gamma_index = np.flatnonzero(is_gamma)
+        first_gamma = gamma_index[0] if len(gamma_index) > 0 else len(is_gamma)
+
+        # the particles before the first gamma of the chunk belong to the open event
+        head_electron_count = np.count_nonzero(is_electron[:first_gamma])
+        head_optical_photon_count = np.count_nonzero(is_optical_photon[:first_gamma])
+        if self.open_event is None:
+            self.pending_optical_photon_count += head_optical_photon_count
+        else:
+            self.open_event['electron_count'] += head_electron_count
+            self.open_event['optical_photon_count'] += head_optical_photon_count
+
+        if len(gamma_index) == 0:
+            return
+
+        electron_count = np.add.reduceat(np.asarray(is_electron, dtype=np.int64), gamma_index)
+        optical_photon_count = np.add.reduceat(np.asarray(is_optical_photon, dtype=np.int64), gamma_index)
+        gamma_position = np.stack([
+            np.asarray(position_x)[gamma_index],
+            np.asarray(position_y)[gamma_index],
+            np.asarray(position_z)[gamma_index],
+        ], axis=1)
+        gamma_index = gamma_index + entry_start
+
+        # the open event is closed by the first gamma of the chunk,
+        # all the events of the chunk but the last one are complete
+        if self.open_event is not None:
+            gamma_index = np.concatenate([[self.open_event['gamma_index']], gamma_index])
+            gamma_position = np.concatenate([[self.open_event['gamma_position']], gamma_position])
+            electron_count = np.concatenate([[self.open_event['electron_count']], electron_count])
+            optical_photon_count = np.concatenate([[self.open_event['optical_photon_count']], optical_photon_count])
+
+        self.open_event = {
+            'gamma_index': gamma_index[-1],
+            'gamma_position': gamma_position[-1],
+            'electron_count': electron_count[-1],
+            'optical_photon_count': optical_photon_count[-1],
+        }
+
+        is_stored = (electron_count[:-1] + optical_photon_count[:-1]) > 0
+        self.store_events(gamma_index[:-1], gamma_position[:-1], electron_count[:-1], optical_photon_count[:-1], is_stored)
+
+    # keeps the stored events that have optical photons
+    def store_events(self, gamma_index, gamma_position, electron_count, optical_photon_count, is_stored):
+        stored_index = np.flatnonzero(is_stored)
+        if len(stored_index) == 0:
+            return
+        optical_photon_count = optical_photon_count.copy()
+        optical_photon_count[stored_index[0]] += self.pending_optical_photon_count
+        self.pending_optical_photon_count = 0
+
+        keep = is_stored & (optical_photon_count != 0)
+        self.event_tables.append({
+            'gamma_index': gamma_index[keep],
+            'gamma_position': gamma_position[keep],
+            'electron_count': electron_count[keep],
+            'optical_photon_count': optical_photon_count[keep],
+        })
+
+    # closes the last event (stored only if it has electrons)
+    # and returns the event table of the whole phase space
+    def finish(self):
+        if self.open_event is not None:
+            open_event = self.open_event
+            self.open_event = None
+            self.store_events(np.array([open_event['gamma_index']]),
+                              np.array([open_event['gamma_position']]),
+                              np.array([open_event['electron_count']]),
+                              np.array([open_event['optical_photon_count']]),
+                              np.array([open_event['electron_count'] > 0]))
+        return concatenate_event_tables(self.event_tables)
+
+
+# joins event tables in order
+def concatenate_event_tables(event_tables):
+    if not event_tables:
+        return empty_event_table()
+    return {key: np.concatenate([event_table[key] for event_table in event_tables])
+            for key in empty_event_table()}
+
+
+# converts the list of dictionaries returned by extract_event_details into
+# an event table (gamma_index is not known and set to -1)
+def event_details_to_table(event_details):
+    if not event_details:
+        return empty_event_table()
+    return {
+        'gamma_index': np.full(len(event_details), -1, dtype=np.int64),
+        'gamma_position': np.array([detail['gamma_position'] for detail in event_details], dtype=np.float64),
+        'electron_count': np.array([detail['electron_count'] for detail in event_details], dtype=np.int64),
+        'optical_photon_count': np.array([detail['optical_photon_count'] for detail in event_details], dtype=np.int64),
+    }
+
+
+# branch with the particle types among branch_names, PDGCode when it is
+# stored (integers are faster to read and compare) and ParticleName otherwise
+def find_particle_type_branch(branch_names, root_file_path=""):
+    for branch in PARTICLE_TYPE_BRANCHES:
+        if branch in branch_names:
+            return branch
+    raise KeyError(f"No particle type branch {PARTICLE_TYPE_BRANCHES} in the phase space of {root_file_path}")
+
+
+# event table of the phase space tree of a root file read chunk by chunk
+# (only needs numpy and uproot, not torch), or from its decoded branches with a
+# branch_cache (see branch_cache.py). returns the event table and the number of rows read
+def segment_root_file(root_file_path, tree_name="Phase", step_size=DEFAULT_STEP_SIZE, branch_cache=None):
+    if branch_cache is not None:
+        particle_type_branch = find_particle_type_branch(branch_cache.open_tree(root_file_path, tree_name).keys(), root_file_path)
+    else:
+        with uproot.open(root_file_path) as root_file:
+            particle_type_branch = find_particle_type_branch(root_file[tree_name].keys(), root_file_path)
+    segmenter = StreamingEventSegmenter()
+    number_of_rows = 0
+    branches = [particle_type_branch] + OPTIGAN_POSITION_BRANCHES
+    for entry_start, arrays in iterate_tree_chunks(root_file_path, tree_name, branches, step_size, branch_cache=branch_cache):
+        segmenter.update(arrays[particle_type_branch], arrays["Position_X"], arrays["Position_Y"], arrays["Position_Z"], entry_start)
+        number_of_rows += len(arrays[particle_type_branch])
+    return segmenter.finish(), number_of_rows
@@ -0,0 +1,182 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import uproot
+
+# storage formats of the optigan inputs and outputs
+# - csv: one csv file per event (original format)
+# - root: one root file with one entry per event (inputs) or per photon
+#   (outputs) and an event index, any range of events can be read alone
+STORAGE_FORMATS = ("csv", "root")
+
+OPTIGAN_INPUTS_FILE_NAME = "optigan_inputs.root"
+OPTIGAN_INPUTS_TREE_NAME = "OptiganInputs"
+OPTIGAN_OUTPUTS_FILE_NAME = "optigan_outputs.root"
+OPTIGAN_OUTPUTS_TREE_NAME = "OptiganOutputs"
+EVENT_INDEX_TREE_NAME = "EventIndex"
+
+
+def check_storage_format(storage_format):
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError(f"Unknown optigan storage format '{storage_format}', use one of {STORAGE_FORMATS}")
+
+
+def extract_number(filename):
+    match = re.search(r'\d+', filename)
+    if match:
+        return int(match.group())
+    return 0
+
+
+# sorted list of the optigan_input_{event_id}.csv files of the folder
+def list_optigan_input_csv_files(optigan_input_folder):
+    return sorted([file for file in os.listdir(optigan_input_folder) if file.endswith('.csv')], key=extract_number)
+
+
+# writes one csv file per event (original format)
+def write_optigan_inputs_csv(optigan_input_folder, gamma_positions, optical_photon_counts):
+    for event_id, (gamma_position, num_optical_photons) in enumerate(zip(gamma_positions, optical_photon_counts)):
+        filepath = os.path.join(optigan_input_folder, f"optigan_input_{event_id}.csv")
+        data = {
+            "gamma_pos_x": [gamma_position[0]],
+            "gamma_pos_y": [gamma_position[1]],
+            "gamma_pos_z": [gamma_position[2]],
+            "num_optical_photons": [num_optical_photons]
+        }
+        pd.DataFrame(data).to_csv(filepath, index=False)
+
+
+# reads the events [first_event, last_event) of the csv inputs,
+# returns the (n, 3) gamma positions and the optical photon counts
+def read_optigan_inputs_csv(optigan_input_folder, first_event=0, last_event=None):
+    csv_files = list_optigan_input_csv_files(optigan_input_folder)[first_event:last_event]
+    gamma_positions = np.zeros((len(csv_files), 3), dtype=np.float64)
+    optical_photon_counts = np.zeros(len(csv_files), dtype=np.int64)
+    for i, file_name in enumerate(csv_files):
+        df = pd.read_csv(os.path.join(optigan_input_folder, file_name))
+        gamma_positions[i] = df[["gamma_pos_x", "gamma_pos_y", "gamma_pos_z"]].values[0]
+        optical_photon_counts[i] = df["num_optical_photons"].values[0]
+    return gamma_positions, optical_photon_counts
+
+
+# writes all the events in one tree, entry i is event i
+def write_optigan_inputs_root(optigan_inputs_file_path, gamma_positions, optical_photon_counts):
+    gamma_positions = np.asarray(gamma_positions, dtype=np.float64).reshape(-1, 3)
+    with uproot.recreate(optigan_inputs_file_path) as root_file:
+        root_file[OPTIGAN_INPUTS_TREE_NAME] = {
+            "gamma_pos_x": gamma_positions[:, 0],
+            "gamma_pos_y": gamma_positions[:, 1],
+            "gamma_pos_z": gamma_positions[:, 2],
+            "num_optical_photons": np.asarray(optical_photon_counts, dtype=np.int64),
+        }
+
+
+# reads the events [first_event, last_event) of the root inputs,
+# only the baskets of these entries are decompressed
+def read_optigan_inputs_root(optigan_inputs_file_path, first_event=0, last_event=None):
+    with uproot.open(optigan_inputs_file_path) as root_file:
+        arrays = root_file[OPTIGAN_INPUTS_TREE_NAME].arrays(library="np", entry_start=first_event, entry_stop=last_event)
+    gamma_positions = np.stack([arrays["gamma_pos_x"], arrays["gamma_pos_y"], arrays["gamma_pos_z"]], axis=1)
+    return gamma_positions, arrays["num_optical_photons"].astype(np.int64)
+
+
+# writes the generated photons of many events in one tree (one entry per
+# photon) and, when closed, an index tree with the photon entry range of
+# each event. events must be given in order, batch by batch.
+class OptiganOutputWriter:
+
+    def __init__(self, optigan_outputs_file_path, column_names):
+        self.optigan_outputs_file_path = optigan_outputs_file_path
+        self.column_names = column_names
+        self.root_file = uproot.recreate(optigan_outputs_file_path)
+        self.tree_created = False
+        self.number_of_photons = 0
+        self.event_ids = []
+        self.photon_counts = []
+
+    # photons holds the photons of the events first_event, first_event + 1, ...
+    # and offsets[i]:offsets[i + 1] the rows of event first_event + i. event_ids
+    # replaces these event ids, e.g. by the EventID of the phase space of the events
+    def write_batch(self, first_event, offsets, photons, event_ids=None):
+        photon_counts = np.diff(offsets)
+        if event_ids is None:
+            event_ids = first_event + np.arange(len(photon_counts), dtype=np.int64)
+        event_ids = np.asarray(event_ids, dtype=np.int64)
+        self.event_ids.append(event_ids)
+        self.photon_counts.append(photon_counts)
+        if len(photons) == 0:
+            return
+
+        chunk = {column: photons[:, i] for i, column in enumerate(self.column_names)}
+        chunk["EventID"] = np.repeat(event_ids, photon_counts)
+        if self.tree_created:
+            self.root_file[OPTIGAN_OUTPUTS_TREE_NAME].extend(chunk)
+        else:
+            self.root_file[OPTIGAN_OUTPUTS_TREE_NAME] = chunk
+            self.tree_created = True
+        self.number_of_photons += len(photons)
+
+    def close(self):
+        event_ids = np.concatenate(self.event_ids) if self.event_ids else np.zeros(0, dtype=np.int64)
+        photon_counts = np.concatenate(self.photon_counts) if self.photon_counts else np.zeros(0, dtype=np.int64)
+        entry_stop = np.cumsum(photon_counts)
+        self.root_file[EVENT_INDEX_TREE_NAME] = {
+            "EventID": event_ids,
+            "entry_start": entry_stop - photon_counts,
+            "entry_stop": entry_stop,
+        }
+        if not self.tree_created:
+            # same schema as the written photons: float32 photon columns and int64 event ids
+            empty_outputs = {column: np.zeros(0, dtype=np.float32) for column in self.column_names}
+            empty_outputs["EventID"] = np.zeros(0, dtype=np.int64)
+            self.root_file[OPTIGAN_OUTPUTS_TREE_NAME] = empty_outputs
+        self.root_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# writes the generated photons as one csv file per event (original format),
+# same interface as OptiganOutputWriter
+class OptiganCsvOutputWriter:
+
+    def __init__(self, optigan_csv_output_folder, column_names):
+        self.optigan_csv_output_folder = optigan_csv_output_folder
+        self.column_names = column_names
+        os.makedirs(optigan_csv_output_folder, exist_ok=True)
+
+    # the files are named by event index, event_ids is not used
+    def write_batch(self, first_event, offsets, photons, event_ids=None):
+        for i in range(len(offsets) - 1):
+            generated_df = pd.DataFrame(photons[offsets[i]:offsets[i + 1]], columns=self.column_names)
+            generated_df.to_csv(os.path.join(self.optigan_csv_output_folder, f"optigan_output_{first_event + i + 1}.csv"), index=False)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# reads the photons of the events [first_event, last_event) of the root outputs,
+# returns the photons as (n, number of columns) array and the offsets of each event
+def read_optigan_outputs_root(optigan_outputs_file_path, column_names, first_event=0, last_event=None):
+    with uproot.open(optigan_outputs_file_path) as root_file:
+        event_index = root_file[EVENT_INDEX_TREE_NAME].arrays(library="np", entry_start=first_event, entry_stop=last_event)
+        entry_start = event_index["entry_start"]
+        entry_stop = event_index["entry_stop"]
+        if len(entry_start) == 0:
+            return np.zeros((0, len(column_names)), dtype=np.float32), np.zeros(1, dtype=np.int64)
+        arrays = root_file[OPTIGAN_OUTPUTS_TREE_NAME].arrays(column_names, library="np",
+                                                              entry_start=int(entry_start[0]), entry_stop=int(entry_stop[-1]))
+    photons = np.stack([arrays[column] for column in column_names], axis=1)
+    offsets = np.concatenate([[0], entry_stop - entry_start[0]])
+    return photons, offsets
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import uproot
+
+from filter_cache import file_identity
+from optigan_segmentation import (
+    OPTIGAN_POSITION_BRANCHES,
+    StreamingEventSegmenter,
+    find_particle_type_branch,
+    particle_masks,
+)
+from root_streaming import DEFAULT_STEP_SIZE, iterate_tree_chunks, parse_step_size
+
+# the index of "file.root" is written next to it as "file.root.Phase.event_index.npz"
+EVENT_INDEX_SUFFIX = "event_index.npz"
+
+# bumped when the content of the index changes, older indexes are rebuilt
+EVENT_INDEX_VERSION = 1
+
+# counts of every event of the index, in the order of particle_masks
+EVENT_COUNTS = ["gamma_count", "electron_count", "optical_photon_count"]
+
+# events of the index:
+# - "event": runs of rows with the same EventID (an EventID written in several
+#   places, e.g. by several threads, has several runs)
+# - "gamma": rows from a gamma to the next one, the events of
+#   process_root_output_into_events (the rows before the first gamma are in none)
+EVENT_KINDS = ("event", "gamma")
+
+
+def get_event_index_path(root_file_path, tree_name="Phase", index_folder=None):
+    index_file_name = f"{os.path.basename(root_file_path)}.{tree_name}.{EVENT_INDEX_SUFFIX}"
+    return os.path.join(index_folder or os.path.dirname(os.path.abspath(root_file_path)), index_file_name)
+
+
+# collects the first row of every event while the tree is streamed, with the
+# number of gammas, electrons and optical photons seen before it, so the counts
+# of an event are the difference with the next event (or the totals)
+class EventBoundaries:
+
+    def __init__(self):
+        self.entry_starts = []
+        self.counts_before = []
+        self.values = []
+
+    def add(self, rows, entry_start, counts_before, values=None):
+        self.entry_starts.append(entry_start + rows)
+        self.counts_before.append(counts_before[rows])
+        if values is not None:
+            self.values.append(values)
+
+    # arrays of the events: entry_start, entry_stop and the EVENT_COUNTS
+    def finish(self, kind, number_of_entries, totals):
+        entry_starts = np.concatenate(self.entry_starts) if self.entry_starts else np.zeros(0, dtype=np.int64)
+        counts_before = np.concatenate(self.counts_before) if self.counts_before else np.zeros((0, len(EVENT_COUNTS)), dtype=np.int64)
+        entry_stops = np.append(entry_starts[1:], number_of_entries).astype(np.int64)
+        counts = np.vstack([counts_before[1:], totals]) - counts_before if len(entry_starts) > 0 else counts_before
+        arrays = {
+            f"{kind}_entry_start": entry_starts.astype(np.int64),
+            f"{kind}_entry_stop": entry_stops,
+        }
+        for i, count in enumerate(EVENT_COUNTS):
+            arrays[f"{kind}_{count}"] = counts[:, i]
+        return arrays
+
+
+# builds the index of the tree in one streamed pass: the entry ranges and counts of
+# the events by EventID (when the branch is stored) and by gamma, the gamma positions,
+# and the event table given to optigan (see optigan_segmentation.segment_events)
+def build_event_index(root_file_path, tree_name="Phase", step_size=DEFAULT_STEP_SIZE):
+    with uproot.open(root_file_path) as root_file:
+        tree = root_file[tree_name]
+        branch_names = tree.keys()
+        number_of_entries = tree.num_entries
+    particle_type_branch = find_particle_type_branch(branch_names, root_file_path)
+    has_event_id = "EventID" in branch_names
+    branches = [particle_type_branch] + OPTIGAN_POSITION_BRANCHES + (["EventID"] if has_event_id else [])
+
+    segmenter = StreamingEventSegmenter()
+    event_boundaries = EventBoundaries()
+    gamma_boundaries = EventBoundaries()
+    totals = np.zeros(len(EVENT_COUNTS), dtype=np.int64)
+    last_event_id = None
+    for entry_start, arrays in iterate_tree_chunks(root_file_path, tree_name, branches, step_size):
+        if len(arrays[particle_type_branch]) == 0:
+            continue
+        masks = particle_masks(arrays[particle_type_branch])
+        segmenter.update_from_masks(*masks, arrays["Position_X"], arrays["Position_Y"], arrays["Position_Z"], entry_start)
+
+        row_counts = np.stack(masks, axis=1).astype(np.int64)
+        counts_before = totals + np.cumsum(row_counts, axis=0) - row_counts
+        totals += row_counts.sum(axis=0)
+
+        gamma_rows = np.flatnonzero(masks[0])
+        gamma_positions = np.stack([np.asarray(arrays[branch])[gamma_rows] for branch in OPTIGAN_POSITION_BRANCHES], axis=1)
+        gamma_boundaries.add(gamma_rows, entry_start, counts_before, gamma_positions)
+
+        if has_event_id:
+            event_ids = np.asarray(arrays["EventID"])
+            is_first_row = np.empty(len(event_ids), dtype=bool)
+            is_first_row[0] = last_event_id is None or event_ids[0] != last_event_id
+            is_first_row[1:] = event_ids[1:] != event_ids[:-1]
+            event_rows = np.flatnonzero(is_first_row)
+            event_boundaries.add(event_rows, entry_start, counts_before, event_ids[event_rows])
+            last_event_id = event_ids[-1]
+
+    arrays = {}
+    if has_event_id:
+        arrays.update(event_boundaries.finish("event", number_of_entries, totals))
+        arrays["event_id"] = np.concatenate(event_boundaries.values).astype(np.int64) if event_boundaries.values else np.zeros(0, dtype=np.int64)
+    arrays.update(gamma_boundaries.finish("gamma", number_of_entries, totals))
+    arrays["gamma_position"] = np.concatenate(gamma_boundaries.values) if gamma_boundaries.values else np.zeros((0, 3), dtype=np.float64)
+    for key, values in segmenter.finish().items():
+        arrays[f"optigan_{key}"] = values
+
+    metadata = {
+        "version": EVENT_INDEX_VERSION,
+        "tree_name": tree_name,
+        "number_of_entries": int(number_of_entries),
+        "particle_type_branch": particle_type_branch,
+        "source_identity": file_identity(root_file_path),
+    }
+    return PhaseSpaceEventIndex(root_file_path, metadata, arrays)
+
+
+# sidecar index of the events of a phase space tree. it gives the entry range of
+# any event (by EventID or by gamma) and its counts, so an event or a range of events
+# is read with entry_start/entry_stop without reading the rows before it.
+class PhaseSpaceEventIndex:
+
+    def __init__(self, root_file_path, metadata, arrays):
+        self.root_file_path = root_file_path
+        self.metadata = metadata
+        self.arrays = arrays
+
+    @property
+    def tree_name(self):
+        return self.metadata["tree_name"]
+
+    @property
+    def number_of_entries(self):
+        return self.metadata["number_of_entries"]
+
+    @property
+    def has_event_ids(self):
+        return "event_id" in self.arrays
+
+    @property
+    def number_of_gamma_events(self):
+        return len(self.arrays["gamma_entry_start"])
+
+    # distinct EventIDs of the tree, sorted
+    def event_ids(self):
+        self.check_event_ids()
+        return np.unique(self.arrays["event_id"])
+
+    # entry_start, entry_stop and counts of the events of a kind (see EVENT_KINDS)
+    def event_summary(self, kind="event"):
+        if kind not in EVENT_KINDS:
+            raise ValueError(f"Unknown event kind '{kind}', use one of {EVENT_KINDS}")
+        if kind == "event":
+            self.check_event_ids()
+        summary = {name: self.arrays[f"{kind}_{name}"] for name in ["entry_start", "entry_stop"] + EVENT_COUNTS}
+        if kind == "event":
+            summary["event_id"] = self.arrays["event_id"]
+        else:
+            summary["gamma_position"] = self.arrays["gamma_position"]
+        return summary
+
+    # event table given to optigan, same as segment_events on the whole tree
+    def event_table(self):
+        return {key[len("optigan_"):]: values for key, values in self.arrays.items() if key.startswith("optigan_")}
+
+    def check_event_ids(self):
+        if not self.has_event_ids:
+            raise KeyError(f"The {self.tree_name} tree of {self.root_file_path} has no EventID branch, use the gamma events")
+
+    # entry ranges of the EventIDs [first_event_id, last_event_id), in order and
+    # merged when they follow each other (always one range without threads)
+    def event_entry_ranges(self, first_event_id, last_event_id=None):
+        self.check_event_ids()
+        if last_event_id is None:
+            last_event_id = first_event_id + 1
+        event_ids = self.arrays["event_id"]
+        selected = np.flatnonzero((event_ids >= first_event_id) & (event_ids < last_event_id))
+        entry_ranges = []
+        for entry_start, entry_stop in zip(self.arrays["event_entry_start"][selected], self.arrays["event_entry_stop"][selected]):
+            if entry_ranges and entry_ranges[-1][1] == entry_start:
+                entry_ranges[-1] = (entry_ranges[-1][0], int(entry_stop))
+            else:
+                entry_ranges.append((int(entry_start), int(entry_stop)))
+        return entry_ranges
+
+    # entry range of the gamma events [first_event, last_event)
+    def gamma_event_entry_range(self, first_event, last_event=None):
+        if last_event is None:
+            last_event = first_event + 1
+        first_event, last_event, _ = slice(first_event, last_event).indices(self.number_of_gamma_events)
+        if first_event >= last_event:
+            return (0, 0)
+        return (int(self.arrays["gamma_entry_start"][first_event]), int(self.arrays["gamma_entry_stop"][last_event - 1]))
+
+    # branches of the rows of the entry ranges, as a dictionary of arrays
+    def read_entry_ranges(self, entry_ranges, branches=None):
+        with uproot.open(self.root_file_path) as root_file:
+            tree = root_file[self.tree_name]
+            chunks = [tree.arrays(branches, entry_start=entry_start, entry_stop=entry_stop, library="np")
+                      for entry_start, entry_stop in entry_ranges]
+            if not chunks:
+                chunks = [tree.arrays(branches, entry_start=0, entry_stop=0, library="np")]
+        return {branch: np.concatenate([chunk[branch] for chunk in chunks]) for branch in chunks[0]}
+
+    # rows of the EventIDs [first_event_id, last_event_id)
+    def read_events(self, first_event_id, last_event_id=None, branches=None):
+        return self.read_entry_ranges(self.event_entry_ranges(first_event_id, last_event_id), branches)
+
+    # rows of the gamma events [first_event, last_event)
+    def read_gamma_events(self, first_event, last_event=None, branches=None):
+        return self.read_entry_ranges([self.gamma_event_entry_range(first_event, last_event)], branches)
+
+    # the index is up to date when the root file did not change since it was built
+    def is_up_to_date(self):
+        return (self.metadata.get("version") == EVENT_INDEX_VERSION
+                and os.path.exists(self.root_file_path)
+                and self.metadata.get("source_identity") == file_identity(self.root_file_path))
+
+    # written in a temporary file first, so an interrupted run keeps the old index
+    def save(self, index_file_path):
+        os.makedirs(os.path.dirname(os.path.abspath(index_file_path)), exist_ok=True)
+        temporary_file_path = f"{index_file_path}.tmp"
+        with open(temporary_file_path, "wb") as index_file:
+            np.savez(index_file, metadata=np.array(json.dumps(self.metadata)), **self.arrays)
+        os.replace(temporary_file_path, index_file_path)
+
+    @classmethod
+    def load(cls, root_file_path, index_file_path):
+        with np.load(index_file_path) as index_file:
+            arrays = {key: index_file[key] for key in index_file.files if key != "metadata"}
+            metadata = json.loads(str(index_file["metadata"]))
+        return cls(root_file_path, metadata, arrays)
+
+
+# event index of a tree when it was already built and is up to date, None otherwise
+# (the tree is never read)
+def find_event_index(root_file_path, tree_name="Phase", index_folder=None):
+    index_file_path = get_event_index_path(root_file_path, tree_name, index_folder)
+    if not os.path.exists(index_file_path):
+        return None
+    event_index = PhaseSpaceEventIndex.load(root_file_path, index_file_path)
+    if event_index.is_up_to_date() and event_index.tree_name == tree_name:
+        return event_index
+    return None
+
+
+# index of the tree of a root file: the sidecar index is loaded when it is up to date,
+# otherwise (or with rebuild) the tree is indexed and the sidecar (re)written
+def load_event_index(root_file_path, tree_name="Phase", step_size=DEFAULT_STEP_SIZE, index_folder=None, rebuild=False):
+    index_file_path = get_event_index_path(root_file_path, tree_name, index_folder)
+    if not rebuild:
+        event_index = find_event_index(root_file_path, tree_name, index_folder)
+        if event_index is not None:
+            return event_index
+    event_index = build_event_index(root_file_path, tree_name, step_size)
+    event_index.save(index_file_path)
+    return event_index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds (once) the event index of a phase space root file and reads events with it")
+    parser.add_argument("root_file", help="phase space root file")
+    parser.add_argument("--tree", default="Phase", help="phase space tree (default: %(default)s)")
+    parser.add_argument("--step-size", default=DEFAULT_STEP_SIZE,
+                        help="entries (e.g. 100000) or memory size (e.g. '100 MB') read at once (default: %(default)s)")
+    parser.add_argument("--index-folder", default=None, help="folder of the index (default: next to the root file)")
+    parser.add_argument("--rebuild", action="store_true", help="index the tree again even if the index is up to date")
+    parser.add_argument("--event", type=int, nargs="+", default=None, metavar="EVENT_ID",
+                        help="prints the rows of an EventID, or of the EventIDs [first, last)")
+    parser.add_argument("--gamma-event", type=int, nargs="+", default=None, metavar="EVENT",
+                        help="prints the rows of a gamma event, or of the gamma events [first, last)")
+    parser.add_argument("--branches", nargs="+", default=None, help="branches printed (default: all)")
+    args = parser.parse_args()
+    for option, values in (("--event", args.event), ("--gamma-event", args.gamma_event)):
+        if values is not None and len(values) > 2:
+            parser.error(f"{option} takes one event or a range first last")
+
+    event_index = load_event_index(args.root_file, args.tree, parse_step_size(args.step_size), args.index_folder, args.rebuild)
+    print(f"{args.root_file}: {event_index.number_of_entries} rows, {event_index.number_of_gamma_events} gamma events, "
+          f"{len(event_index.event_table()['gamma_index'])} events given to optigan")
+    if event_index.has_event_ids:
+        print(f"{len(event_index.event_ids())} EventIDs in {len(event_index.arrays['event_id'])} runs of rows")
+
+    selections = []
+    if args.event is not None:
+        selections.append((f"EventID {args.event}", event_index.read_events(*args.event, branches=args.branches)))
+    if args.gamma_event is not None:
+        selections.append((f"gamma event {args.gamma_event}", event_index.read_gamma_events(*args.gamma_event, branches=args.branches)))
+    for name, rows in selections:
+        print(f"{name}: {len(next(iter(rows.values()))) if rows else 0} rows")
+        for branch, values in rows.items():
+            print(f"    {branch}: {values}")
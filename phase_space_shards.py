@@ -0,0 +1,86 @@
+import argparse
+import os
+import subprocess
+import sys
+
+import numpy as np
+import uproot
+
+from root_filter_engine import to_writable_array
+from root_streaming import DEFAULT_STEP_SIZE, RootTreeWriter, iterate_tree_chunks, parse_step_size
+
+
+# output file of a shard, "phase_space.root" -> "phase_space_shard3.root"
+def shard_output_filename(output_filename, shard_index):
+    stem, extension = os.path.splitext(output_filename)
+    return f"{stem}_shard{shard_index}{extension}"
+
+
+# distinct seeds of the shards. without a base seed, one is drawn from the
+# system entropy so two campaigns do not share their seeds.
+def shard_seeds(number_of_shards, seed=None):
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1)[0])
+    return [int(seed) + shard_index for shard_index in range(number_of_shards)]
+
+
+# run time slice [start, end) of each shard, the total run time is split in equal parts
+def shard_time_intervals(number_of_shards, start_time, end_time):
+    edges = np.linspace(start_time, end_time, number_of_shards + 1)
+    return [(float(edges[i]), float(edges[i + 1])) for i in range(number_of_shards)]
+
+
+# runs the script once per shard, as separate processes running at the same
+# time. shard_arguments[i] is the command line of shard i. raises if a shard fails.
+def launch_shards(script_path, shard_arguments):
+    processes = []
+    for shard_index, arguments in enumerate(shard_arguments):
+        print(f"Launching shard {shard_index}: {' '.join(arguments)}")
+        processes.append(subprocess.Popen([sys.executable, script_path] + list(arguments)))
+    failed_shards = [shard_index for shard_index, process in enumerate(processes) if process.wait() != 0]
+    if failed_shards:
+        raise RuntimeError(f"Shards {failed_shards} of {script_path} failed")
+
+
+# concatenates the phase space trees of the shards into one root file, chunk by
+# chunk. the event ids of every shard start after the last event id of the
+# previous shards, so events of different shards never share an id.
+# returns the number of entries written.
+def merge_phase_space_files(shard_root_file_paths, merged_root_file_path, tree_name="Phase",
+                            step_size=DEFAULT_STEP_SIZE, event_id_branch="EventID"):
+    event_id_offset = 0
+    with RootTreeWriter(merged_root_file_path, tree_name) as writer:
+        for shard_root_file_path in shard_root_file_paths:
+            with uproot.open(shard_root_file_path) as root_file:
+                tree = root_file[tree_name]
+                has_event_id = event_id_branch in tree.keys()
+                # an empty shard gives the schema if every shard is empty
+                if tree.num_entries == 0:
+                    arrays = tree.arrays(library="np")
+                    writer.write({branch: to_writable_array(array) for branch, array in arrays.items()})
+                    continue
+
+            last_event_id = -1
+            for _, arrays in iterate_tree_chunks(shard_root_file_path, tree_name, step_size=step_size):
+                if has_event_id:
+                    event_ids = arrays[event_id_branch]
+                    last_event_id = max(last_event_id, int(event_ids.max()))
+                    arrays[event_id_branch] = (event_ids + event_id_offset).astype(event_ids.dtype)
+                writer.write({branch: to_writable_array(array) for branch, array in arrays.items()})
+            event_id_offset += last_event_id + 1
+            print(f"Merged {shard_root_file_path}, next event id {event_id_offset}")
+    return writer.number_of_entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merges the phase space root files of sharded simulation runs.")
+    parser.add_argument("merged_root_file", help="root file written")
+    parser.add_argument("shard_root_files", nargs="+", help="root files of the shards, in order")
+    parser.add_argument("--tree", default="Phase", help="name of the phase space tree (default: %(default)s)")
+    parser.add_argument("--step-size", default=DEFAULT_STEP_SIZE,
+                        help="entries (e.g. 100000) or memory size (e.g. '100 MB') read at once (default: %(default)s)")
+    args = parser.parse_args()
+
+    number_of_entries = merge_phase_space_files(args.shard_root_files, args.merged_root_file, args.tree,
+                                                parse_step_size(args.step_size))
+    print(f"{number_of_entries} entries written in {args.merged_root_file}")
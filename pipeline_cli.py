@@ -0,0 +1,293 @@
+# Command line entry point of the comparison pipeline:
+#
+#   python pipeline_cli.py filter --input-folder <root files> --output-folder <filtered root files>
+#   python pipeline_cli.py extract-events phase_space.root [--output-folder <optigan inputs>]
+#   python pipeline_cli.py generate phase_space.root --data-folder <folder with optigan_models>
+#   python pipeline_cli.py compare --dataset gate9:gate9.root:MyActorPixel_In --dataset gate10:gate10.root:Phase
+#   python pipeline_cli.py plot <histograms .npz files or folders>
+#
+# Only the standard library is imported to parse the command line, every subcommand
+# imports what it needs when it runs: uproot and numpy for filter, extract-events and
+# compare, torch only for generate and matplotlib only for plot. So --help and the
+# event count queries do not pay the torch, seaborn and opengate imports
+# (see benchmarks/benchmark_cli_startup.py for the measured start times).
+
+import argparse
+import os
+
+from pipeline_instrumentation import PROFILERS
+
+
+# keyword arguments of the options that were given, the others keep the defaults of the called function
+def given_options(**options):
+    return {name: value for name, value in options.items() if value is not None}
+
+
+# writes the instrumentation summary when --instrumentation-summary is given
+def finish_instrumentation(instrumentation, args):
+    instrumentation.print_summary()
+    if args.instrumentation_summary is not None:
+        instrumentation.write_summary(args.instrumentation_summary)
+        print(f"Saved the instrumentation summary to {args.instrumentation_summary}")
+
+
+def run_filter(args):
+    from helpers_filter_root_files import filter_root_files, print_filter_summaries
+    from pipeline_instrumentation import Instrumentation
+    from root_streaming import parse_step_size
+
+    if args.quick_look is not None:
+        from helpers_filter_root_files import print_quick_look_summaries, quick_look_root_files
+
+        summaries = quick_look_root_files(jobs=args.jobs, sample_size=args.quick_look, sampling_mode=args.sampling,
+                                          max_seconds=args.max_seconds, seed=args.seed, plot=not args.no_plots,
+                                          **given_options(step_size=parse_step_size(args.step_size),
+                                                          unfiltered_root_files_folder=args.input_folder,
+                                                          filtered_root_files_folder=args.output_folder,
+                                                          number_of_bins=args.bins, dpi=args.dpi,
+                                                          branch_cache_folder=args.branch_cache))
+        print_quick_look_summaries(summaries)
+        return
+
+    instrumentation = Instrumentation()
+    summaries, manifest = filter_root_files(jobs=args.jobs, plot=not args.no_plots, force=args.force, use_hash=args.hash,
+                                            instrumentation=instrumentation, profiler=args.profile, profile_folder=args.profile_folder,
+                                            **given_options(step_size=parse_step_size(args.step_size),
+                                                            unfiltered_root_files_folder=args.input_folder,
+                                                            filtered_root_files_folder=args.output_folder,
+                                                            number_of_bins=args.bins, dpi=args.dpi,
+                                                            branch_cache_folder=args.branch_cache))
+    print_filter_summaries(summaries)
+    manifest.print_report()
+    finish_instrumentation(instrumentation, args)
+
+
+# segments the phase space into events (streamed, without torch) and prints the counts,
+# the optigan inputs are written in --output-folder when it is given
+def run_extract_events(args):
+    from optigan_segmentation import segment_root_file
+    from root_streaming import parse_step_size
+
+    step_size_option = given_options(step_size=parse_step_size(args.step_size))
+    if args.event_index:
+        from phase_space_index import load_event_index
+
+        event_index = load_event_index(args.root_file, args.tree, **step_size_option)
+        event_table, number_of_rows = event_index.event_table(), event_index.number_of_entries
+    else:
+        branch_cache = None
+        if args.branch_cache is not None:
+            from branch_cache import BranchCache
+
+            branch_cache = BranchCache(args.branch_cache)
+        event_table, number_of_rows = segment_root_file(args.root_file, args.tree, branch_cache=branch_cache, **step_size_option)
+    optical_photon_counts = event_table['optical_photon_count']
+    print(f"{args.root_file}: {number_of_rows} rows, {len(optical_photon_counts)} events with optical photons")
+    print(f"{int(event_table['electron_count'].sum())} electrons, {int(optical_photon_counts.sum())} optical photons")
+    if args.print_events:
+        for event_id, (gamma_position, electron_count, optical_photon_count) in enumerate(zip(
+                event_table['gamma_position'], event_table['electron_count'], optical_photon_counts)):
+            print(f"Event ID: {event_id}, Gamma Position: {tuple(gamma_position)}, Number of Electrons: {electron_count}, "
+                  f"Number of Optical Photons: {optical_photon_count}")
+
+    if args.output_folder is None:
+        return
+    from optigan_storage import OPTIGAN_INPUTS_FILE_NAME, write_optigan_inputs_csv, write_optigan_inputs_root
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    if args.storage_format == "root":
+        write_optigan_inputs_root(os.path.join(args.output_folder, OPTIGAN_INPUTS_FILE_NAME), event_table['gamma_position'], optical_photon_counts)
+    else:
+        write_optigan_inputs_csv(args.output_folder, event_table['gamma_position'], optical_photon_counts)
+    print(f"The optigan input files are saved at {args.output_folder}")
+
+
+def run_generate(args):
+    if args.discard_photons and not args.aggregate_response:
+        raise argparse.ArgumentTypeError("--discard-photons needs --aggregate-response, otherwise nothing is kept")
+
+    from optigan_helpers import OptiganHelpers
+    from optigan_inference import OptiganExecutionProfile, OptiganStageMetrics
+    from root_streaming import parse_step_size
+
+    execution_profile = OptiganExecutionProfile(args.threads, args.seed, precision=args.precision,
+                                                **given_options(max_batch_rows=args.batch_rows))
+    instrumentation = OptiganStageMetrics(args.profile, profile_folder=args.profile_folder)
+    optigan_helpers = OptiganHelpers(args.root_file, step_size=parse_step_size(args.step_size), storage_format=args.storage_format,
+                                     save_event_graphs=not args.no_graphs, pipeline_mode=args.pipeline_mode,
+                                     write_outputs=args.write_outputs, model_name=args.model, crystal_size_mm=args.crystal_size,
+                                     use_torchscript=args.torchscript, execution_profile=execution_profile,
+                                     instrumentation=instrumentation, instrumentation_summary_path=args.instrumentation_summary,
+                                     data_folder=args.data_folder, use_event_index=args.event_index,
+                                     branch_cache_folder=args.branch_cache, aggregate_response=args.aggregate_response,
+                                     keep_photons=not args.discard_photons,
+                                     **given_options(pixel_grid=args.pixel_grid, energy_range_mev=args.energy_range))
+    if args.quick_look is not None:
+        optigan_helpers.run_optigan_quick_look(args.quick_look, sampling_mode=args.sampling, max_seconds=args.max_seconds)
+    else:
+        optigan_helpers.run_optigan()
+
+
+def run_compare(args):
+    from dataset_comparison import BRANCH_ALIASES, compare_datasets, parse_dataset, parse_range, write_comparison
+    from root_streaming import parse_step_size
+
+    datasets = [parse_dataset(value) for value in args.datasets]
+    fixed_ranges = dict(parse_range(value) for value in args.ranges)
+    report, histograms = compare_datasets(datasets, args.quantities or list(BRANCH_ALIASES), fixed_ranges=fixed_ranges,
+                                          **given_options(number_of_bins=args.bins, step_size=parse_step_size(args.step_size)))
+    write_comparison(args.output, report, histograms, args.histograms_folder)
+
+
+# histograms files of the given paths, folders are searched recursively
+def find_histograms_files(paths):
+    histograms_file_paths = []
+    for path in paths:
+        if not os.path.isdir(path):
+            histograms_file_paths.append(path)
+            continue
+        for root, _, file_names in os.walk(path):
+            histograms_file_paths.extend(os.path.join(root, file_name) for file_name in sorted(file_names)
+                                         if file_name.endswith("histograms.npz"))
+    return histograms_file_paths
+
+
+# renders saved histograms, x_histograms.npz is rendered in the x_graphs folder next to it
+# (distribution_histograms.npz -> distribution_graphs like helpers_filter_root_files)
+def run_plot(args):
+    from root_histograms import render_histograms_file
+
+    histograms_file_paths = find_histograms_files(args.paths)
+    for histograms_file_path in histograms_file_paths:
+        graphs_folder_name = os.path.basename(histograms_file_path)[:-len(".npz")].replace("histograms", "graphs")
+        graphs_folder = os.path.join(args.output_folder or os.path.dirname(histograms_file_path), graphs_folder_name)
+        render_histograms_file(histograms_file_path, graphs_folder, args.dpi)
+        print(f"Saved the graphs of {histograms_file_path} in {graphs_folder}")
+    print(f"Rendered {len(histograms_file_paths)} histograms files")
+
+
+def add_step_size_argument(parser):
+    parser.add_argument("--step-size", default=None, help="entries (e.g. 100000) or memory size (e.g. '100 MB') read at once")
+
+
+def add_branch_cache_argument(parser):
+    parser.add_argument("--branch-cache", default=None,
+                        help="folder where the decoded branches of the root files are kept for the next runs (see branch_cache.py)")
+
+
+def add_instrumentation_arguments(parser):
+    parser.add_argument("--instrumentation-summary", default=None, help="json file where the spans and counters of the run are written")
+    parser.add_argument("--profile", choices=PROFILERS, default=None, help="profile the stages of the run")
+    parser.add_argument("--profile-folder", default="profiles", help="folder where the profiles are written")
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Gate 9, Gate 10 and OptiGAN dataset comparison pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    filter_parser = subparsers.add_parser("filter", help="filter the simulation root files, compute and plot their histograms")
+    filter_parser.add_argument("--input-folder", default=None, help="folder with the unfiltered root files")
+    filter_parser.add_argument("--output-folder", default=None, help="folder where the filtered root files are written")
+    filter_parser.add_argument("--jobs", type=int, default=1, help="number of processes")
+    add_step_size_argument(filter_parser)
+    filter_parser.add_argument("--no-plots", action="store_true", help="only compute the histograms, do not plot them")
+    filter_parser.add_argument("--bins", type=int, default=None, help="number of bins of the histograms")
+    filter_parser.add_argument("--dpi", type=int, default=None, help="resolution of the graphs")
+    filter_parser.add_argument("--force", action="store_true", help="ignore the cache manifest and recompute everything")
+    filter_parser.add_argument("--hash", action="store_true", help="identify the source root files by content hash instead of size and modification time")
+    add_branch_cache_argument(filter_parser)
+    filter_parser.add_argument("--quick-look", type=int, default=None, metavar="SAMPLE_SIZE",
+                               help="only histogram a sample of this many rows (or events) of every root file, scaled to the whole file")
+    filter_parser.add_argument("--sampling", choices=("reservoir", "event"), default="reservoir",
+                               help="quick look sampling of rows or of events (default: %(default)s)")
+    filter_parser.add_argument("--max-seconds", type=float, default=None, help="quick look reading time limit of every root file")
+    filter_parser.add_argument("--seed", type=int, default=None, help="seed of the quick look sampling")
+    add_instrumentation_arguments(filter_parser)
+    filter_parser.set_defaults(run=run_filter)
+
+    extract_parser = subparsers.add_parser("extract-events", help="count the events of a phase space and write the optigan inputs")
+    extract_parser.add_argument("root_file", help="phase space root file")
+    extract_parser.add_argument("--tree", default="Phase", help="phase space tree (default: %(default)s)")
+    add_step_size_argument(extract_parser)
+    extract_parser.add_argument("--event-index", action="store_true",
+                                help="use (and build the first time) the sidecar event index of the phase space")
+    add_branch_cache_argument(extract_parser)
+    extract_parser.add_argument("--print-events", action="store_true", help="print the gamma position and counts of every event")
+    extract_parser.add_argument("--output-folder", default=None, help="folder where the optigan inputs are written")
+    extract_parser.add_argument("--storage-format", choices=("csv", "root"), default="csv", help="format of the optigan inputs")
+    extract_parser.set_defaults(run=run_extract_events)
+
+    generate_parser = subparsers.add_parser("generate", help="run optigan on the events of a phase space")
+    generate_parser.add_argument("root_file", help="phase space root file")
+    generate_parser.add_argument("--data-folder", default=None,
+                                 help="folder with optigan_models, where optigan_inputs and optigan_outputs are written "
+                                      "(default: the data folder of the opengate tests)")
+    generate_parser.add_argument("--pipeline-mode", choices=("disk", "memory"), default="disk")
+    generate_parser.add_argument("--storage-format", choices=("csv", "root"), default="csv")
+    generate_parser.add_argument("--write-outputs", action="store_true", help="write the generated photons in memory mode")
+    generate_parser.add_argument("--no-graphs", action="store_true", help="do not plot the photons of every event")
+    add_step_size_argument(generate_parser)
+    generate_parser.add_argument("--event-index", action="store_true",
+                                 help="take the events from the sidecar event index of the phase space")
+    add_branch_cache_argument(generate_parser)
+    generate_parser.add_argument("--quick-look", type=int, default=None, metavar="EVENTS",
+                                 help="only generate the photons of a sample of this many events and plot their "
+                                      "histograms scaled to all the events, with error bands")
+    generate_parser.add_argument("--sampling", choices=("reservoir", "event"), default="event",
+                                 help="quick look sampling of the events by EventID, or of the events of the windows read "
+                                      "(no EventID needed), when there is no event index (default: %(default)s)")
+    generate_parser.add_argument("--max-seconds", type=float, default=None,
+                                 help="quick look reading time limit of the phase space when there is no event index")
+    generate_parser.add_argument("--aggregate-response", action="store_true",
+                                 help="accumulate the hit map of the pixel, the dX/dY/dZ/Ekine spectra and the photon counts "
+                                      "per event in optigan_response.npz")
+    generate_parser.add_argument("--discard-photons", action="store_true",
+                                 help="do not write or keep the generated photons (use with --aggregate-response)")
+    generate_parser.add_argument("--pixel-grid", type=int, nargs=2, default=None, metavar=("NX", "NY"),
+                                 help="cells of the hit map of the pixel (default: 30 30)")
+    generate_parser.add_argument("--energy-range", type=float, nargs=2, default=None, metavar=("MIN", "MAX"),
+                                 help="range in MeV of the Ekine spectrum (default: the one of the model, 1e-6 5e-6)")
+    generate_parser.add_argument("--model", default=None, help="name of the optigan model")
+    generate_parser.add_argument("--crystal-size", type=float, nargs=3, default=None, metavar=("X", "Y", "Z"),
+                                 help="crystal size in mm, picks the model trained for it (or for its x, y section)")
+    generate_parser.add_argument("--torchscript", action="store_true", help="use the frozen TorchScript export of the generator")
+    generate_parser.add_argument("--precision", choices=("float32", "bfloat16", "dynamic_int8"), default="float32",
+                                 help="numerical precision of the generator (default: %(default)s)")
+    generate_parser.add_argument("--threads", type=int, default=None)
+    generate_parser.add_argument("--seed", type=int, default=None)
+    generate_parser.add_argument("--batch-rows", type=int, default=None, help="maximum number of photons generated at once")
+    add_instrumentation_arguments(generate_parser)
+    generate_parser.set_defaults(run=run_generate)
+
+    compare_parser = subparsers.add_parser("compare", help="compare the distributions of two or three datasets")
+    compare_parser.add_argument("--dataset", dest="datasets", action="append", required=True,
+                                help="label:root_file_path:tree_name, given two or three times")
+    compare_parser.add_argument("--quantities", nargs="+", default=None, help="quantities to compare (default: all)")
+    compare_parser.add_argument("--bins", type=int, default=None, help="number of bins")
+    compare_parser.add_argument("--range", dest="ranges", action="append", default=[],
+                                help="fixed range of a quantity, quantity=minimum:maximum")
+    add_step_size_argument(compare_parser)
+    compare_parser.add_argument("--output", default="dataset_comparison.json", help="json report (default: %(default)s)")
+    compare_parser.add_argument("--histograms-folder", default=None,
+                                help="also saves the histograms of each dataset as <label>_histograms.npz in this folder")
+    compare_parser.set_defaults(run=run_compare)
+
+    plot_parser = subparsers.add_parser("plot", help="render saved histograms (.npz) as png graphs")
+    plot_parser.add_argument("paths", nargs="+", help="histograms files, or folders searched for *histograms.npz")
+    plot_parser.add_argument("--output-folder", default=None, help="folder of the graphs folders (default: next to the histograms)")
+    plot_parser.add_argument("--dpi", type=int, default=300, help="resolution of the graphs")
+    plot_parser.set_defaults(run=run_plot)
+    return parser
+
+
+def main(argv=None):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    try:
+        args.run(args)
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+
+
+if __name__ == "__main__":
+    main()
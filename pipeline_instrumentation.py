@@ -0,0 +1,144 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+# profilers that can capture the spans
+PROFILERS = ("cprofile", "pyinstrument")
+
+
+# peak resident memory of the process in MB (ru_maxrss is in kB on linux)
+def peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# lightweight instrumentation of a pipeline run:
+# - spans: named and nested timed sections, "run_optigan/generate" is the
+#   generate span inside the run_optigan span, with their calls and seconds
+# - counters: rows read, events found, photons generated, files and bytes written, ...
+# - profiles: with a profiler ("cprofile" or "pyinstrument"), the spans named in
+#   profile_spans (all the outermost ones if None) are profiled and the profile
+#   is written in profile_folder (.prof for cProfile, .html for pyinstrument)
+class Instrumentation:
+
+    def __init__(self, profiler=None, profile_spans=None, profile_folder="profiles"):
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler '{profiler}', use one of {PROFILERS}")
+        self.profiler = profiler
+        self.profile_spans = None if profile_spans is None else set(profile_spans)
+        self.profile_folder = profile_folder
+        self.reset()
+
+    def reset(self):
+        self.spans = {}
+        self.counters = {}
+        self.profiles = []
+        self.span_stack = []
+        self.active_profiler = None
+
+    @contextmanager
+    def span(self, name):
+        self.span_stack.append(name)
+        span_path = "/".join(self.span_stack)
+        profiler = self.start_profiler(name)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            if profiler is not None:
+                self.stop_profiler(profiler, span_path)
+            self.span_stack.pop()
+            self.add_span(span_path, seconds)
+
+    def add_span(self, span_path, seconds, calls=1):
+        span = self.spans.setdefault(span_path, {"calls": 0, "seconds": 0.0})
+        span["calls"] += calls
+        span["seconds"] += seconds
+
+    # seconds of the spans with this name, whatever their parents
+    def span_seconds(self, name):
+        return sum(span["seconds"] for span_path, span in self.spans.items() if span_path.rsplit("/", 1)[-1] == name)
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    # counts a written file (or all the files of a written folder) and its bytes
+    def record_written(self, path):
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file in files:
+                    self.record_written(os.path.join(root, file))
+            return
+        self.count("files_written")
+        self.count("bytes_written", os.path.getsize(path))
+
+    # the profiler does not nest, so only the outermost profiled span is captured
+    def start_profiler(self, name):
+        if self.profiler is None or self.active_profiler is not None:
+            return None
+        if self.profile_spans is None and len(self.span_stack) > 1:
+            return None
+        if self.profile_spans is not None and name not in self.profile_spans:
+            return None
+        if self.profiler == "cprofile":
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            try:
+                import pyinstrument
+            except ImportError:
+                raise ImportError("The pyinstrument profiler needs the pyinstrument package (pip install pyinstrument)")
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+        self.active_profiler = profiler
+        return profiler
+
+    def stop_profiler(self, profiler, span_path):
+        self.active_profiler = None
+        os.makedirs(self.profile_folder, exist_ok=True)
+        file_name = span_path.replace("/", "__")
+        if self.profiler == "cprofile":
+            profiler.disable()
+            profile_path = os.path.join(self.profile_folder, f"{file_name}.prof")
+            profiler.dump_stats(profile_path)
+        else:
+            profiler.stop()
+            profile_path = os.path.join(self.profile_folder, f"{file_name}.html")
+            with open(profile_path, "w") as profile_file:
+                profile_file.write(profiler.output_html())
+        self.profiles.append({"span": span_path, "path": profile_path})
+
+    # adds the summary of another instrumentation (e.g. of a pool worker), its
+    # spans are put under the current span. the seconds of workers running at
+    # the same time are summed, so they can be more than the wall time.
+    def merge(self, summary):
+        prefix = "/".join(self.span_stack)
+        for span_path, span in summary["spans"].items():
+            self.add_span(f"{prefix}/{span_path}" if prefix else span_path, span["seconds"], span["calls"])
+        for counter, value in summary["counters"].items():
+            self.count(counter, value)
+        for profile in summary["profiles"]:
+            self.profiles.append({"span": f"{prefix}/{profile['span']}" if prefix else profile["span"], "path": profile["path"]})
+
+    def summary(self):
+        return {
+            "spans": {span_path: dict(span) for span_path, span in self.spans.items()},
+            "counters": dict(self.counters),
+            "profiles": [dict(profile) for profile in self.profiles],
+            "peak_memory_mb": peak_memory_mb(),
+        }
+
+    def write_summary(self, summary_file_path):
+        os.makedirs(os.path.dirname(os.path.abspath(summary_file_path)), exist_ok=True)
+        with open(summary_file_path, "w") as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+
+    def print_summary(self):
+        for span_path, span in sorted(self.spans.items()):
+            print(f"{'    ' * span_path.count('/')}{span_path.rsplit('/', 1)[-1]}: {span['seconds']:.3f} s ({span['calls']} calls)")
+        for counter, value in self.counters.items():
+            print(f"{counter}: {value}")
+        print(f"peak memory {peak_memory_mb():.0f} MB")
@@ -0,0 +1,368 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from branch_cache import open_root_file_with_cache
+from optigan_segmentation import (OPTIGAN_POSITION_BRANCHES, empty_event_table, find_particle_type_branch, particle_masks,
+                                  segment_events_from_masks)
+from root_histograms import DEFAULT_NUMBER_OF_BINS, HistogramAccumulator, is_numeric, make_bin_edges, save_histograms
+from root_streaming import parse_step_size
+
+# how the rows of a quick look are drawn:
+# - "reservoir": uniform sample of the rows
+# - "event": all the rows of a uniform sample of the events (EventID), so the
+#   rows of an event stay together
+SAMPLING_MODES = ("reservoir", "event")
+
+# rows (reservoir) or events (event) kept by default
+DEFAULT_SAMPLE_SIZE = 100000
+
+# entries or memory size of the windows of the tree read in random order, small
+# enough that a time limit still leaves windows spread over the whole tree
+DEFAULT_WINDOW_SIZE = "10 MB"
+
+# entry numbers added to the rows of the event sampling of sample_phase_space_events
+ENTRY_BRANCH = "entry"
+
+
+# uniform sample of at most sample_size rows of a stream of chunks (algorithm R,
+# vectorized per chunk): row i of the stream replaces a random slot of the
+# reservoir with probability sample_size / (i + 1)
+class ReservoirSampler:
+
+    def __init__(self, sample_size, seed=None):
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+        self.reservoir = None
+        self.number_of_rows_seen = 0
+        self.number_of_rows_kept = 0
+
+    # arrays: branch -> values of a chunk
+    def add(self, arrays):
+        number_of_rows = len(next(iter(arrays.values()))) if arrays else 0
+        if number_of_rows == 0:
+            return
+        if self.reservoir is None:
+            self.reservoir = {branch: np.empty(self.sample_size, dtype=values.dtype) for branch, values in arrays.items()}
+
+        # the first rows fill the reservoir
+        number_filled = min(self.sample_size - self.number_of_rows_kept, number_of_rows)
+        for branch, values in arrays.items():
+            self.reservoir[branch][self.number_of_rows_kept:self.number_of_rows_kept + number_filled] = values[:number_filled]
+        self.number_of_rows_kept += number_filled
+
+        # the next ones replace a slot j < sample_size drawn in [0, i], when a slot is drawn
+        # more than once in the chunk the last row wins, like the row by row algorithm
+        row_indices = self.number_of_rows_seen + np.arange(number_filled, number_of_rows)
+        slots = (self.rng.random(len(row_indices)) * (row_indices + 1)).astype(np.int64)
+        replacing_rows = np.nonzero(slots < self.sample_size)[0]
+        if len(replacing_rows) > 0:
+            replaced_slots, last_rows = np.unique(slots[replacing_rows][::-1], return_index=True)
+            chunk_rows = number_filled + replacing_rows[len(replacing_rows) - 1 - last_rows]
+            for branch, values in arrays.items():
+                self.reservoir[branch][replaced_slots] = values[chunk_rows]
+        self.number_of_rows_seen += number_of_rows
+
+    def sample(self):
+        if self.reservoir is None:
+            return {}
+        return {branch: values[:self.number_of_rows_kept] for branch, values in self.reservoir.items()}
+
+
+# uniform hash of the event ids in [0, 2**64), the same event id always gets the same
+# key (splitmix64), so an event cut between two chunks is kept or dropped as a whole
+def event_keys(event_ids, seed=0):
+    with np.errstate(over="ignore"):
+        keys = np.asarray(event_ids).astype(np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return keys ^ (keys >> np.uint64(31))
+
+
+# uniform sample of at most sample_size events of a stream of chunks: the events
+# with the sample_size smallest keys (bottom-k sampling) and all their rows
+class EventSampler:
+
+    def __init__(self, sample_size, seed=None, event_id_branch="EventID"):
+        self.sample_size = sample_size
+        self.seed = 0 if seed is None else seed
+        self.event_id_branch = event_id_branch
+        self.threshold = np.iinfo(np.uint64).max
+        self.chunks = []
+        self.keys = []
+        self.number_of_rows_seen = 0
+        self.number_of_rows_kept = 0
+        # the rows kept are shrunk to the sample events when they pass this number
+        self.shrink_rows = 2 * sample_size
+
+    def add(self, arrays):
+        if self.event_id_branch not in arrays:
+            raise ValueError(f"The event sampling needs the {self.event_id_branch} branch")
+        keys = event_keys(arrays[self.event_id_branch], self.seed)
+        kept_rows = keys <= self.threshold
+        self.chunks.append({branch: values[kept_rows] for branch, values in arrays.items()})
+        self.keys.append(keys[kept_rows])
+        self.number_of_rows_seen += len(keys)
+        self.number_of_rows_kept += int(np.count_nonzero(kept_rows))
+        # the rows kept stay proportional to the rows of the sample events
+        if self.number_of_rows_kept > self.shrink_rows:
+            self.shrink()
+            self.shrink_rows = max(2 * self.number_of_rows_kept, 2 * self.sample_size)
+
+    # keeps the rows of the sample_size events with the smallest keys
+    def shrink(self):
+        if not self.chunks:
+            return
+        keys = np.concatenate(self.keys)
+        distinct_keys = np.unique(keys)
+        if len(distinct_keys) > self.sample_size:
+            self.threshold = distinct_keys[self.sample_size - 1]
+        kept_rows = keys <= self.threshold
+        self.chunks = [{branch: np.concatenate([chunk[branch] for chunk in self.chunks])[kept_rows] for branch in self.chunks[0]}]
+        self.keys = [keys[kept_rows]]
+        self.number_of_rows_kept = int(np.count_nonzero(kept_rows))
+
+    def sample(self):
+        self.shrink()
+        return self.chunks[0] if self.chunks else {}
+
+
+def create_sampler(sampling_mode, sample_size, seed=None):
+    if sampling_mode == "reservoir":
+        return ReservoirSampler(sample_size, seed)
+    if sampling_mode == "event":
+        return EventSampler(sample_size, seed)
+    raise ValueError(f"Unknown sampling mode '{sampling_mode}', use one of {SAMPLING_MODES}")
+
+
+# sample of a tree read in windows of step_size taken in random order, so stopping
+# after max_seconds still gives windows spread over the whole tree. without
+# max_seconds every window is read (the memory used stays bounded by the sample).
+# returns the sample (branch -> values) and a description with the number of
+# entries of the tree (the population), the entries read and the rows sampled.
+def sample_tree(root_file_path, tree_name, branches=None, sample_size=DEFAULT_SAMPLE_SIZE, sampling_mode="reservoir",
+                step_size=DEFAULT_WINDOW_SIZE, max_seconds=None, seed=None, branch_cache=None):
+    start_time = time.perf_counter()
+    sampler = create_sampler(sampling_mode, sample_size, seed)
+    with open_root_file_with_cache(root_file_path, branch_cache) as root_file:
+        tree = root_file[tree_name]
+        branches = list(tree.keys()) if branches is None else list(branches)
+        if sampling_mode == "event" and sampler.event_id_branch not in branches:
+            branches.append(sampler.event_id_branch)
+        number_of_entries = tree.num_entries
+        windows = get_random_windows(tree, branches, step_size, seed)
+
+        number_of_windows_read = 0
+        for window_start, window_stop in windows:
+            if max_seconds is not None and number_of_windows_read > 0 and time.perf_counter() - start_time > max_seconds:
+                break
+            sampler.add(tree.arrays(branches, entry_start=window_start, entry_stop=window_stop, library="np"))
+            number_of_windows_read += 1
+
+    sample = sampler.sample()
+    return sample, {
+        "root_file_path": root_file_path,
+        "tree_name": tree_name,
+        "sampling_mode": sampling_mode,
+        "sample_size": sample_size,
+        "number_of_entries": number_of_entries,
+        "number_of_entries_read": sampler.number_of_rows_seen,
+        "number_of_windows_read": number_of_windows_read,
+        "number_of_windows": len(windows),
+        "number_of_rows_sampled": len(next(iter(sample.values()))) if sample else 0,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+# (entry_start, entry_stop) of the windows of step_size (entries or memory size of
+# the branches) covering a tree, in random order
+def get_random_windows(tree, branches, step_size=DEFAULT_WINDOW_SIZE, seed=None):
+    number_of_entries = tree.num_entries
+    window_entries = max(1, step_size if isinstance(step_size, int) else tree.num_entries_for(step_size, branches))
+    window_starts = np.arange(0, number_of_entries, window_entries)
+    np.random.default_rng(seed).shuffle(window_starts)
+    return [(int(window_start), min(int(window_start) + window_entries, number_of_entries)) for window_start in window_starts]
+
+
+# events of a window of a phase space (see optigan_segmentation.segment_events) with
+# gamma_index as rows of the tree. the rows before the first gamma belong to an event
+# that started in the previous window and the last event may go on in the next one,
+# both are dropped (the last one is kept in the last window of the tree).
+# returns the event table and the number of rows of the events kept
+def segment_window_events(arrays, particle_type_branch, window_start, is_last_window):
+    is_gamma, is_electron, is_optical_photon = particle_masks(arrays[particle_type_branch])
+    gamma_rows = np.flatnonzero(is_gamma)
+    if len(gamma_rows) == 0:
+        return empty_event_table(), 0
+    row_stop = len(is_gamma) if is_last_window else gamma_rows[-1]
+    rows = slice(gamma_rows[0], row_stop + 1)
+    event_table = segment_events_from_masks(is_gamma[rows], is_electron[rows], is_optical_photon[rows],
+                                            *(arrays[branch][rows] for branch in OPTIGAN_POSITION_BRANCHES))
+    event_table['gamma_index'] = event_table['gamma_index'] + window_start + gamma_rows[0]
+    return event_table, int(row_stop - gamma_rows[0])
+
+
+# uniform sample of the events of a phase space drawn while streaming its windows in
+# random order (like sample_tree, so max_seconds bounds the time), for the optigan quick look:
+# - "event": all the rows of a sample of the EventIDs, segmented in the order of the tree
+# - "reservoir": sample of the events segmented window by window, the events cut by a
+#   window are dropped (see segment_window_events), it does not need an EventID branch
+#   ("event" falls back to it when the tree has no EventID)
+# returns the event table of the sampled events (gamma_index are rows of the tree) and a
+# description like sample_tree's with the estimated optical photons of the whole tree:
+# the photons of the sample scaled by the rows of the tree per sampled row ("event"),
+# or the photons of the events segmented scaled by the rows of the tree per row of
+# these events ("reservoir")
+def sample_phase_space_events(root_file_path, tree_name="Phase", number_of_events=1000, sampling_mode="event",
+                              step_size=DEFAULT_WINDOW_SIZE, max_seconds=None, seed=None, branch_cache=None):
+    start_time = time.perf_counter()
+    with open_root_file_with_cache(root_file_path, branch_cache) as root_file:
+        tree = root_file[tree_name]
+        particle_type_branch = find_particle_type_branch(tree.keys(), root_file_path)
+        if sampling_mode == "event" and "EventID" not in tree.keys():
+            print(f"No EventID branch in the {tree_name} tree of {root_file_path}, the events are sampled per window")
+            sampling_mode = "reservoir"
+        sampler = create_sampler(sampling_mode, number_of_events, seed)
+        branches = [particle_type_branch] + OPTIGAN_POSITION_BRANCHES
+        if sampling_mode == "event":
+            branches.append(sampler.event_id_branch)
+        number_of_entries = tree.num_entries
+        windows = get_random_windows(tree, branches, step_size, seed)
+
+        number_of_entries_read = 0
+        number_of_windows_read = 0
+        number_of_rows_segmented = 0
+        number_of_photons_segmented = 0
+        for window_start, window_stop in windows:
+            if max_seconds is not None and number_of_windows_read > 0 and time.perf_counter() - start_time > max_seconds:
+                break
+            arrays = dict(tree.arrays(branches, entry_start=window_start, entry_stop=window_stop, library="np"))
+            if sampling_mode == "event":
+                arrays[ENTRY_BRANCH] = np.arange(window_start, window_stop)
+                sampler.add(arrays)
+            else:
+                window_events, number_of_rows = segment_window_events(arrays, particle_type_branch, window_start,
+                                                                      window_stop == number_of_entries)
+                number_of_rows_segmented += number_of_rows
+                number_of_photons_segmented += int(window_events['optical_photon_count'].sum())
+                # the reservoir keeps 1-D columns, the gamma position is split in its branches
+                gamma_position = window_events.pop('gamma_position')
+                window_events.update({branch: gamma_position[:, i] for i, branch in enumerate(OPTIGAN_POSITION_BRANCHES)})
+                sampler.add(window_events)
+            number_of_entries_read += window_stop - window_start
+            number_of_windows_read += 1
+
+    sample = sampler.sample()
+    if not sample:
+        event_table = empty_event_table()
+    elif sampling_mode == "event":
+        order = np.argsort(sample[ENTRY_BRANCH], kind="stable")
+        event_table = segment_events_from_masks(*particle_masks(sample[particle_type_branch][order]),
+                                                *(sample[branch][order] for branch in OPTIGAN_POSITION_BRANCHES))
+        event_table['gamma_index'] = sample[ENTRY_BRANCH][order][event_table['gamma_index']]
+    else:
+        order = np.argsort(sample['gamma_index'], kind="stable")
+        event_table = {
+            'gamma_index': sample['gamma_index'][order],
+            'gamma_position': np.stack([sample[branch][order] for branch in OPTIGAN_POSITION_BRANCHES], axis=1),
+            'electron_count': sample['electron_count'][order],
+            'optical_photon_count': sample['optical_photon_count'][order],
+        }
+
+    number_of_photons_sampled = int(event_table['optical_photon_count'].sum())
+    if sampling_mode == "event":
+        number_of_rows_sampled = len(sample[ENTRY_BRANCH]) if sample else 0
+        estimated_number_of_photons = number_of_photons_sampled * get_sample_scale(number_of_entries, number_of_rows_sampled)
+    else:
+        estimated_number_of_photons = number_of_photons_segmented * get_sample_scale(number_of_entries, number_of_rows_segmented)
+    return event_table, {
+        "root_file_path": root_file_path,
+        "tree_name": tree_name,
+        "sampling_mode": sampling_mode,
+        "sample_size": number_of_events,
+        "number_of_entries": number_of_entries,
+        "number_of_entries_read": number_of_entries_read,
+        "number_of_windows_read": number_of_windows_read,
+        "number_of_windows": len(windows),
+        "number_of_events_sampled": len(event_table['optical_photon_count']),
+        "number_of_photons_sampled": number_of_photons_sampled,
+        "estimated_number_of_photons": estimated_number_of_photons,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+# branch -> (minimum, maximum) of the numeric branches of many samples, None for the others
+def sample_branch_ranges(samples):
+    branch_ranges = {}
+    for sample in samples:
+        for branch, values in sample.items():
+            branch_ranges.setdefault(branch, None)
+            if not is_numeric(values) or len(values) == 0:
+                continue
+            minimum, maximum = values.min(), values.max()
+            if branch_ranges[branch] is not None:
+                minimum = min(minimum, branch_ranges[branch][0])
+                maximum = max(maximum, branch_ranges[branch][1])
+            branch_ranges[branch] = (minimum, maximum)
+    return branch_ranges
+
+
+# histograms of a sample scaled to the population: every sampled row stands for
+# scale rows of the population, a bin with n sampled rows is estimated at n * scale
+# rows with a Poisson error of sqrt(n) * scale. the histograms keep the sampled
+# counts ("sample_counts") and give the estimate as "counts" with its "errors".
+def fill_sampled_histograms(sample, bin_edges, scale):
+    accumulator = HistogramAccumulator(bin_edges)
+    accumulator.fill(sample)
+    histograms = accumulator.result()
+    for histogram in histograms.values():
+        sample_counts = histogram['counts']
+        histogram['sample_counts'] = sample_counts
+        histogram['counts'] = sample_counts * scale
+        histogram['errors'] = np.sqrt(sample_counts) * scale
+        histogram['scale'] = scale
+        for field in ('underflow', 'overflow'):
+            if field in histogram:
+                histogram[field] = histogram[field] * scale
+    return histograms
+
+
+# population rows per sampled row
+def get_sample_scale(number_of_entries, number_of_rows_sampled):
+    return number_of_entries / number_of_rows_sampled if number_of_rows_sampled > 0 else 0.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quick look at the distributions of a tree from a sample of its rows or events")
+    parser.add_argument("root_file", help="root file")
+    parser.add_argument("--tree", default="Phase", help="name of the tree (default: %(default)s)")
+    parser.add_argument("--branches", nargs="+", default=None, help="branches histogrammed (default: all)")
+    parser.add_argument("--sample-size", type=int, default=DEFAULT_SAMPLE_SIZE, help="rows or events sampled (default: %(default)s)")
+    parser.add_argument("--sampling", choices=SAMPLING_MODES, default="reservoir", help="sampling of rows or of events (default: %(default)s)")
+    parser.add_argument("--max-seconds", type=float, default=None, help="stops reading the tree after this time")
+    parser.add_argument("--step-size", default=DEFAULT_WINDOW_SIZE,
+                        help="entries (e.g. 100000) or memory size (e.g. '100 MB') of the windows read (default: %(default)s)")
+    parser.add_argument("--bins", type=int, default=DEFAULT_NUMBER_OF_BINS, help="number of bins (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the sampling")
+    parser.add_argument("--output-folder", default="quick_look", help="folder of the histograms and graphs (default: %(default)s)")
+    parser.add_argument("--dpi", type=int, default=150, help="resolution of the graphs (default: %(default)s)")
+    args = parser.parse_args()
+
+    sample, description = sample_tree(args.root_file, args.tree, args.branches, args.sample_size, args.sampling,
+                                      parse_step_size(args.step_size), args.max_seconds, args.seed)
+    if args.branches is not None:
+        sample = {branch: sample[branch] for branch in args.branches}
+    scale = get_sample_scale(description["number_of_entries"], description["number_of_rows_sampled"])
+    histograms = fill_sampled_histograms(sample, make_bin_edges(sample_branch_ranges([sample]), args.bins), scale)
+
+    from root_histograms import render_histograms_file
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    histograms_file_path = os.path.join(args.output_folder, "quick_look_histograms.npz")
+    save_histograms(histograms_file_path, histograms)
+    render_histograms_file(histograms_file_path, os.path.join(args.output_folder, "graphs"), args.dpi)
+    print(f"{description['number_of_rows_sampled']} rows sampled from {description['number_of_entries_read']} of "
+          f"{description['number_of_entries']} entries ({description['number_of_windows_read']}/{description['number_of_windows']} windows) "
+          f"in {description['seconds']:.2f} s, graphs in {args.output_folder}")
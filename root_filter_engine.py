@@ -0,0 +1,171 @@
+import operator
+
+import numpy as np
+
+from branch_cache import open_root_file_with_cache
+from optigan_segmentation import PARTICLE_PDG_CODES
+from root_streaming import DEFAULT_STEP_SIZE, RootTreeWriter
+
+# comparison operators usable in a RootFilter
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+# a named selection "branch operator value", e.g. RootFilter("lt_20.02_filter", "Position_Z", "<", 20.02)
+class RootFilter:
+
+    def __init__(self, name, branch, comparison, value):
+        if comparison not in OPERATORS:
+            raise ValueError(f"Unknown comparison '{comparison}' in filter {name}, use one of {list(OPERATORS)}")
+        self.name = name
+        self.branch = branch
+        self.comparison = comparison
+        self.value = value
+
+    # branches read to evaluate the filter
+    @property
+    def branches(self):
+        return [self.branch]
+
+    # boolean mask of the selected rows of a chunk
+    def mask(self, arrays):
+        return OPERATORS[self.comparison](arrays[self.branch], self.value)
+
+    # text used to describe the filter (e.g. in the cache manifest)
+    def definition(self):
+        return f"{self.branch} {self.comparison} {self.value!r}"
+
+    # filter applied to a tree with these branches
+    def for_branches(self, tree_branches):
+        return self
+
+    def __repr__(self):
+        return f"RootFilter({self.name!r}, {self.branch!r}, {self.comparison!r}, {self.value!r})"
+
+
+# selects (or with "!=" rejects) a particle, e.g. ParticleFilter("optical_photon_filter", "opticalphoton").
+# trees written with a compact output profile have PDGCode instead of ParticleName,
+# there the particle is selected by its code.
+class ParticleFilter(RootFilter):
+
+    def __init__(self, name, particle_name, comparison="=="):
+        if particle_name not in PARTICLE_PDG_CODES:
+            raise ValueError(f"Unknown particle '{particle_name}' in filter {name}, use one of {list(PARTICLE_PDG_CODES)}")
+        super().__init__(name, "ParticleName", comparison, particle_name)
+
+    def for_branches(self, tree_branches):
+        if self.branch in tree_branches or "PDGCode" not in tree_branches:
+            return self
+        return RootFilter(self.name, "PDGCode", self.comparison, PARTICLE_PDG_CODES[self.value])
+
+    def __repr__(self):
+        return f"ParticleFilter({self.name!r}, {self.value!r}, {self.comparison!r})"
+
+
+# filters applied to the simulation root files,
+# posZ < 20.02, posZ > 20.11, +dZ and -dZ
+DEFAULT_FILTERS = [
+    RootFilter("lt_20.02_filter", "Position_Z", "<", 20.02),
+    RootFilter("gt_20.11_filter", "Position_Z", ">", 20.11),
+    RootFilter("positive_dZ_filter", "Direction_Z", ">", 0),
+    RootFilter("negative_dZ_filter", "Direction_Z", "<", 0),
+]
+
+
+# uproot can not write object arrays, strings are converted to fixed width unicode
+def to_writable_array(array):
+    if array.dtype == object:
+        return array.astype(str)
+    return array
+
+
+# applies many filters to a tree in one pass. every chunk is read once: first
+# the branches used by the filters, then (only if some rows are selected) the
+# branches written to the outputs. each selection is appended to its own root
+# file, so adding a filter costs a mask and the selected rows, not a copy of
+# the whole tree.
+class RootFilterEngine:
+
+    def __init__(self, filters=DEFAULT_FILTERS, tree_name="Phase", output_tree_name="tree",
+                 step_size=DEFAULT_STEP_SIZE, output_branches=None, write_entry_index=True, branch_cache=None):
+        self.filters = list(filters)
+        self.tree_name = tree_name
+        self.output_tree_name = output_tree_name
+        self.step_size = step_size
+        # branches written in the filtered trees, None writes all of them
+        self.output_branches = output_branches
+        # writes the entry number of the row in the input tree as "index"
+        # (the filtered trees written from pandas DataFrames had this branch)
+        self.write_entry_index = write_entry_index
+        # reads the input trees from the decoded branches of a branch_cache.BranchCache
+        self.branch_cache = branch_cache
+
+    # branches needed to evaluate the filters (all of them by default)
+    def filter_branches(self, filters=None):
+        branches = []
+        for root_filter in (self.filters if filters is None else filters):
+            for branch in root_filter.branches:
+                if branch not in branches:
+                    branches.append(branch)
+        return branches
+
+    # filters the tree of input_root_file_path, output_root_file_paths maps a
+    # filter name to its output file (filters without output are skipped).
+    # returns the number of input rows and the number of rows of each filter.
+    def run(self, input_root_file_path, output_root_file_paths):
+        filters = [root_filter for root_filter in self.filters if root_filter.name in output_root_file_paths]
+        filtered_row_counts = {root_filter.name: 0 for root_filter in filters}
+        number_of_rows = 0
+
+        with open_root_file_with_cache(input_root_file_path, self.branch_cache) as input_root_file:
+            tree = input_root_file[self.tree_name]
+            if not filters:
+                return tree.num_entries, filtered_row_counts
+
+            tree_branches = tree.keys()
+            filters = [root_filter.for_branches(tree_branches) for root_filter in filters]
+            filter_branches = self.filter_branches(filters)
+            output_branches = self.output_branches if self.output_branches is not None else list(tree.keys())
+            other_branches = [branch for branch in output_branches if branch not in filter_branches]
+            columns = (["index"] if self.write_entry_index else []) + output_branches
+
+            writers = {root_filter.name: RootTreeWriter(output_root_file_paths[root_filter.name], self.output_tree_name)
+                       for root_filter in filters}
+            try:
+                for arrays, report in tree.iterate(filter_branches, step_size=self.step_size, library="np", report=True):
+                    entry_start, entry_stop = report.tree_entry_start, report.tree_entry_stop
+                    number_of_rows += entry_stop - entry_start
+
+                    masks = {root_filter.name: np.asarray(root_filter.mask(arrays)) for root_filter in filters}
+                    selected_row_counts = {name: int(np.count_nonzero(mask)) for name, mask in masks.items()}
+                    for name, selected_row_count in selected_row_counts.items():
+                        filtered_row_counts[name] += selected_row_count
+
+                    # the other branches are only read when some rows are written
+                    if any(selected_row_counts.values()) and other_branches:
+                        arrays.update(tree.arrays(other_branches, entry_start=entry_start, entry_stop=entry_stop, library="np"))
+                    if self.write_entry_index:
+                        arrays["index"] = np.arange(entry_start, entry_stop, dtype=np.int64)
+
+                    for name, mask in masks.items():
+                        if selected_row_counts[name] > 0:
+                            writers[name].write({column: to_writable_array(arrays[column][mask]) for column in columns})
+
+                # filters without any selected row get an empty tree with the same branches
+                empty_writers = [writer for writer in writers.values() if not writer.tree_created]
+                if empty_writers:
+                    arrays = tree.arrays(output_branches, entry_start=0, entry_stop=1, library="np")
+                    arrays["index"] = np.zeros(0, dtype=np.int64)
+                    for writer in empty_writers:
+                        writer.write({column: to_writable_array(arrays[column][:0]) for column in columns})
+            finally:
+                for writer in writers.values():
+                    writer.close()
+
+        return number_of_rows, filtered_row_counts
@@ -0,0 +1,207 @@
+import os
+
+import numpy as np
+import uproot
+
+from root_streaming import DEFAULT_STEP_SIZE
+
+# number of bins of the distribution graphs of the filtered root files
+DEFAULT_NUMBER_OF_BINS = 50
+
+
+# strings (and other non numeric branches) are histogrammed per category
+def is_numeric(array):
+    return array.dtype.kind in "biuf"
+
+
+# minimum and maximum of every numeric branch over all the root files,
+# read chunk by chunk. returns branch -> (minimum, maximum), None for the
+# non numeric branches and for the branches without any entry.
+def compute_branch_ranges(root_file_paths, tree_name, branches=None, step_size=DEFAULT_STEP_SIZE):
+    branch_ranges = {}
+    for root_file_path in root_file_paths:
+        with uproot.open(root_file_path) as root_file:
+            tree = root_file[tree_name]
+            for arrays in tree.iterate(branches, step_size=step_size, library="np"):
+                for branch, array in arrays.items():
+                    branch_ranges.setdefault(branch, None)
+                    if not is_numeric(array) or len(array) == 0:
+                        continue
+                    minimum, maximum = array.min(), array.max()
+                    if branch_ranges[branch] is not None:
+                        minimum = min(minimum, branch_ranges[branch][0])
+                        maximum = max(maximum, branch_ranges[branch][1])
+                    branch_ranges[branch] = (minimum, maximum)
+    return branch_ranges
+
+
+# uniform bin edges for every branch range, None (categories) is kept as is
+def make_bin_edges(branch_ranges, number_of_bins=DEFAULT_NUMBER_OF_BINS):
+    bin_edges = {}
+    for branch, branch_range in branch_ranges.items():
+        if branch_range is None:
+            bin_edges[branch] = None
+            continue
+        minimum, maximum = float(branch_range[0]), float(branch_range[1])
+        if minimum == maximum:
+            minimum, maximum = minimum - 0.5, maximum + 0.5
+        bin_edges[branch] = np.linspace(minimum, maximum, number_of_bins + 1)
+    return bin_edges
+
+
+# bin of every value for uniform bin edges, the last bin includes its right edge
+# like np.histogram. values below the edges get a negative bin, values above get
+# a bin >= number of bins.
+def uniform_bin_index(values, edges):
+    number_of_bins = len(edges) - 1
+    values = np.asarray(values, dtype=np.float64)
+    bin_index = np.floor((values - edges[0]) * (number_of_bins / (edges[-1] - edges[0]))).astype(np.int64)
+    bin_index[values == edges[-1]] = number_of_bins - 1
+    return bin_index
+
+
+# bin counts of uniform bin edges with np.bincount. returns counts, underflow and overflow.
+def uniform_bin_counts(values, edges):
+    number_of_bins = len(edges) - 1
+    bin_index = uniform_bin_index(values, edges)
+    underflow = np.count_nonzero(bin_index < 0)
+    overflow = np.count_nonzero(bin_index >= number_of_bins)
+    in_range = bin_index[(bin_index >= 0) & (bin_index < number_of_bins)]
+    return np.bincount(in_range, minlength=number_of_bins), underflow, overflow
+
+
+# accumulates the histograms of many branches chunk by chunk with fixed bin edges,
+# the branches with None as edges are counted per category
+class HistogramAccumulator:
+
+    def __init__(self, bin_edges):
+        self.bin_edges = bin_edges
+        self.histograms = {}
+        for branch, edges in bin_edges.items():
+            if edges is None:
+                self.histograms[branch] = {'categories': {}}
+            else:
+                self.histograms[branch] = {
+                    'edges': np.asarray(edges, dtype=np.float64),
+                    'counts': np.zeros(len(edges) - 1, dtype=np.int64),
+                    'underflow': 0,
+                    'overflow': 0,
+                }
+
+    # arrays: branch -> values of a chunk
+    def fill(self, arrays):
+        for branch, histogram in self.histograms.items():
+            if branch not in arrays:
+                continue
+            values = arrays[branch]
+            if 'edges' in histogram:
+                counts, underflow, overflow = uniform_bin_counts(values, histogram['edges'])
+                histogram['counts'] += counts
+                histogram['underflow'] += underflow
+                histogram['overflow'] += overflow
+            else:
+                categories, counts = np.unique(np.asarray(values).astype(str), return_counts=True)
+                for category, count in zip(categories, counts):
+                    histogram['categories'][category] = histogram['categories'].get(category, 0) + int(count)
+
+    # returns branch -> histogram, categories are given as two arrays (names and counts)
+    def result(self):
+        histograms = {}
+        for branch, histogram in self.histograms.items():
+            if 'edges' in histogram:
+                histograms[branch] = dict(histogram)
+            else:
+                categories = sorted(histogram['categories'])
+                histograms[branch] = {
+                    'categories': np.array(categories, dtype=str),
+                    'counts': np.array([histogram['categories'][category] for category in categories], dtype=np.int64),
+                }
+        return histograms
+
+
+# histograms of the branches of bin_edges for one root file, read chunk by chunk
+def fill_histograms(root_file_path, tree_name, bin_edges, step_size=DEFAULT_STEP_SIZE):
+    accumulator = HistogramAccumulator(bin_edges)
+    with uproot.open(root_file_path) as root_file:
+        for arrays in root_file[tree_name].iterate(list(bin_edges), step_size=step_size, library="np"):
+            accumulator.fill(arrays)
+    return accumulator.result()
+
+
+# histograms of many root files with shared bin edges (one pass to find the
+# ranges, one pass to count). returns root file path -> histograms.
+def fill_histograms_with_shared_edges(root_file_paths, tree_name, branches=None, number_of_bins=DEFAULT_NUMBER_OF_BINS,
+                                      step_size=DEFAULT_STEP_SIZE):
+    bin_edges = make_bin_edges(compute_branch_ranges(root_file_paths, tree_name, branches, step_size), number_of_bins)
+    return {root_file_path: fill_histograms(root_file_path, tree_name, bin_edges, step_size) for root_file_path in root_file_paths}
+
+
+# saves the histograms in one compact .npz file, keys are "<branch>/<field>"
+def save_histograms(histograms_file_path, histograms):
+    arrays = {}
+    for branch, histogram in histograms.items():
+        for field, value in histogram.items():
+            arrays[f"{branch}/{field}"] = np.asarray(value)
+    np.savez_compressed(histograms_file_path, **arrays)
+
+
+def load_histograms(histograms_file_path):
+    histograms = {}
+    with np.load(histograms_file_path) as arrays:
+        for key in arrays.files:
+            branch, field = key.rsplit("/", 1)
+            value = arrays[key]
+            histograms.setdefault(branch, {})[field] = value if value.ndim > 0 else value.item()
+    return histograms
+
+
+# renders one histogram as png, only this stage needs matplotlib
+def render_histogram(histogram, branch_name, graph_file_path, dpi=300):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10,6))
+    # 2d histograms (hit maps, see optigan_aggregation.py) have edges on both axes
+    if 'x_edges' in histogram:
+        plt.pcolormesh(histogram['x_edges'], histogram['y_edges'], np.asarray(histogram['counts']).T, cmap="viridis")
+        plt.colorbar(label="Frequency")
+        plt.gca().set_aspect("equal")
+        plt.title(f"Histogram of {branch_name}", fontsize=16, fontweight='bold')
+        plt.xlabel(branch_name[:1], fontsize=14)
+        plt.ylabel(branch_name[1:], fontsize=14)
+        plt.tight_layout()
+        plt.savefig(graph_file_path, dpi=dpi)
+        plt.close()
+        return
+
+    # histograms estimated from a sample (see quick_look.py) have an error per bin
+    errors = histogram.get('errors')
+    if 'edges' in histogram:
+        plt.ticklabel_format(axis='x', style='plain')
+        plt.stairs(histogram['counts'], histogram['edges'], fill=True, color="teal", alpha=0.75)
+        if errors is not None:
+            plt.stairs(histogram['counts'] + errors, histogram['edges'], baseline=np.maximum(histogram['counts'] - errors, 0),
+                       fill=True, color="black", alpha=0.3, label="Poisson error of the sample")
+            plt.legend()
+    else:
+        plt.bar(histogram['categories'], histogram['counts'], yerr=errors, color="teal")
+    plt.title(f"Histograms of {branch_name}" + (" (sampled)" if errors is not None else ""), fontsize=16, fontweight='bold')
+    plt.xlabel(branch_name, fontsize=14)
+    plt.ylabel("Frequency", fontsize=14)
+
+    # Improve layout
+    plt.tight_layout()
+    plt.savefig(graph_file_path, dpi=dpi)
+    plt.close()
+
+
+# renders all the histograms of a .npz file as <branch>_histogram.png in graphs_folder,
+# the entries without counts (e.g. per event arrays) are not histograms and are skipped
+def render_histograms_file(histograms_file_path, graphs_folder, dpi=300):
+    os.makedirs(graphs_folder, exist_ok=True)
+    histograms = load_histograms(histograms_file_path)
+    for branch_name, histogram in histograms.items():
+        if 'counts' not in histogram:
+            continue
+        render_histogram(histogram, branch_name, os.path.join(graphs_folder, f"{branch_name}_histogram.png"), dpi)
@@ -0,0 +1,74 @@
+import uproot
+
+# default amount of data read at once when streaming a tree,
+# uproot accepts a number of entries (int) or a memory size ("100 MB")
+DEFAULT_STEP_SIZE = "100 MB"
+
+
+# converts a command line value into an uproot step size
+# "50000" -> 50000 entries, "100 MB" -> "100 MB"
+def parse_step_size(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    return value
+
+
+# yields (entry_start, arrays) for every chunk of the tree, arrays holds
+# only the requested branches so the memory used is proportional
+# to the step size and not to the size of the file. with a branch cache
+# (see branch_cache.py) the chunks are read from its memory-mapped files.
+def iterate_tree_chunks(root_file_path, tree_name, branches=None, step_size=DEFAULT_STEP_SIZE, library="np", branch_cache=None):
+    if branch_cache is not None:
+        chunks = branch_cache.open_tree(root_file_path, tree_name).iterate(branches, step_size=step_size, library=library, report=True)
+    else:
+        chunks = uproot.iterate({root_file_path: tree_name}, branches, step_size=step_size, library=library, report=True)
+    for arrays, report in chunks:
+        yield report.tree_entry_start, arrays
+
+
+# number of entries of a chunk given as a pandas DataFrame or a dictionary of arrays
+def chunk_length(chunk):
+    if isinstance(chunk, dict):
+        return len(next(iter(chunk.values()))) if chunk else 0
+    return len(chunk)
+
+
+# writes a tree chunk by chunk, the first non empty chunk creates the tree
+# and the following ones extend it. empty chunks are only written when
+# nothing else was, because uproot can not create string branches from them.
+class RootTreeWriter:
+
+    def __init__(self, root_file_path, tree_name="tree"):
+        self.root_file_path = root_file_path
+        self.tree_name = tree_name
+        self.number_of_entries = 0
+        self.root_file = uproot.recreate(root_file_path)
+        self.tree_created = False
+        self.empty_chunk = None
+
+    def write(self, chunk):
+        length = chunk_length(chunk)
+        if length == 0:
+            self.empty_chunk = chunk
+            return
+        if self.tree_created:
+            self.root_file[self.tree_name].extend(chunk)
+        else:
+            self.root_file[self.tree_name] = chunk
+            self.tree_created = True
+        self.number_of_entries += length
+
+    def close(self):
+        if not self.tree_created and self.empty_chunk is not None:
+            self.root_file[self.tree_name] = self.empty_chunk
+            self.tree_created = True
+        self.root_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()